@@ -13,6 +13,7 @@ from .lib import (
     session,
     configure,
     lilypad_config,
+    preload_deployments,
     register_serializer,
 )
 from ._types import NOT_GIVEN, Omit, NoneType, NotGiven, Transport, ProxiesTypes
@@ -47,6 +48,7 @@ __all__ = [
     "configure",
     "lilypad_config",
     "Message",
+    "preload_deployments",
     "RemoteFunctionError",
     "register_serializer",
     "session",
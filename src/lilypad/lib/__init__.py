@@ -8,11 +8,13 @@ from .messages import Message
 from .sessions import Session, session
 from ._configure import configure, lilypad_config
 from .exceptions import RemoteFunctionError
+from .deployments import preload_deployments
 
 __all__ = [
     "configure",
     "lilypad_config",
     "Message",
+    "preload_deployments",
     "RemoteFunctionError",
     "register_serializer",
     "session",
@@ -2,27 +2,45 @@
 
 from __future__ import annotations
 
+import os
 import time
 import queue
 import random
+import inspect
 import logging
 import threading
 import importlib.util
-from typing import Any
+from typing import Any, TypeVar
 from secrets import token_bytes
+from functools import wraps
 from contextlib import contextmanager
 from contextvars import copy_context
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence, Coroutine
 
+import orjson
 from pydantic import TypeAdapter
-from opentelemetry import trace
-from opentelemetry.trace import INVALID_SPAN_ID, INVALID_TRACE_ID
-from opentelemetry.sdk.trace import IdGenerator, ReadableSpan, TracerProvider
+from opentelemetry import trace, context as otel_context
+from opentelemetry.trace import (
+    INVALID_SPAN_ID,
+    INVALID_TRACE_ID,
+    Link,
+    Status,
+    SpanKind,
+    StatusCode,
+    TraceFlags,
+    SpanContext,
+)
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import Event, IdGenerator, ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace.export import (
     SpanExporter,
     SpanExportResult,
     BatchSpanProcessor,
+    SimpleSpanProcessor,
 )
+from opentelemetry.sdk.util.instrumentation import InstrumentationScope
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
 
 from .exceptions import LilypadException
 from ._utils.client import get_sync_client
@@ -44,6 +62,13 @@ _MAX_RETRIES = 5
 _BACKOFF_SECS = 2.0
 _WORKER_SLEEP = 0.2
 
+_R = TypeVar("_R")
+
+_span_processor: SpanProcessor | None = None
+_span_processor_lock = threading.Lock()
+_sandbox_exporter: _CollectingSpanExporter | None = None
+_propagator = TraceContextTextMapPropagator()
+
 
 class _RetryPayload:
     __slots__ = ("data", "attempts")
@@ -72,6 +97,59 @@ class CryptoIdGenerator(IdGenerator):
         return trace_id
 
 
+def _span_to_dict(span: ReadableSpan) -> dict[str, Any]:
+    """Convert the span data to a dictionary that can be serialized to JSON"""
+    # span.instrumentation_scope to_json does not work
+    instrumentation_scope = (
+        {
+            "name": span.instrumentation_scope.name,
+            "version": span.instrumentation_scope.version,
+            "schema_url": span.instrumentation_scope.schema_url,
+            "attributes": dict(span.instrumentation_scope.attributes.items())
+            if span.instrumentation_scope.attributes
+            else None,
+        }
+        if span.instrumentation_scope
+        else {
+            "name": None,
+            "version": None,
+            "schema_url": None,
+            "attributes": {},
+        }
+    )
+    return {
+        "trace_id": f"{span.context.trace_id:032x}" if span.context else None,
+        "span_id": f"{span.context.span_id:016x}" if span.context else None,
+        "parent_span_id": f"{span.parent.span_id:016x}" if span.parent else None,
+        "instrumentation_scope": instrumentation_scope,
+        "resource": span.resource.to_json(0),
+        "name": span.name,
+        "start_time": span.start_time,
+        "end_time": span.end_time,
+        "attributes": dict(span.attributes.items()) if span.attributes else {},
+        "status": span.status.status_code.name,
+        "session_id": span.attributes.get("lilypad.session_id"),
+        "events": [
+            {
+                "name": event.name,
+                "attributes": dict(event.attributes.items()) if event.attributes else {},
+                "timestamp": event.timestamp,
+            }
+            for event in span.events
+        ],
+        "links": [
+            {
+                "context": {
+                    "trace_id": f"{link.context.trace_id:032x}",
+                    "span_id": f"{link.context.span_id:016x}",
+                },
+                "attributes": link.attributes,
+            }
+            for link in span.links
+        ],
+    }
+
+
 class _JSONSpanExporter(SpanExporter):
     """A custom span exporter that sends spans to a custom endpoint as JSON."""
 
@@ -163,7 +241,7 @@ class _JSONSpanExporter(SpanExporter):
         if not spans:
             return SpanExportResult.SUCCESS
 
-        span_data = [self._span_to_dict(span) for span in spans]
+        span_data = [_span_to_dict(span) for span in spans]
 
         if response_spans := self._send_once(span_data):
             for response_span in response_spans:
@@ -177,57 +255,18 @@ class _JSONSpanExporter(SpanExporter):
             self.log.error("Retry queue full – dropping %d spans", len(span_data))
             return SpanExportResult.FAILURE
 
-    def _span_to_dict(self, span: ReadableSpan) -> dict[str, Any]:
-        """Convert the span data to a dictionary that can be serialized to JSON"""
-        # span.instrumentation_scope to_json does not work
-        instrumentation_scope = (
-            {
-                "name": span.instrumentation_scope.name,
-                "version": span.instrumentation_scope.version,
-                "schema_url": span.instrumentation_scope.schema_url,
-                "attributes": dict(span.instrumentation_scope.attributes.items())
-                if span.instrumentation_scope.attributes
-                else None,
-            }
-            if span.instrumentation_scope
-            else {
-                "name": None,
-                "version": None,
-                "schema_url": None,
-                "attributes": {},
-            }
-        )
-        return {
-            "trace_id": f"{span.context.trace_id:032x}" if span.context else None,
-            "span_id": f"{span.context.span_id:016x}" if span.context else None,
-            "parent_span_id": f"{span.parent.span_id:016x}" if span.parent else None,
-            "instrumentation_scope": instrumentation_scope,
-            "resource": span.resource.to_json(0),
-            "name": span.name,
-            "start_time": span.start_time,
-            "end_time": span.end_time,
-            "attributes": dict(span.attributes.items()) if span.attributes else {},
-            "status": span.status.status_code.name,
-            "session_id": span.attributes.get("lilypad.session_id"),
-            "events": [
-                {
-                    "name": event.name,
-                    "attributes": dict(event.attributes.items()) if event.attributes else {},
-                    "timestamp": event.timestamp,
-                }
-                for event in span.events
-            ],
-            "links": [
-                {
-                    "context": {
-                        "trace_id": f"{link.context.trace_id:032x}",
-                        "span_id": f"{link.context.span_id:016x}",
-                    },
-                    "attributes": link.attributes,
-                }
-                for link in span.links
-            ],
-        }
+
+def _configure_logging(
+    log_level: int, log_format: str | None, log_handlers: list[logging.Handler] | None
+) -> logging.Logger:
+    logger = logging.getLogger("lilypad")
+    logger.setLevel(log_level)
+    logger.handlers.clear()
+    handlers = log_handlers or [LogHandler()]
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(log_format))
+        logger.addHandler(handler)
+    return logger
 
 
 def configure(
@@ -256,13 +295,7 @@ def configure(
 
     _set_settings(new)
 
-    logger = logging.getLogger("lilypad")
-    logger.setLevel(log_level)
-    logger.handlers.clear()
-    handlers = log_handlers or [LogHandler()]
-    for handler in handlers:
-        handler.setFormatter(logging.Formatter(log_format))
-        logger.addHandler(handler)
+    logger = _configure_logging(log_level, log_format, log_handlers)
 
     # Proceed with tracer provider configuration.
     if trace.get_tracer_provider().__class__.__name__ == "TracerProvider":
@@ -275,6 +308,9 @@ def configure(
         wrap_batch_processor(processor)
     provider.add_span_processor(processor)
     trace.set_tracer_provider(provider)
+    global _span_processor
+    with _span_processor_lock:
+        _span_processor = processor
 
     if not auto_llm:
         return
@@ -314,6 +350,143 @@ def configure(
         OutlinesInstrumentor().instrument()
 
 
+class _CollectingSpanExporter(SpanExporter):
+    """Keeps finished spans in memory so that a sandbox can return them with its result."""
+
+    def __init__(self) -> None:
+        self._spans: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self._lock:
+            self._spans.extend({**_span_to_dict(span), "kind": span.kind.name} for span in spans)
+        return SpanExportResult.SUCCESS
+
+    def collect(self) -> list[dict[str, Any]]:
+        with self._lock:
+            spans, self._spans = self._spans, []
+        return spans
+
+
+def _span_from_dict(data: dict[str, Any]) -> ReadableSpan:
+    """Rebuild a span serialized by `_span_to_dict` in a sandbox."""
+    trace_id = int(data["trace_id"], 16)
+    sampled = TraceFlags(TraceFlags.SAMPLED)
+    resource = orjson.loads(data["resource"])
+    scope = data["instrumentation_scope"]
+    return ReadableSpan(
+        name=data["name"],
+        context=SpanContext(trace_id, int(data["span_id"], 16), is_remote=False, trace_flags=sampled),
+        parent=SpanContext(trace_id, int(data["parent_span_id"], 16), is_remote=True, trace_flags=sampled)
+        if data["parent_span_id"]
+        else None,
+        resource=Resource(resource["attributes"], resource.get("schema_url")),
+        attributes=data["attributes"],
+        events=[Event(event["name"], event["attributes"], event["timestamp"]) for event in data["events"]],
+        links=[
+            Link(
+                SpanContext(
+                    int(link["context"]["trace_id"], 16),
+                    int(link["context"]["span_id"], 16),
+                    is_remote=True,
+                    trace_flags=sampled,
+                ),
+                link["attributes"],
+            )
+            for link in data["links"]
+        ],
+        kind=SpanKind[data.get("kind", "INTERNAL")],
+        status=Status(StatusCode[data["status"]]),
+        start_time=data["start_time"],
+        end_time=data["end_time"],
+        instrumentation_scope=InstrumentationScope(
+            scope["name"] or "", scope["version"], scope["schema_url"], scope["attributes"]
+        ),
+    )
+
+
+def configure_sandbox(
+    *,
+    log_level: int = DEFAULT_LOG_LEVEL,
+    log_format: str | None = None,
+    log_handlers: list[logging.Handler] | None = None,
+) -> None:
+    """Initialize Lilypad inside a sandbox whose spans are exported by its caller.
+
+    Unlike `configure`, no exporter is started: finished spans are kept in
+    memory until `collect_sandbox_spans` hands them over with the call's
+    result, and the caller exports them with `export_sandbox_spans`.
+    """
+    global _sandbox_exporter
+    _configure_logging(log_level, log_format, log_handlers)
+    if _sandbox_exporter is not None:
+        return
+    _sandbox_exporter = _CollectingSpanExporter()
+    provider = TracerProvider(id_generator=CryptoIdGenerator())
+    provider.add_span_processor(SimpleSpanProcessor(_sandbox_exporter))
+    trace.set_tracer_provider(provider)
+
+
+def collect_sandbox_spans() -> list[dict[str, Any]]:
+    """Return and forget the spans finished in this sandbox so far."""
+    return _sandbox_exporter.collect() if _sandbox_exporter is not None else []
+
+
+def current_traceparent() -> str | None:
+    """Return the W3C `traceparent` of the current span, if there is one."""
+    carrier: dict[str, str] = {}
+    _propagator.inject(carrier)
+    return carrier.get("traceparent")
+
+
+def propagate_context(fn: Callable[..., _R]) -> Callable[..., _R]:
+    """Run each call of *fn* in the trace context of the sandbox's caller.
+
+    The caller passes its W3C `traceparent` as the `_lilypad_traceparent`
+    keyword argument; without it, the `TRACEPARENT` environment variable is
+    used. Spans started by *fn* then become children of the caller's span.
+    """
+
+    async def _in_context(coroutine: Coroutine[Any, Any, Any], context: Context) -> Any:
+        token = otel_context.attach(context)
+        try:
+            return await coroutine
+        finally:
+            otel_context.detach(token)
+
+    @wraps(fn)
+    def inner(*args: Any, _lilypad_traceparent: str | None = None, **kwargs: Any) -> Any:
+        traceparent = _lilypad_traceparent or os.environ.get("TRACEPARENT")
+        context = _propagator.extract({"traceparent": traceparent} if traceparent else {})
+        token = otel_context.attach(context)
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            otel_context.detach(token)
+        if inspect.iscoroutine(result):
+            return _in_context(result, context)
+        return result
+
+    return inner
+
+
+def export_sandbox_spans(spans: Sequence[dict[str, Any]] | None) -> None:
+    """Export spans returned by a sandbox through this process's span pipeline.
+
+    Uses the processor set up by `configure`; if Lilypad was not configured,
+    one exporting to the Lilypad API is created on first use.
+    """
+    if not spans:
+        return
+    global _span_processor
+    with _span_processor_lock:
+        if _span_processor is None:
+            _span_processor = BatchSpanProcessor(_JSONSpanExporter())  # pyright: ignore[reportArgumentType]
+        processor = _span_processor
+    for span in spans:
+        processor.on_end(_span_from_dict(span))
+
+
 @contextmanager
 def lilypad_config(**override: Any):
     token = None
@@ -2,31 +2,44 @@
 
 from __future__ import annotations
 
+import io
 import os
 import ast
 import sys
+import json
 import site
+import bisect
+import pickle
 import hashlib
 import inspect
+import keyword
+import logging
 import tempfile
+import tokenize
+import itertools
+import threading
 import subprocess
 import importlib.util
+import multiprocessing
 import importlib.metadata
 from types import ModuleType
-from typing import Any, TypeVar, cast
+from typing import Any, NamedTuple, cast
 from pathlib import Path
+from weakref import WeakKeyDictionary
 from textwrap import dedent
-from functools import lru_cache, cached_property  # noqa: TID251
-from collections.abc import Callable
+from functools import wraps, lru_cache, cached_property  # noqa: TID251
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterable, Iterator, Sequence
 from typing_extensions import TypedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import libcst as cst
-import libcst.matchers as m
-from libcst import MaybeSentinel
-from pydantic import BaseModel
+from pydantic import Field, BaseModel
 from packaging.requirements import Requirement
 
-_BaseCompoundStatementT = TypeVar("_BaseCompoundStatementT", bound=cst.BaseCompoundStatement)
+from .settings import get_settings
+
+logger = logging.getLogger(__name__)
 
 
 class DependencyInfo(TypedDict):
@@ -60,71 +73,226 @@ def _is_third_party(module: ModuleType, site_packages: set[str]) -> bool:
     )
 
 
-class _RemoveDocstringTransformer(cst.CSTTransformer):
-    """A LibCST transformer for removing docstrings from functions and classes.
+_module_sources: dict[str, tuple[int, str, ast.Module]] = {}
+
+
+def _module_source(module: ModuleType) -> tuple[str, ast.Module]:
+    """Returns the source and `ast` tree of a module, cached by its file path and modification time."""
+    path = getattr(module, "__file__", None)
+    try:
+        mtime = os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        mtime = None
+    if path and mtime is not None and (cached := _module_sources.get(path)) and cached[0] == mtime:
+        return cached[1], cached[2]
+    source = inspect.getsource(module)
+    tree = ast.parse(source)
+    if path and mtime is not None:
+        _module_sources[path] = (mtime, source, tree)
+    return source, tree
+
+
+@lru_cache(maxsize=1024)
+def _parse_ast(code: str) -> ast.Module:
+    """Returns the `ast` tree of a code snippet; callers must not modify it."""
+    return ast.parse(code)
+
+
+class _SourceEdits:
+    """Replacements of text spans in a source, applied without reformatting the rest of it."""
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self._lines = source.splitlines(keepends=True)
+        self._line_starts = [0, *itertools.accumulate(len(line) for line in self._lines)]
+        self._edits: list[tuple[int, int, str]] = []
+
+    def offset(self, lineno: int, col_offset: int) -> int:
+        """Returns the index in the source of an `ast` position, whose column counts UTF-8 bytes."""
+        line = self._lines[lineno - 1] if lineno <= len(self._lines) else ""
+        return self._line_starts[lineno - 1] + len(line.encode("utf-8")[:col_offset].decode("utf-8", "ignore"))
+
+    def token_offset(self, position: tuple[int, int]) -> int:
+        """Returns the index in the source of a `tokenize` position, whose column counts characters."""
+        lineno, col = position
+        return self._line_starts[min(lineno, len(self._lines) + 1) - 1] + col
+
+    def start(self, node: ast.expr | ast.stmt | ast.alias) -> int:
+        return self.offset(node.lineno, node.col_offset)
+
+    def end(self, node: ast.expr | ast.stmt | ast.alias) -> int:
+        return self.offset(node.end_lineno or node.lineno, node.end_col_offset or 0)
+
+    def replace(self, start: int, end: int, text: str) -> None:
+        self._edits.append((start, end, text))
+
+    def apply(self) -> str:
+        """Returns the edited source; an edit overlapping an earlier one is dropped."""
+        parts: list[str] = []
+        position = 0
+        for start, end, text in sorted(self._edits, key=lambda edit: edit[0]):
+            if start < position:
+                continue
+            parts += [self.source[position:start], text]
+            position = end
+        parts.append(self.source[position:])
+        return "".join(parts)
+
+
+@lru_cache(maxsize=1024)
+def _tokens(code: str) -> tuple[tokenize.TokenInfo, ...]:
+    """Returns the tokens of a code snippet."""
+    return tuple(tokenize.generate_tokens(io.StringIO(code).readline))
+
+
+_DefinitionNode = ast.FunctionDef | ast.AsyncFunctionDef | ast.ClassDef
+
+# Before Python 3.12 an f-string is a single STRING token, and `ast` positions inside it are unreliable.
+_FSTRING_TOKENS = sys.version_info < (3, 12)
+
 
-    This transformer unconditionally removes the first statement (docstring) in each
-    FunctionDef/ClassDef if it is a single string literal. If removing the docstring
-    leaves the body empty, we insert a single 'pass' statement.
+def _fstring_fields(body: str) -> Iterator[tuple[int, int]]:
+    """Yields the spans of the replacement field expressions in the body of an f-string.
 
-    If exclude_fn_body=True, we replace the entire body with a single 'pass' statement.
+    The fields nested in a format spec are yielded after the field they belong to.
     """
+    index = 0
+    while index < len(body):
+        if body.startswith(("{{", "}}"), index):
+            index += 2
+            continue
+        if body[index] != "{":
+            index += 1
+            continue
+        index += 1
+        start, depth, quote = index, 0, ""
+        while index < len(body):
+            char = body[index]
+            if quote:
+                if body.startswith(quote, index):
+                    index += len(quote) - 1
+                    quote = ""
+            elif char in "'\"":
+                quote = char * 3 if body.startswith(char * 3, index) else char
+                index += len(quote) - 1
+            elif char in "([{":
+                depth += 1
+            elif char in ")]}":
+                if not depth:
+                    break
+                depth -= 1
+            elif not depth and (char == ":" or (char == "!" and not body.startswith("!=", index))):
+                break
+            index += 1
+        expression = body[start:index].rstrip()
+        if expression.endswith("=") and not expression.endswith(("==", "!=", "<=", ">=")):
+            expression = expression[:-1]  # a self-documenting `{name=}`
+        yield start, start + len(expression)
 
-    def __init__(self, exclude_fn_body: bool) -> None:
-        super().__init__()
-        self.exclude_fn_body = exclude_fn_body
 
-    @staticmethod
-    def _remove_first_docstring(
-        node: _BaseCompoundStatementT,
-    ) -> _BaseCompoundStatementT:
-        """Return the body without a docstring, inserting 'pass' if no docstring."""
-        body = node.body
-        stmts = list(body.body)
-        if stmts:
-            first_stmt = stmts[0]
-            # Check if the first statement is a single string-literal line
-            if m.matches(first_stmt, m.SimpleStatementLine(body=[m.Expr(value=m.SimpleString())])):
-                # Remove the docstring
-                stmts.pop(0)
-
-        # If removing docstring leaves no statements, insert a single 'pass'
-        if not stmts:
-            stmts = [
-                cst.Expr(
-                    value=cst.Ellipsis(
-                        lpar=[],
-                        rpar=[],
-                    ),
-                    semicolon=MaybeSentinel.DEFAULT,
-                )
-            ]
-            if m.matches(node.body, m.IndentedBlock()):
-                return node.with_changes(body=stmts[0])
-        new_body = body.with_changes(body=stmts)
-        return node.with_changes(body=new_body)
-
-    def leave_FunctionDef(self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef) -> cst.FunctionDef:
-        if self.exclude_fn_body:
-            stmts = cst.Expr(
-                value=cst.Ellipsis(
-                    lpar=[],
-                    rpar=[],
-                ),
-                semicolon=MaybeSentinel.DEFAULT,
-            )
-            return updated_node.with_changes(body=stmts)
+def _remove_docstrings(source: str, exclude_fn_body: bool) -> str:
+    """Removes the docstring of each function and class in `source`, keeping its formatting.
 
-        return self._remove_first_docstring(updated_node)
+    A docstring is a string literal alone on the first line of an indented
+    body; a body left empty becomes `...`. With `exclude_fn_body`, function
+    bodies are replaced with `...` and class bodies with `pass` instead.
+    """
+    tree = _parse_ast(source)
+    tokens = _tokens(source)
+    edits = _SourceEdits(source)
+    token_starts = [edits.token_offset(token.start) for token in tokens]
+
+    def next_token(offset: int, kind: int) -> tokenize.TokenInfo:
+        index = bisect.bisect_left(token_starts, offset)
+        while tokens[index].type != kind:
+            index += 1
+        return tokens[index]
+
+    def statement_start(node: ast.stmt) -> int:
+        """Returns the index where `node` starts, including its decorators."""
+        if not isinstance(node, _DefinitionNode) or not node.decorator_list:
+            return edits.start(node)
+        index = bisect.bisect_left(token_starts, edits.start(node.decorator_list[0])) - 1
+        while not (tokens[index].type == tokenize.OP and tokens[index].string == "@"):
+            index -= 1
+        return token_starts[index]
+
+    def header_end(node: _DefinitionNode) -> int:
+        """Returns the index just past the colon that ends the definition's header."""
+        index = bisect.bisect_left(token_starts, statement_start(node.body[0])) - 1
+        while not (tokens[index].type == tokenize.OP and tokens[index].string == ":"):
+            index -= 1
+        return edits.token_offset(tokens[index].end)
+
+    def line_end(node: ast.stmt) -> tokenize.TokenInfo:
+        """Returns the NEWLINE token that ends the logical line of `node`."""
+        return next_token(edits.end(node), tokenize.NEWLINE)
+
+    def is_docstring(node: _DefinitionNode, colon: int) -> bool:
+        first = node.body[0]
+        if not (
+            isinstance(first, ast.Expr)
+            and isinstance(first.value, ast.Constant)
+            and isinstance(first.value.value, str | bytes)
+        ):
+            return False
+        if "\n" not in source[colon : edits.start(first)]:
+            return False  # a body on the header's line
+        if len(node.body) > 1 and node.body[1].lineno == (first.end_lineno or first.lineno):
+            return False  # followed by another statement on the same line
+        start, end = edits.start(first.value), edits.end(first.value)
+        return (
+            sum(
+                1
+                for offset, token in zip(token_starts, tokens, strict=False)
+                if start <= offset < end and token.type == tokenize.STRING
+            )
+            == 1
+        )
 
-    def leave_ClassDef(self, original_node: cst.ClassDef, updated_node: cst.ClassDef) -> cst.ClassDef:
-        if self.exclude_fn_body:
-            # Replace entire body with a single 'pass'
-            pass_stmt = cst.SimpleStatementLine([cst.Pass()])
-            new_body = updated_node.body.with_changes(body=[pass_stmt])
-            return updated_node.with_changes(body=new_body)
+    def visit(node: ast.AST) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, _DefinitionNode):
+                clean(child)
+            else:
+                visit(child)
+
+    def clean(node: _DefinitionNode) -> None:
+        colon = header_end(node)
+        body_start = statement_start(node.body[0])
+        body_on_header = "\n" not in source[colon:body_start]
+        if exclude_fn_body:
+            body_end = edits.token_offset(line_end(node.body[-1]).start)
+            if not isinstance(node, ast.ClassDef):
+                edits.replace(colon, body_end, "...")
+            elif body_on_header:
+                edits.replace(colon, body_end, " pass")
+            else:
+                first_line = source.rfind("\n", 0, body_start) + 1
+                indent = source[first_line:body_start]
+                edits.replace(edits.token_offset(next_token(colon, tokenize.NEWLINE).end), first_line, "")
+                edits.replace(first_line, body_end, f"{indent}pass")
+            return
+        body = node.body
+        if is_docstring(node, colon):
+            docstring_end = line_end(body[0])
+            if len(body) == 1:
+                edits.replace(colon, edits.token_offset(docstring_end.start), "...")
+                return
+            edits.replace(
+                edits.token_offset(next_token(colon, tokenize.NEWLINE).end),
+                edits.token_offset(docstring_end.end),
+                "",
+            )
+            body = body[1:]
+        for statement in body:
+            if isinstance(statement, _DefinitionNode):
+                clean(statement)
+            else:
+                visit(statement)
 
-        return self._remove_first_docstring(updated_node)
+    visit(tree)
+    return edits.apply()
 
 
 def _clean_source_code(
@@ -133,26 +301,16 @@ def _clean_source_code(
     exclude_fn_body: bool = False,
 ) -> str:
     """Returns a function's source code cleaned of elements that have no impact on behavior.
-    Uses LibCST to:
-      1. Remove the first docstring from any function/class in the code.
-      2. Insert 'pass' if removal leaves the body empty.
-      3. Optionally replace the body with 'pass' if exclude_fn_body is True.
-      4. Convert multi-line strings to triple-quoted strings.
+
+    Unless docstrings are included in versioning, removes the docstring of each
+    function and class in the code, replacing a body left empty with `...`, and
+    optionally replaces the bodies with `...` if `exclude_fn_body` is True.
     """
     source = dedent(inspect.getsource(fn))
     docstr_flag = os.getenv("LILYPAD_VERSIONING_INCLUDE_DOCSTRINGS", "true").lower()
     if docstr_flag not in ("0", "false", "no"):
         return source.rstrip()
-    module = cst.parse_module(source)
-
-    transformer = _RemoveDocstringTransformer(exclude_fn_body=exclude_fn_body)
-    new_module = module.visit(transformer)
-
-    code = new_module.code
-    # Trim trailing whitespace
-    code = code.rstrip()
-
-    return code
+    return _remove_docstrings(source, exclude_fn_body).rstrip()
 
 
 class _NameCollector(ast.NodeVisitor):
@@ -408,12 +566,16 @@ class _DefinitionCollector(ast.NodeVisitor):
         self.generic_visit(node)
 
 
-class _QualifiedNameRewriter(cst.CSTTransformer):
-    """A transformer that rewrites qualified names and resolves import aliases."""
+class _QualifiedNameRewriter:
+    """Rewrites qualified names and resolves import aliases in code snippets.
+
+    An attribute access whose final name is a local name is collapsed to that
+    name, and each aliased name is replaced with its original name. The code
+    is otherwise left as written.
+    """
 
     def __init__(self, local_names: set[str], user_defined_imports: set[str]) -> None:
         """Initialize alias mapping from import statements."""
-        super().__init__()
         self.local_names: set[str] = local_names
         self.alias_mapping = {}
         for import_stmt in user_defined_imports:
@@ -424,64 +586,108 @@ class _QualifiedNameRewriter(cst.CSTTransformer):
                     alias = parts[parts.index("as") + 1]
                     self.alias_mapping[alias] = original_name
 
-    def _gather_attribute_chain(self, node: cst.Attribute | cst.Name) -> list[str]:
-        """Recursively gather the full attribute chain into a list of names.
-
-        Args:
-            node: The current node to process
-
-        Returns:
-            List of attribute names in order from left to right
-        """
-        names = []
-        current = node
-
-        while isinstance(current, cst.Attribute):
-            names.append(current.attr.value)
-            current = current.value
-
-        if isinstance(current, cst.Name):
-            names.append(current.value)
-
-        return list(reversed(names))
-
-    def leave_Attribute(self, original_node: cst.Attribute, updated_node: cst.Attribute) -> cst.Name | cst.Attribute:
-        """Process attribute access expressions and potentially simplify them.
-
-        Args:
-            original_node: Original Attribute node
-            updated_node: Updated Attribute node after visiting children
-
-        Returns:
-            Transformed node (either simplified Name or original Attribute)
-        """
-        names = self._gather_attribute_chain(updated_node)
-
-        node_name = names[-1]
+    def _local_name(self, name: str) -> str | None:
+        """Returns the local name a dotted name collapses to, if any."""
+        last = name.rsplit(".", 1)[-1]
+        last = self.alias_mapping.get(last, last)
+        return last if "." in name and last in self.local_names else None
+
+    def rewrite(self, code: str) -> str:
+        """Returns `code` with its qualified names and aliases rewritten."""
+        tokens = _tokens(code)
+        edits = _SourceEdits(code)
+        token_starts = [edits.token_offset(token.start) for token in tokens]
+        collapsed: list[tuple[int, int]] = []
+
+        def collapse(start: int, end: int, name: str) -> None:
+            edits.replace(start, end, name)
+            collapsed.append((start, end))
+
+        def dotted_name(index: int) -> tuple[int, int, str]:
+            """Returns the span and text of the dotted name starting at token `index`."""
+            start, parts = token_starts[index], [tokens[index].string]
+            while tokens[index + 1].string == "." and tokens[index + 2].type == tokenize.NAME:
+                parts += [".", tokens[index + 2].string]
+                index += 2
+            return start, edits.token_offset(tokens[index].end), "".join(parts)
+
+        def visit(node: ast.AST) -> None:
+            if _FSTRING_TOKENS and isinstance(node, ast.JoinedStr):
+                return  # rewritten from its STRING token below
+            if isinstance(node, ast.Attribute) and (name := self._local_name(f".{node.attr}")):
+                collapse(edits.start(node), edits.end(node), name)
+                return
+            if isinstance(node, ast.alias) and hasattr(node, "lineno"):
+                start, end, dotted = dotted_name(bisect.bisect_left(token_starts, edits.start(node)))
+                if name := self._local_name(dotted):
+                    collapse(start, end, name)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                index = bisect.bisect_left(token_starts, edits.start(node)) + 1
+                while tokens[index].type != tokenize.NAME:
+                    index += 1  # relative import dots
+                start, end, dotted = dotted_name(index)
+                if name := self._local_name(dotted):
+                    collapse(start, end, name)
+            for child in ast.iter_child_nodes(node):
+                visit(child)
+
+        visit(_parse_ast(code))
+        collapsed.sort()
+        for offset, token in zip(token_starts, tokens, strict=False):
+            if token.type == tokenize.STRING and _FSTRING_TOKENS:
+                self._rewrite_fstring(token.string, offset, edits)
+            elif (
+                token.type == tokenize.NAME
+                and token.string in self.alias_mapping
+                and not keyword.iskeyword(token.string)
+            ):
+                index = bisect.bisect_right(collapsed, (offset, len(code) + 1)) - 1
+                if index < 0 or collapsed[index][1] <= offset:
+                    edits.replace(offset, edits.token_offset(token.end), self.alias_mapping[token.string])
+        return edits.apply()
+
+    def _rewrite_fstring(self, string: str, offset: int, edits: _SourceEdits) -> None:
+        """Rewrites the replacement field expressions of an f-string token starting at `offset`."""
+        prefix = len(string) - len(string.lstrip("bBfFrRuU"))
+        if "f" not in string[:prefix].lower():
+            return
+        quote = 3 if string.startswith(string[prefix] * 3, prefix) else 1
+        body = string[prefix + quote : len(string) - quote]
+        for start, end in _fstring_fields(body):
+            expression = body[start:end]
+            try:
+                rewritten = self.rewrite(f"({expression})")[1:-1]
+            except (SyntaxError, tokenize.TokenError):
+                continue
+            if rewritten != expression:
+                start += offset + prefix + quote
+                edits.replace(start, start + len(expression), rewritten)
 
-        if node_name in self.local_names:
-            return cst.Name(value=node_name)
 
-        return updated_node
+_class_indexes: WeakKeyDictionary[ModuleType, tuple[int, dict[str, type]]] = WeakKeyDictionary()
 
-    def leave_Name(self, original_node: cst.Name, updated_node: cst.Name) -> cst.Name:
-        """Process name nodes and resolve aliases.
 
-        Args:
-            original_node: Original Name node
-            updated_node: Updated Name node after visiting children
+def _module_class_index(module: ModuleType) -> dict[str, type]:
+    """Returns the classes defined in *module*, including nested ones, by their `__qualname__`.
 
-        Returns:
-            Transformed name node with alias resolved if applicable
-        """
-        if updated_node.value in self.alias_mapping:
-            # Replace alias with original name
-            return cst.Name(
-                value=self.alias_mapping[updated_node.value],
-                lpar=updated_node.lpar,
-                rpar=updated_node.rpar,
-            )
-        return updated_node
+    The index is cached per module and rebuilt when the module's namespace grows.
+    """
+    size = len(vars(module))
+    cached = _class_indexes.get(module)
+    if cached is not None and cached[0] == size:
+        return cached[1]
+    index: dict[str, type] = {}
+    seen: set[int] = set()
+    pending = [value for value in list(vars(module).values()) if isinstance(value, type)]
+    while pending:
+        cls = pending.pop()
+        if cls.__module__ != module.__name__ or id(cls) in seen:
+            continue
+        seen.add(id(cls))
+        index.setdefault(cls.__qualname__, cls)
+        pending.extend(value for value in vars(cls).values() if isinstance(value, type))
+    _class_indexes[module] = (size, index)
+    return index
 
 
 def _get_class_from_unbound_method(method: Callable[..., Any]) -> type | None:
@@ -490,6 +696,18 @@ def _get_class_from_unbound_method(method: Callable[..., Any]) -> type | None:
     if len(parts) < 2:
         return None
     class_qualname = ".".join(parts[:-1])
+
+    module = sys.modules.get(getattr(method, "__module__", None) or "")
+    if module is not None and "<locals>" not in parts:
+        obj: Any = module
+        for part in parts[:-1]:
+            obj = getattr(obj, part, None)
+        if isinstance(obj, type) and obj.__qualname__ == class_qualname:
+            return obj
+        if cls := _module_class_index(module).get(class_qualname):
+            return cls
+
+    # Classes defined inside functions are not reachable from their module.
     import gc
 
     for obj in gc.get_objects():
@@ -503,12 +721,9 @@ def _get_class_from_unbound_method(method: Callable[..., Any]) -> type | None:
     return None
 
 
+@lru_cache(maxsize=1024)
 def _clean_source_from_string(source: str, exclude_fn_body: bool = False) -> str:
-    source = dedent(source)
-    module = cst.parse_module(source)
-    transformer = _RemoveDocstringTransformer(exclude_fn_body=exclude_fn_body)
-    new_module = module.visit(transformer)
-    return new_module.code.rstrip()
+    return _remove_docstrings(dedent(source), exclude_fn_body).rstrip()
 
 
 def get_class_source_from_method(method: Callable[..., Any]) -> str:
@@ -519,6 +734,49 @@ def get_class_source_from_method(method: Callable[..., Any]) -> str:
     return _clean_source_from_string(source)
 
 
+class _DistributionIndex:
+    """The installed distributions, built once per `sys.path`."""
+
+    def __init__(self, path: tuple[str, ...]) -> None:
+        self.path = path
+        self.site_packages: set[str] = {str(Path(p).resolve()) for p in site.getsitepackages()}
+        self.installed: dict[str, importlib.metadata.Distribution] = {
+            dist.name: dist for dist in importlib.metadata.distributions()
+        }
+        self.import_to_dist = importlib.metadata.packages_distributions()
+        self._extras: dict[str, tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+
+    def extras(self, dist: importlib.metadata.Distribution) -> list[str]:
+        """Returns the extras of `dist` whose requirements are all installed."""
+        with self._lock:
+            if (extras := self._extras.get(dist.name)) is not None:
+                return list(extras)
+        extra_reqs = dist.requires or []
+        satisfiable = []
+        for extra in dist.metadata.get_all("Provides-Extra", []):
+            extra_deps = [Requirement(r).name for r in extra_reqs if f"extra == '{extra}'" in r]
+            if extra_deps and all(dep in self.installed for dep in extra_deps):
+                satisfiable.append(extra)
+        with self._lock:
+            self._extras[dist.name] = tuple(satisfiable)
+        return satisfiable
+
+
+_distribution_index: _DistributionIndex | None = None
+_distribution_index_lock = threading.Lock()
+
+
+def _get_distribution_index() -> _DistributionIndex:
+    """Returns the distribution index, rebuilding it if `sys.path` changed since it was built."""
+    global _distribution_index
+    path = tuple(sys.path)
+    with _distribution_index_lock:
+        if _distribution_index is None or _distribution_index.path != path:
+            _distribution_index = _DistributionIndex(path)
+        return _distribution_index
+
+
 class _DependencyCollector:
     """Collects all dependencies for a function."""
 
@@ -529,7 +787,12 @@ class _DependencyCollector:
         self.assignments: list[str] = []
         self.source_code: list[str] = []
         self.visited_functions: set[str] = set()
-        self.site_packages: set[str] = {str(Path(p).resolve()) for p in site.getsitepackages()}
+        self.source_names: list[str] = []
+        self.modules: set[str] = set()
+        self.definition_children: dict[str, list[str]] = {}
+        self._including: list[str] = []
+        self._distributions = _get_distribution_index()
+        self.site_packages = self._distributions.site_packages
         self._last_import_collector: _ImportCollector | None = None
 
     def _collect_assignments_and_imports(
@@ -550,7 +813,7 @@ class _DependencyCollector:
         global_assignment_collector.visit(module_tree)
 
         for global_assignment in global_assignment_collector.assignments:
-            tree = ast.parse(global_assignment)
+            tree = _parse_ast(global_assignment)
             stmt = cast(ast.Assign | ast.AnnAssign, tree.body[0])
             if isinstance(stmt, ast.Assign):
                 var_name = cast(ast.Name, stmt.targets[0]).id
@@ -608,10 +871,10 @@ class _DependencyCollector:
             module = inspect.getmodule(definition)
             if not module or _is_third_party(module, self.site_packages):
                 return
+            self.modules.add(module.__name__)
 
-            module_source = inspect.getsource(module)
-            module_tree = ast.parse(module_source)
-            fn_tree = ast.parse(source)
+            module_source, module_tree = _module_source(module)
+            fn_tree = _parse_ast(source)
 
             name_collector = _NameCollector()
             name_collector.visit(fn_tree)
@@ -630,22 +893,31 @@ class _DependencyCollector:
                 for user_defined_import in self.user_defined_imports:
                     source = source.replace(user_defined_import, "")
                 self.source_code.insert(0, source)
-
-            self._collect_assignments_and_imports(fn_tree, module_tree, used_names, module_source)
-            definition_collector = _DefinitionCollector(module, used_names, self.site_packages)
-            definition_collector.visit(fn_tree)
-            for collected_definition in definition_collector.definitions_to_include:
-                self._collect_imports_and_source_code(collected_definition, True)
-            for collected_definition in definition_collector.definitions_to_analyze:
-                self._collect_imports_and_source_code(collected_definition, False)
+                self.source_names.insert(0, definition.__qualname__)
+                self.definition_children.setdefault(definition.__qualname__, [])
+                if self._including:
+                    self.definition_children[self._including[-1]].append(definition.__qualname__)
+                self._including.append(definition.__qualname__)
+
+            try:
+                self._collect_assignments_and_imports(fn_tree, module_tree, used_names, module_source)
+                definition_collector = _DefinitionCollector(module, used_names, self.site_packages)
+                definition_collector.visit(fn_tree)
+                for collected_definition in definition_collector.definitions_to_include:
+                    self._collect_imports_and_source_code(collected_definition, True)
+                for collected_definition in definition_collector.definitions_to_analyze:
+                    self._collect_imports_and_source_code(collected_definition, False)
+            finally:
+                if include_source:
+                    self._including.pop()
 
         except (OSError, TypeError):  # pragma: no cover
             pass
 
     def _collect_required_dependencies(self, imports: set[str]) -> dict[str, DependencyInfo]:
         stdlib_modules = set(sys.stdlib_module_names)
-        installed_packages = {dist.name: dist for dist in importlib.metadata.distributions()}
-        import_to_dist = importlib.metadata.packages_distributions()
+        installed_packages = self._distributions.installed
+        import_to_dist = self._distributions.import_to_dist
 
         dependencies = {}
         for import_stmt in imports:
@@ -662,12 +934,7 @@ class _DependencyCollector:
                 if dist_name not in installed_packages:  # pragma: no cover
                     continue
                 dist = installed_packages[dist_name]
-                extras = []
-                for extra in dist.metadata.get_all("Provides-Extra", []):
-                    extra_reqs = dist.requires or []
-                    extra_deps = [Requirement(r).name for r in extra_reqs if f"extra == '{extra}'" in r]
-                    if extra_deps and all(dep in installed_packages for dep in extra_deps):
-                        extras.append(extra)
+                extras = self._distributions.extras(dist)
 
                 dependencies[dist.name] = {
                     "version": dist.version,
@@ -692,13 +959,33 @@ class _DependencyCollector:
             elif isinstance(value, ast.AST):
                 cls._map_child_to_parent(child_to_parent, value, node)
 
+    def definition_hashes(self, source_code: list[str]) -> dict[str, str]:
+        """Returns the Merkle hash of each included definition by qualified name.
+
+        A definition's hash combines the canonical hash of its own (rewritten)
+        source with the hashes of the definitions it pulled into the closure,
+        so it only changes when the definition or one of its dependencies does.
+        """
+        own = {name: _canonical_hash(code) for name, code in zip(self.source_names, source_code, strict=True)}
+        hashes: dict[str, str] = {}
+
+        def merkle(name: str) -> str:
+            if name not in hashes:
+                children = sorted(merkle(child) for child in self.definition_children[name])
+                hashes[name] = _combine_hashes([own[name], *children])
+            return hashes[name]
+
+        for name in own:
+            merkle(name)
+        return hashes
+
     def collect(self, fn: Callable[..., Any]) -> tuple[list[str], list[str], list[str], dict[str, DependencyInfo]]:
         """Returns the imports and source code for a function and its dependencies."""
         self._collect_imports_and_source_code(fn, True)
 
         local_names = set()
         for code in self.source_code + self.assignments:
-            tree = ast.parse(code)
+            tree = _parse_ast(code)
 
             child_to_parent = {}
 
@@ -723,17 +1010,8 @@ class _DependencyCollector:
 
         rewriter = _QualifiedNameRewriter(local_names, self.user_defined_imports)
 
-        assignments = []
-        for code in self.assignments:
-            tree = cst.parse_module(code)
-            new_tree = tree.visit(rewriter)
-            assignments.append(new_tree.code)
-
-        source_code = []
-        for code in self.source_code:
-            tree = cst.parse_module(code)
-            new_tree = tree.visit(rewriter)
-            source_code.append(new_tree.code)
+        assignments = [rewriter.rewrite(code) for code in self.assignments]
+        source_code = [rewriter.rewrite(code) for code in self.source_code]
 
         required_dependencies = self._collect_required_dependencies(self.imports | self.fn_internal_imports)
 
@@ -745,34 +1023,350 @@ class _DependencyCollector:
         )
 
 
+_RUFF_BATCH_SIZE = 256
+
+
+def _run_ruff_batch(codes: Sequence[str]) -> list[str]:
+    """Sort the imports of and format each of *codes* with ruff.
+
+    The codes are written to one temporary directory and formatted with two
+    ruff invocations per `_RUFF_BATCH_SIZE` files instead of two per code.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        tmp_paths = [Path(directory, f"code_{index}.py") for index in range(len(codes))]
+        for tmp_path, code in zip(tmp_paths, codes, strict=True):
+            tmp_path.write_text(code, encoding="utf-8")
+
+        for start in range(0, len(tmp_paths), _RUFF_BATCH_SIZE):
+            batch = [str(tmp_path) for tmp_path in tmp_paths[start : start + _RUFF_BATCH_SIZE]]
+            proc = subprocess.run(
+                ["ruff", "check", "--isolated", "--select=I", "--fix", *batch],
+                capture_output=True,
+                text=True,
+            )
+
+            # 0: no rule violations / 1: violations found but fixed successfully
+            if proc.returncode not in (0, 1):
+                raise subprocess.CalledProcessError(proc.returncode, proc.args, output=proc.stdout, stderr=proc.stderr)
+
+            subprocess.run(
+                ["ruff", "format", "--isolated", "--line-length=88", *batch],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+        return [tmp_path.read_text(encoding="utf-8") for tmp_path in tmp_paths]
+
+
 def _run_ruff(code: str) -> str:
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as tmp_file:
-        tmp_file.write(code)
-        tmp_path = Path(tmp_file.name)
+    return _run_ruff_batch([code])[0]
 
-    try:
-        proc = subprocess.run(
-            ["ruff", "check", "--isolated", "--select=I", "--fix", str(tmp_path)],
-            capture_output=True,
-            text=True,
-        )
 
-        # 0: no rule violations / 1: violations found but fixed successfully
-        if proc.returncode not in (0, 1):
-            raise subprocess.CalledProcessError(
-                proc.returncode, proc.args, output=proc.stdout, stderr=proc.stderr
+class _DocstringNormalizer(ast.NodeTransformer):
+    """Dedents docstrings so that re-indenting a definition does not change its canonical form."""
+
+    def _normalize(self, node: ast.Module | ast.ClassDef | ast.FunctionDef | ast.AsyncFunctionDef) -> ast.AST:
+        self.generic_visit(node)
+        if (
+            node.body
+            and isinstance(first := node.body[0], ast.Expr)
+            and isinstance(first.value, ast.Constant)
+            and isinstance(first.value.value, str)
+        ):
+            first.value.value = inspect.cleandoc(first.value.value)
+        return node
+
+    visit_Module = visit_ClassDef = visit_FunctionDef = visit_AsyncFunctionDef = _normalize  # noqa: N815
+
+
+def _canonical_code(code: str) -> str:
+    """Returns *code* in a canonical form that does not depend on its formatting.
+
+    The code is parsed and unparsed in-process, with docstrings dedented and
+    top-level imports split into one name per statement, de-duplicated and
+    sorted, so it is equal for any two codes that ruff formats identically.
+    """
+    tree = _DocstringNormalizer().visit(ast.parse(code))
+    imports: set[str] = set()
+    body: list[str] = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports.update(ast.unparse(ast.Import(names=[alias])) for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.update(
+                ast.unparse(ast.ImportFrom(module=node.module, names=[alias], level=node.level)) for alias in node.names
             )
+        else:
+            body.append(ast.unparse(node))
+    return "\n".join([*sorted(imports), *body])
+
+
+@lru_cache(maxsize=4096)
+def _canonical_hash(code: str) -> str:
+    """Returns the SHA-256 hash of the canonical form of *code*."""
+    return hashlib.sha256(_canonical_code(code).encode("utf-8")).hexdigest()
+
+
+_HASH_VERSION = 2
+"""The version of the closure hash.
+
+1: the SHA-256 hash of the closure's code formatted with ruff.
+2: the root of a Merkle tree of canonical hashes, see `_closure_hash`. Hashes
+   differ from version 1 even for unchanged code; `Closure.legacy_hash` keeps
+   the version 1 hash so that existing functions are still found by it.
+"""
+
+
+def _combine_hashes(hashes: Sequence[str]) -> str:
+    """Returns the SHA-256 hash of a node whose children have the given hashes."""
+    return hashlib.sha256("\n".join(hashes).encode("utf-8")).hexdigest()
+
+
+def _closure_hash(imports: Sequence[str], assignments: Sequence[str], definition_hashes: Sequence[str]) -> str:
+    """Returns the root of the closure's Merkle tree.
+
+    Its children are the hash of the sorted imports, the hash of each global
+    assignment and the hashes of the definitions no other definition included.
+    """
+    return _combine_hashes(
+        [
+            _canonical_hash("\n".join(sorted(imports))),
+            *(_canonical_hash(assignment) for assignment in assignments),
+            *definition_hashes,
+        ]
+    )
+
+
+_MANIFEST_VERSION = 1
+
+_file_digests: dict[str, tuple[int, str]] = {}
+
+
+def _file_digest(path: str) -> str:
+    """Returns the SHA-256 hash of a file's contents, cached by its modification time."""
+    mtime = os.stat(path).st_mtime_ns
+    if (cached := _file_digests.get(path)) and cached[0] == mtime:
+        return cached[1]
+    digest = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    _file_digests[path] = (mtime, digest)
+    return digest
+
+
+def _source_fingerprint(modules: Sequence[str]) -> str | None:
+    """Returns a hash of the source files of *modules*, or `None` if one of them has none."""
+    digests = []
+    for name in sorted(modules):
+        path = getattr(sys.modules.get(name), "__file__", None)
+        if path is None:
+            return None
+        try:
+            digests.append(f"{name}:{_file_digest(path)}")
+        except OSError:
+            return None
+    return _combine_hashes(digests)
+
+
+def _manifest_key(fn: Callable[..., Any]) -> str:
+    return f"{fn.__module__}:{fn.__qualname__}"
+
+
+@lru_cache(maxsize=8)
+def _load_manifest(path: str) -> dict[str, dict[str, Any]]:
+    """Returns the closures of a manifest written by `lilypad build`, by `_manifest_key`."""
+    with open(path, "rb") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != _MANIFEST_VERSION:
+        raise ValueError(f"Unsupported closure manifest version in {path}: {manifest.get('version')}")
+    return manifest["closures"]
+
+
+def _closure_from_manifest(fn: Callable[..., Any]) -> Closure | None:
+    """Returns the closure of *fn* from the configured manifest if its sources have not changed since the build."""
+    path = get_settings().closure_manifest_path
+    if path is None:
+        return None
+    entry = _load_manifest(path).get(_manifest_key(fn))
+    if entry is None or _source_fingerprint(entry["modules"]) != entry["fingerprint"]:
+        return None
+    return Closure.model_validate(entry["closure"])
+
+
+class _CollectedClosure(NamedTuple):
+    """A closure before its code and signature are formatted, as sent back by worker processes."""
+
+    name: str
+    code: str
+    signature: str
+    hash: str
+    dependencies: dict[str, DependencyInfo]
+    definition_hashes: dict[str, str]
+    modules: list[str]
+
+
+def _collect_closure(fn: Callable[..., Any]) -> _CollectedClosure:
+    """Collects the closure of *fn* without formatting it."""
+    collector = _DependencyCollector()
+    imports, assignments, source_code, dependencies = collector.collect(fn)
+    code = "{imports}\n\n{assignments}\n\n{source_code}".format(
+        imports="\n".join(imports),
+        assignments="\n".join(assignments),
+        source_code="\n\n".join(source_code),
+    )
+    definition_hashes = collector.definition_hashes(source_code)
+    included = {child for children in collector.definition_children.values() for child in children}
+    return _CollectedClosure(
+        name=get_qualified_name(fn),
+        code=code,
+        signature=_clean_source_code(fn, exclude_fn_body=True),
+        hash=_closure_hash(
+            imports,
+            assignments,
+            [definition_hashes[name] for name in collector.source_names if name not in included],
+        ),
+        dependencies=dependencies,
+        definition_hashes=definition_hashes,
+        modules=sorted(collector.modules),
+    )
+
+
+# Raised when a function or its closure cannot be sent to or from a worker process, or a worker dies.
+_WORKER_ERRORS = (pickle.PicklingError, AttributeError, TypeError, ImportError, BrokenProcessPool)
+
+
+def _pool_context() -> multiprocessing.context.BaseContext:
+    """Returns the start method of the closure pool: `forkserver` where available, else `spawn`.
+
+    Forking the calling process itself could copy its threads' held locks into the workers.
+    """
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+
+
+def _collect_closures(fns: Sequence[Callable[..., Any]], workers: int | None = 1) -> list[tuple[Closure, list[str]]]:
+    """Computes the closures of *fns* and returns each with the modules it was collected from.
 
-        subprocess.run(
-            ["ruff", "format", "--isolated", "--line-length=88", str(tmp_path)],
-            check=True,
-            capture_output=True,
-            text=True,
+    With more than one worker, the closures are collected in a pool of
+    processes started with `_pool_context`, which import the functions' modules
+    again; as with any `multiprocessing` code, a calling script must guard its
+    entry point with `if __name__ == "__main__":`. Functions that cannot be
+    collected there, e.g. because they cannot be pickled, are collected in this
+    process. All codes and signatures are then formatted with one batch of ruff
+    invocations.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(fns) > 1:
+        collected: list[_CollectedClosure] = []
+        with ProcessPoolExecutor(min(workers, len(fns)), mp_context=_pool_context()) as pool:
+            futures = [pool.submit(_collect_closure, fn) for fn in fns]
+            for fn, future in zip(fns, futures, strict=True):
+                try:
+                    collected.append(future.result())
+                except _WORKER_ERRORS as e:
+                    logger.warning(
+                        "Collecting the closure of %s in this process, as a worker process could not: %r",
+                        get_qualified_name(fn),
+                        e,
+                    )
+                    collected.append(_collect_closure(fn))
+    else:
+        collected = [_collect_closure(fn) for fn in fns]
+
+    formatted = _run_ruff_batch([text for entry in collected for text in (entry.code, entry.signature)])
+    closures = []
+    for index, entry in enumerate(collected):
+        closure = Closure(
+            name=entry.name,
+            signature=formatted[2 * index + 1].strip(),
+            code=formatted[2 * index],
+            hash=entry.hash,
+            legacy_hash=hashlib.sha256(formatted[2 * index].encode("utf-8")).hexdigest(),
+            dependencies=entry.dependencies,
+            definition_hashes=entry.definition_hashes,
         )
-        processed_code = tmp_path.read_text()
-        return processed_code
-    finally:
-        tmp_path.unlink()
+        closures.append((closure, entry.modules))
+    return closures
+
+
+class _CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int | None
+    currsize: int
+
+
+def _closure_cache_key(fn: Callable[..., Any]) -> Hashable:
+    """Returns a key identifying the code of *fn* and the version of its source file.
+
+    Functions re-created from the same definition, e.g. by a decorator
+    factory, share a key, and editing the source file changes it.
+    """
+    unwrapped = inspect.unwrap(fn)
+    code = getattr(unwrapped, "__code__", None)
+    if code is None:
+        return fn
+    try:
+        mtime = os.stat(code.co_filename).st_mtime_ns
+    except OSError:
+        mtime = None
+    return (fn.__module__, fn.__qualname__, code, getattr(fn, "__code__", None), mtime)
+
+
+class _ClosureCache:
+    """An LRU cache of closures keyed by `_closure_cache_key` instead of function objects.
+
+    Its size is read from the `closure_cache_size` setting; `None` means unbounded.
+    """
+
+    def __init__(self) -> None:
+        self._entries: OrderedDict[Hashable, Closure] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, fn: Callable[..., Any]) -> Closure | None:
+        key = _closure_cache_key(fn)
+        with self._lock:
+            closure = self._entries.get(key)
+            if closure is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return closure
+
+    def put(self, fn: Callable[..., Any], closure: Closure) -> None:
+        maxsize = get_settings().closure_cache_size
+        with self._lock:
+            self._entries[_closure_cache_key(fn)] = closure
+            while maxsize is not None and len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def __call__(self, compute: Callable[[type[Closure], Callable[..., Any]], Closure]) -> Any:
+        """Decorates `Closure.from_fn`, adding `cache_clear` and `cache_info` like `lru_cache`."""
+
+        @wraps(compute)
+        def cached(cls: type[Closure], fn: Callable[..., Any]) -> Closure:
+            if (closure := self.get(fn)) is None:
+                closure = compute(cls, fn)
+                self.put(fn, closure)
+            return closure
+
+        cached.cache_clear = self.cache_clear  # pyright: ignore [reportFunctionMemberAccess]
+        cached.cache_info = self.cache_info  # pyright: ignore [reportFunctionMemberAccess]
+        return cached
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = 0
+
+    def cache_info(self) -> _CacheInfo:
+        with self._lock:
+            return _CacheInfo(self._hits, self._misses, get_settings().closure_cache_size, len(self._entries))
+
+
+_closure_cache = _ClosureCache()
 
 
 class Closure(BaseModel):
@@ -782,35 +1376,83 @@ class Closure(BaseModel):
     signature: str
     code: str
     hash: str
+    """The root of the closure's Merkle tree, see `_HASH_VERSION`."""
     dependencies: dict[str, DependencyInfo]
+    definition_hashes: dict[str, str] = Field(default_factory=dict)
+    """The Merkle hash of each function and class in the closure, by qualified name."""
+    legacy_hash: str | None = None
+    """The hash of the formatted `code`, which was the closure hash before `_HASH_VERSION` 2.
+
+    Functions registered by older versions of the SDK are stored under it, so
+    it is looked up when `hash` is not found.
+    """
 
     @classmethod
-    @lru_cache(maxsize=128)
+    @_closure_cache
     def from_fn(cls, fn: Callable[..., Any]) -> Closure:
         """Create a closure from a function.
 
+        Closures are cached by the function's module, qualified name, code and
+        source file modification time, see `from_fn.cache_info()`. If the `closure_manifest_path` setting points to a manifest written by
+        `lilypad build` that holds the function, and the source files it was
+        built from are unchanged, the closure is read from the manifest.
+
         Args:
             fn: The function to analyze
 
         Returns:
             Closure: The closure of the function.
         """
-        collector = _DependencyCollector()
-        imports, assignments, source_code, dependencies = collector.collect(fn)
-        code = "{imports}\n\n{assignments}\n\n{source_code}".format(
-            imports="\n".join(imports),
-            assignments="\n".join(assignments),
-            source_code="\n\n".join(source_code),
-        )
-        formatted_code = _run_ruff(code)
-        hash_value = hashlib.sha256(formatted_code.encode("utf-8")).hexdigest()
-        return cls(
-            name=get_qualified_name(fn),
-            signature=_run_ruff(_clean_source_code(fn, exclude_fn_body=True)).strip(),
-            code=formatted_code,
-            hash=hash_value,
-            dependencies=dependencies,
-        )
+        if (closure := _closure_from_manifest(fn)) is not None:
+            return closure
+        return _collect_closures([fn])[0][0]
 
+    @classmethod
+    def from_fns(cls, fns: Iterable[Callable[..., Any]], *, workers: int | None = None) -> list[Closure]:
+        """Create the closures of many functions in parallel.
 
-__all__ = ["Closure"]
+        Closures already in `from_fn`'s cache or in the configured manifest are
+        reused; the others are collected in a pool of *workers* processes, one
+        per CPU by default, formatted together and added to the cache.
+
+        Args:
+            fns: The functions to analyze
+            workers: The number of processes to use, or 1 to collect in this process
+
+        Returns:
+            list[Closure]: The closures, in the order of `fns`.
+        """
+        fns = list(fns)
+        closures: dict[Callable[..., Any], Closure] = {}
+        pending = []
+        for fn in dict.fromkeys(fns):
+            if (closure := _closure_cache.get(fn) or _closure_from_manifest(fn)) is not None:
+                closures[fn] = closure
+            else:
+                pending.append(fn)
+        for fn, (closure, _) in zip(pending, _collect_closures(pending, workers), strict=True):
+            closures[fn] = closure
+        for fn, closure in closures.items():
+            _closure_cache.put(fn, closure)
+        return [closures[fn] for fn in fns]
+
+
+def build_closure_manifest(fns: Iterable[Callable[..., Any]], *, workers: int | None = None) -> dict[str, Any]:
+    """Computes the closures of *fns* for a manifest that `Closure.from_fn` can read instead.
+
+    Each closure is stored under the function's module and qualified name,
+    with a fingerprint of the source files it was collected from. The
+    closures are collected in parallel as in `Closure.from_fns`.
+    """
+    fns = list(dict.fromkeys(fns))
+    closures: dict[str, Any] = {}
+    for fn, (closure, modules) in zip(fns, _collect_closures(fns, workers), strict=True):
+        closures[_manifest_key(fn)] = {
+            "modules": modules,
+            "fingerprint": _source_fingerprint(modules),
+            "closure": closure.model_dump(mode="json"),
+        }
+    return {"version": _MANIFEST_VERSION, "closures": closures}
+
+
+__all__ = ["Closure", "build_closure_manifest"]
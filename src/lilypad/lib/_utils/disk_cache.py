@@ -0,0 +1,222 @@
+"""An on-disk `FunctionPublic` cache shared by every process on a host."""
+
+from __future__ import annotations
+
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from typing import Literal, TypeAlias
+from pathlib import Path
+from collections.abc import Callable, Awaitable
+
+from .settings import get_settings
+from ...types.projects.functions import FunctionPublic
+
+CacheKind: TypeAlias = Literal["hash", "version", "deployed"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS functions (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+_POLL_INTERVAL = 0.05  # seconds
+
+
+def _encode_key(key: tuple[object, ...]) -> str:
+    return "\x1f".join(str(part) for part in key)
+
+
+class FunctionDiskCache:
+    """A SQLite-backed cache of `FunctionPublic` lookups.
+
+    The database runs in WAL mode so that many processes can read concurrently.
+    Fetches are coordinated with short-lived leases: when several processes miss
+    the same key at once, one of them fetches while the others wait for its
+    result, so a restart storm produces a single API call per key.
+    """
+
+    def __init__(self, path: str | os.PathLike[str], *, lease_seconds: float = 10.0) -> None:
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self._owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self._closed = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # one connection shared by every thread; `_lock` serializes its use
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # leases are claimed on their own connection, so waiting for the write lock does not block lookups
+        self._claim_conn = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=False)
+
+    def close(self) -> None:
+        """Close the database connections."""
+        with self._claim_lock, self._lock:
+            self._claim_conn.close()
+            self._conn.close()
+            self._closed = True
+
+    def get(
+        self, kind: CacheKind, key: tuple[object, ...], *, max_age: float | None = None
+    ) -> tuple[float, FunctionPublic] | None:
+        """Return `(stored_at, value)` for *key*, or `None` if missing or older than *max_age*."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM functions WHERE kind = ? AND key = ?", (kind, _encode_key(key))
+            ).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] > max_age):
+            return None
+        return row[1], FunctionPublic.model_validate_json(row[0])
+
+    def set(self, kind: CacheKind, key: tuple[object, ...], value: FunctionPublic) -> float:
+        """Store *value* for *key* and return its timestamp."""
+        stored_at = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO functions (kind, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                (kind, _encode_key(key), value.model_dump_json(), stored_at),
+            )
+        return stored_at
+
+    def delete(self, kind: CacheKind, key: tuple[object, ...], *, prefix: bool = False) -> None:
+        """Delete *key*, or every key starting with the parts of *key* when *prefix* is set."""
+        encoded = _encode_key(key)
+        with self._lock:
+            if prefix:
+                encoded += "\x1f"
+                self._conn.execute(
+                    "DELETE FROM functions WHERE kind = ? AND substr(key, 1, ?) = ?", (kind, len(encoded), encoded)
+                )
+            else:
+                self._conn.execute("DELETE FROM functions WHERE kind = ? AND key = ?", (kind, encoded))
+
+    def _claim(self, kind: CacheKind, key: str) -> bool:
+        now = time.time()
+        with self._claim_lock:
+            self._claim_conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._claim_conn.execute(
+                    "DELETE FROM leases WHERE kind = ? AND key = ? AND expires_at < ?", (kind, key, now)
+                )
+                cursor = self._claim_conn.execute(
+                    "INSERT OR IGNORE INTO leases (kind, key, owner, expires_at) VALUES (?, ?, ?, ?)",
+                    (kind, key, self._owner, now + self.lease_seconds),
+                )
+                self._claim_conn.execute("COMMIT")
+            except BaseException:
+                self._claim_conn.execute("ROLLBACK")
+                raise
+            return cursor.rowcount == 1
+
+    def _release(self, kind: CacheKind, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE kind = ? AND key = ? AND owner = ?", (kind, key, self._owner))
+
+    def get_or_fetch(
+        self,
+        kind: CacheKind,
+        key: tuple[object, ...],
+        fetch: Callable[[], FunctionPublic | None],
+        *,
+        max_age: float | None = None,
+        force: bool = False,
+    ) -> tuple[float, FunctionPublic | None]:
+        """Return the cached value for *key*, fetching and storing it on a miss.
+
+        Args:
+            kind: The lookup the value belongs to.
+            key: The lookup key.
+            fetch: Called to fetch the value when no process has a usable copy.
+            max_age: Entries older than this many seconds are refetched.
+            force: Skip the read and always fetch.
+
+        Returns:
+            `(stored_at, value)`. `value` is `None` if *fetch* returned `None`,
+            in which case nothing is stored.
+        """
+        encoded = _encode_key(key)
+        deadline = time.monotonic() + self.lease_seconds
+        while True:
+            if not force and (hit := self.get(kind, key, max_age=max_age)):
+                return hit
+            if self._claim(kind, encoded) or time.monotonic() > deadline:
+                break
+            time.sleep(_POLL_INTERVAL)
+        try:
+            if not force and (hit := self.get(kind, key, max_age=max_age)):
+                return hit
+            value = fetch()
+            return (self.set(kind, key, value) if value is not None else time.time()), value
+        finally:
+            self._release(kind, encoded)
+
+    async def get_or_fetch_async(
+        self,
+        kind: CacheKind,
+        key: tuple[object, ...],
+        fetch: Callable[[], Awaitable[FunctionPublic | None]],
+        *,
+        max_age: float | None = None,
+        force: bool = False,
+    ) -> tuple[float, FunctionPublic | None]:
+        """Asynchronous version of `get_or_fetch`; the database is accessed from worker threads."""
+        encoded = _encode_key(key)
+        deadline = time.monotonic() + self.lease_seconds
+        while True:
+            if not force and (hit := await asyncio.to_thread(self.get, kind, key, max_age=max_age)):
+                return hit
+            if await asyncio.to_thread(self._claim, kind, encoded) or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(_POLL_INTERVAL)
+        try:
+            if not force and (hit := await asyncio.to_thread(self.get, kind, key, max_age=max_age)):
+                return hit
+            value = await fetch()
+            if value is None:
+                return time.time(), value
+            return await asyncio.to_thread(self.set, kind, key, value), value
+        finally:
+            await asyncio.to_thread(self._release, kind, encoded)
+
+
+_disk_caches: dict[str, FunctionDiskCache] = {}  # by path; kept open for the life of the process
+_disk_caches_lock = threading.Lock()
+
+
+def _open_disk_cache(path: str) -> FunctionDiskCache:
+    with _disk_caches_lock:
+        cache = _disk_caches.get(path)
+        if cache is None or cache._closed:
+            cache = _disk_caches[path] = FunctionDiskCache(path)
+        return cache
+
+
+def get_disk_cache() -> FunctionDiskCache | None:
+    """Return the configured on-disk cache, or `None` if `LILYPAD_FUNCTION_CACHE_PATH` is unset."""
+    path = get_settings().function_cache_path
+    if not path:
+        return None
+    return _open_disk_cache(str(Path(path).expanduser()))
+
+
+__all__ = ["FunctionDiskCache", "get_disk_cache"]
@@ -2,20 +2,28 @@
 
 from __future__ import annotations
 
+import random
 import asyncio
+import logging
 import threading
 from time import time
 from typing import Any, Final, Generic, TypeVar, Callable, Awaitable, OrderedDict
 from functools import lru_cache  # noqa: TID251
-from collections.abc import Coroutine
+from contextvars import copy_context
+from collections.abc import Iterable, Coroutine
+from concurrent.futures import Future
 
 from lilypad.lib._utils import Closure
+from lilypad._exceptions import NotFoundError
 from lilypad.lib._utils.client import get_sync_client, get_async_client
+from lilypad.lib._utils.settings import get_settings
+from lilypad.lib._utils.disk_cache import CacheKind, get_disk_cache
 from lilypad.types.projects.functions import FunctionPublic
 
 _HASH_SYNC_MAX = 2_048
 _hash_async_lock = asyncio.Lock()
-_hash_async_cache: dict[tuple[str, str], FunctionPublic] = {}
+
+_NOT_FOUND_MAX = 1_024
 
 _VERSION_SYNC_MAX = 2_048
 _version_async_lock = asyncio.Lock()
@@ -29,42 +37,238 @@ _Key = tuple[str, str]  # (project_uuid, function_name | function_hash)
 _Hit = tuple[float, FunctionPublic]  # (timestamp, value)
 
 _deployed_cache: dict[_Key, _Hit] = {}
-_hash_cache: dict[_Key, FunctionPublic] = {}
+_hash_cache: OrderedDict[_Key, FunctionPublic] = OrderedDict()
+_not_found_cache: OrderedDict[_Key, tuple[float, NotFoundError]] = OrderedDict()
+_create_sync_futures: dict[_Key, Future[FunctionPublic | None]] = {}
+_create_async_tasks: dict[_Key, asyncio.Task[FunctionPublic | None]] = {}
 
 _hash_lock = threading.Lock()
 _deployed_sync_lock = threading.Lock()
 _deployed_async_lock = asyncio.Lock()
 
-_DEFAULT_DEPLOY_TTL = 30.0  # seconds
+_deployed_refreshing: set[_Key] = set()  # keys with a background refresh in flight
+_background_tasks: set[asyncio.Task[None]] = set()
+
+logger = logging.getLogger(__name__)
+
+
+def _fetch_sync(
+    kind: CacheKind,
+    key: tuple[str, ...],
+    fetch: Callable[[], FunctionPublic | None],
+    *,
+    max_age: float | None = None,
+    force: bool = False,
+) -> tuple[float, FunctionPublic | None]:
+    """Fetch through the on-disk cache when one is configured."""
+    disk = get_disk_cache()
+    if disk is None:
+        return time(), fetch()
+    return disk.get_or_fetch(kind, key, fetch, max_age=max_age, force=force)
+
+
+async def _fetch_async(
+    kind: CacheKind,
+    key: tuple[str, ...],
+    fetch: Callable[[], Awaitable[FunctionPublic | None]],
+    *,
+    max_age: float | None = None,
+    force: bool = False,
+) -> tuple[float, FunctionPublic | None]:
+    """Asynchronous version of `_fetch_sync`."""
+    disk = get_disk_cache()
+    if disk is None:
+        return time(), await fetch()
+    return await disk.get_or_fetch_async(kind, key, fetch, max_age=max_age, force=force)
+
+
+def _hash_hit(key: _Key) -> FunctionPublic | None:
+    # callers hold _hash_lock
+    if (fn := _hash_cache.get(key)) is not None:
+        _hash_cache.move_to_end(key)
+    return fn
+
+
+def _get_cached_hash(key: _Key) -> FunctionPublic | None:
+    """Return the cached function for *key*, raising if it was recently not found."""
+    with _hash_lock:
+        if (fn := _hash_hit(key)) is not None:
+            return fn
+        hit = _not_found_cache.get(key)
+        if hit is None:
+            return None
+        ttl = get_settings().not_found_cache_ttl
+        if ttl <= 0 or _expired(hit[0], ttl):
+            del _not_found_cache[key]
+            return None
+    error = hit[1]
+    # raise a copy so concurrent callers don't share (and grow) one traceback
+    raise NotFoundError(error.message, response=error.response, body=error.body)
+
+
+def _remember_hash(key: _Key, fn: FunctionPublic) -> None:
+    with _hash_lock:
+        _not_found_cache.pop(key, None)
+        _hash_cache[key] = fn
+        _hash_cache.move_to_end(key)
+        if len(_hash_cache) > _HASH_SYNC_MAX:
+            _hash_cache.popitem(last=False)  # evict least recently used
+
+
+def _remember_not_found(key: _Key, error: NotFoundError) -> None:
+    if get_settings().not_found_cache_ttl <= 0:
+        return
+    with _hash_lock:
+        _not_found_cache[key] = (time(), error)
+        _not_found_cache.move_to_end(key)
+        if len(_not_found_cache) > _NOT_FOUND_MAX:
+            _not_found_cache.popitem(last=False)
 
 
-@lru_cache(maxsize=_HASH_SYNC_MAX)
 def get_function_by_hash_sync(project_uuid: str, function_hash: str) -> FunctionPublic:
-    """Synchronous, cached `retrieve_by_hash`."""
+    """Synchronous, cached `retrieve_by_hash`.
+
+    A `NotFoundError` is remembered for `LILYPAD_NOT_FOUND_CACHE_TTL` seconds,
+    during which the lookup raises again without calling the API.
+    """
+    key = (project_uuid, function_hash)
+    if (fn := _get_cached_hash(key)) is not None:
+        return fn
+
     client = get_sync_client()
-    return client.projects.functions.retrieve_by_hash(
-        project_uuid=project_uuid,
-        function_hash=function_hash,
-    )
+    try:
+        _, fn = _fetch_sync(
+            "hash",
+            key,
+            lambda: client.projects.functions.retrieve_by_hash(
+                project_uuid=project_uuid,
+                function_hash=function_hash,
+            ),
+        )
+    except NotFoundError as e:
+        _remember_not_found(key, e)
+        raise
+    if fn is not None:
+        _remember_hash(key, fn)
+    return fn  # pyright: ignore [reportReturnType]
 
 
 async def get_function_by_hash_async(project_uuid: str, function_hash: str) -> FunctionPublic:
-    """Asynchronous, cached `retrieve_by_hash`."""
+    """Asynchronous version of `get_function_by_hash_sync`."""
     key = (project_uuid, function_hash)
-    if key in _hash_async_cache:
-        return _hash_async_cache[key]
+    if (fn := _get_cached_hash(key)) is not None:
+        return fn
 
     async with _hash_async_lock:
-        if key in _hash_async_cache:  # lost race
-            return _hash_async_cache[key]
+        if (fn := _get_cached_hash(key)) is not None:  # lost race
+            return fn
 
         client = get_async_client()
-        fn = await client.projects.functions.retrieve_by_hash(
-            project_uuid=project_uuid,
-            function_hash=function_hash,
-        )
-        _hash_async_cache[key] = fn
+        try:
+            _, fn = await _fetch_async(
+                "hash",
+                key,
+                lambda: client.projects.functions.retrieve_by_hash(
+                    project_uuid=project_uuid,
+                    function_hash=function_hash,
+                ),
+            )
+        except NotFoundError as e:
+            _remember_not_found(key, e)
+            raise
+        if fn is not None:
+            _remember_hash(key, fn)
+        return fn  # pyright: ignore [reportReturnType]
+
+
+def get_function_by_closure_sync(project_uuid: str, closure: Closure) -> FunctionPublic:
+    """`get_function_by_hash_sync` for *closure*, falling back to its `legacy_hash`.
+
+    Functions registered before the closure hash was re-versioned are stored
+    under the legacy hash; finding them by it keeps their version instead of
+    creating a new one.
+    """
+    try:
+        return get_function_by_hash_sync(project_uuid, closure.hash)
+    except NotFoundError:
+        if closure.legacy_hash is None or closure.legacy_hash == closure.hash:
+            raise
+        return get_function_by_hash_sync(project_uuid, closure.legacy_hash)
+
+
+async def get_function_by_closure_async(project_uuid: str, closure: Closure) -> FunctionPublic:
+    """Asynchronous version of `get_function_by_closure_sync`."""
+    try:
+        return await get_function_by_hash_async(project_uuid, closure.hash)
+    except NotFoundError:
+        if closure.legacy_hash is None or closure.legacy_hash == closure.hash:
+            raise
+        return await get_function_by_hash_async(project_uuid, closure.legacy_hash)
+
+
+def create_function_sync(
+    project_uuid: str,
+    function_hash: str,
+    create: Callable[[], FunctionPublic | None],
+) -> FunctionPublic | None:
+    """Call *create* for *function_hash*, coalescing concurrent calls.
+
+    Threads creating the same hash at the same time wait for the first one and
+    share its result, or its exception if it fails. The created function is
+    stored in the hash cache.
+    """
+    key = (project_uuid, function_hash)
+    with _hash_lock:
+        if (fn := _hash_hit(key)) is not None:
+            return fn
+        future = _create_sync_futures.get(key)
+        if future is None:
+            future = _create_sync_futures[key] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        return future.result()
+    try:
+        fn = create()
+        if fn is not None:
+            _remember_hash(key, fn)
+        future.set_result(fn)
         return fn
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _hash_lock:
+            _create_sync_futures.pop(key, None)
+
+
+async def create_function_async(
+    project_uuid: str,
+    function_hash: str,
+    create: Callable[[], Awaitable[FunctionPublic | None]],
+) -> FunctionPublic | None:
+    """Asynchronous version of `create_function_sync`."""
+    key = (project_uuid, function_hash)
+    with _hash_lock:
+        if (fn := _hash_hit(key)) is not None:
+            return fn
+    loop = asyncio.get_running_loop()
+    task = _create_async_tasks.get(key)
+    if task is None or task.get_loop() is not loop:
+        task = loop.create_task(create())  # pyright: ignore [reportArgumentType]
+        _create_async_tasks[key] = task
+
+        def _forget(done: asyncio.Task[FunctionPublic | None]) -> None:
+            if _create_async_tasks.get(key) is done:
+                del _create_async_tasks[key]
+
+        task.add_done_callback(_forget)
+    # shield so that one cancelled caller does not cancel the create for the others
+    fn = await asyncio.shield(task)
+    if fn is not None:
+        _remember_hash(key, fn)
+    return fn
 
 
 @lru_cache(maxsize=_VERSION_SYNC_MAX)
@@ -75,11 +279,16 @@ def get_function_by_version_sync(
 ) -> FunctionPublic:
     """Synchronous, cached `retrieve_by_version`."""
     client = get_sync_client()
-    return client.projects.functions.name.retrieve_by_version(
-        project_uuid=project_uuid,
-        function_name=function_name,
-        version_num=version_num,
+    _, fn = _fetch_sync(
+        "version",
+        (project_uuid, function_name, str(version_num)),
+        lambda: client.projects.functions.name.retrieve_by_version(
+            project_uuid=project_uuid,
+            function_name=function_name,
+            version_num=version_num,
+        ),
     )
+    return fn  # pyright: ignore [reportReturnType]
 
 
 async def get_function_by_version_async(
@@ -97,12 +306,16 @@ async def get_function_by_version_async(
             return _version_async_cache[key]
 
         client = get_async_client()
-        fn = await client.projects.functions.name.retrieve_by_version(
-            project_uuid=project_uuid,
-            function_name=function_name,
-            version_num=version_num,
+        _, fn = await _fetch_async(
+            "version",
+            (project_uuid, function_name, str(version_num)),
+            lambda: client.projects.functions.name.retrieve_by_version(
+                project_uuid=project_uuid,
+                function_name=function_name,
+                version_num=version_num,
+            ),
         )
-        _version_async_cache[key] = fn
+        _version_async_cache[key] = fn  # pyright: ignore [reportArgumentType]
         return fn
 
 
@@ -110,31 +323,134 @@ def _expired(ts: float, ttl: float) -> bool:
     return 0 < ttl < time() - ts
 
 
+def _stamp(ttl: float, jitter: float) -> float:
+    """Return the timestamp to store for a fresh entry.
+
+    The timestamp is backdated by a random fraction (up to *jitter*) of *ttl* so
+    that entries fetched together do not all expire in the same instant.
+    """
+    return time() - ttl * jitter * random.random()
+
+
+def _deploy_policy(ttl: float | None, max_stale: float | None, jitter: float | None) -> tuple[float, float, float]:
+    settings = get_settings()
+    return (
+        settings.deployed_cache_ttl if ttl is None else ttl,
+        settings.deployed_cache_max_stale if max_stale is None else max_stale,
+        settings.deployed_cache_jitter if jitter is None else jitter,
+    )
+
+
+def _lookup_deployed(key: _Key, ttl: float, max_stale: float) -> tuple[FunctionPublic | None, bool]:
+    """Return the cached value for *key* and whether it needs a background refresh.
+
+    A value is returned when it is fresh, or stale by no more than *max_stale*
+    seconds past its TTL. Stale values are returned with the refresh flag set
+    only for the first caller, so concurrent callers do not stampede.
+    """
+    with _deployed_sync_lock:
+        ts, fn = _deployed_cache.get(key, (0.0, None))  # type: ignore[misc]
+        if fn is None:
+            return None, False
+        if not _expired(ts, ttl):
+            return fn, False
+        if max_stale <= 0 or _expired(ts, ttl + max_stale):
+            return None, False
+        if key in _deployed_refreshing:
+            return fn, False
+        _deployed_refreshing.add(key)
+        return fn, True
+
+
+def _store_deployed(key: _Key, fn: FunctionPublic, ttl: float, jitter: float, stored_at: float) -> None:
+    with _deployed_sync_lock:
+        _deployed_cache[key] = (min(stored_at, _stamp(ttl, jitter)), fn)
+
+
+def _fetch_deployed_sync(key: _Key, ttl: float, jitter: float, force: bool) -> FunctionPublic | None:
+    client = get_sync_client()
+    stored_at, fn = _fetch_sync(
+        "deployed",
+        key,
+        lambda: client.projects.functions.name.retrieve_deployed(
+            project_uuid=key[0],
+            function_name=key[1],
+        ),
+        max_age=ttl if ttl > 0 else None,
+        force=force,
+    )
+    if fn is not None:  # keep serving the stale value if the API call failed softly
+        _store_deployed(key, fn, ttl, jitter, stored_at)
+    return fn
+
+
+async def _fetch_deployed_async(key: _Key, ttl: float, jitter: float, force: bool) -> FunctionPublic | None:
+    client = get_async_client()
+    stored_at, fn = await _fetch_async(
+        "deployed",
+        key,
+        lambda: client.projects.functions.name.retrieve_deployed(
+            project_uuid=key[0],
+            function_name=key[1],
+        ),
+        max_age=ttl if ttl > 0 else None,
+        force=force,
+    )
+    if fn is not None:
+        _store_deployed(key, fn, ttl, jitter, stored_at)
+    return fn
+
+
+def _refresh_deployed_sync(key: _Key, ttl: float, jitter: float) -> None:
+    try:
+        _fetch_deployed_sync(key, ttl, jitter, force=False)
+    except Exception as e:
+        logger.debug("Background refresh of deployed function %s failed: %s", key, e)
+    finally:
+        with _deployed_sync_lock:
+            _deployed_refreshing.discard(key)
+
+
+async def _refresh_deployed_async(key: _Key, ttl: float, jitter: float) -> None:
+    try:
+        await _fetch_deployed_async(key, ttl, jitter, force=False)
+    except Exception as e:
+        logger.debug("Background refresh of deployed function %s failed: %s", key, e)
+    finally:
+        with _deployed_sync_lock:
+            _deployed_refreshing.discard(key)
+
+
 def get_deployed_function_sync(
     project_uuid: str,
     function_name: str,
     *,
     ttl: float | None = None,
     force_refresh: bool = False,
+    max_stale: float | None = None,
+    jitter: float | None = None,
 ) -> FunctionPublic:
-    if ttl is None:
-        ttl = _DEFAULT_DEPLOY_TTL
+    """Synchronous, cached `retrieve_deployed` with stale-while-revalidate.
+
+    Once *ttl* has passed, the cached value keeps being served for up to
+    *max_stale* more seconds while a background thread fetches a fresh one.
+    Past that, the call blocks on the API.
+    """
+    ttl, max_stale, jitter = _deploy_policy(ttl, max_stale, jitter)
     key: _Key = (project_uuid, function_name)
     if not force_refresh:
-        with _deployed_sync_lock:
-            ts, fn = _deployed_cache.get(key, (0.0, None))  # type: ignore[misc]
-            if fn is not None and not _expired(ts, ttl):
-                return fn
-
-    client = get_sync_client()
-    fn = client.projects.functions.name.retrieve_deployed(
-        project_uuid=project_uuid,
-        function_name=function_name,
-    )
+        fn, refresh = _lookup_deployed(key, ttl, max_stale)
+        if refresh:
+            ctx = copy_context()
+            threading.Thread(
+                target=lambda: ctx.run(_refresh_deployed_sync, key, ttl, jitter),
+                name="LilypadDeployedRefresh",
+                daemon=True,
+            ).start()
+        if fn is not None:
+            return fn
 
-    with _deployed_sync_lock:
-        _deployed_cache[key] = (time(), fn)
-    return fn
+    return _fetch_deployed_sync(key, ttl, jitter, force_refresh)  # pyright: ignore [reportReturnType]
 
 
 async def get_deployed_function_async(
@@ -143,29 +459,55 @@ async def get_deployed_function_async(
     *,
     ttl: float | None = None,
     force_refresh: bool = False,
+    max_stale: float | None = None,
+    jitter: float | None = None,
 ) -> FunctionPublic:
-    if ttl is None:
-        ttl = _DEFAULT_DEPLOY_TTL
+    """Asynchronous, cached `retrieve_deployed` with stale-while-revalidate.
+
+    Behaves like `get_deployed_function_sync`, refreshing stale values in a
+    background task on the running event loop.
+    """
+    ttl, max_stale, jitter = _deploy_policy(ttl, max_stale, jitter)
     key: _Key = (project_uuid, function_name)
     if not force_refresh:
-        entry = _deployed_cache.get(key)
-        if entry and not _expired(entry[0], ttl):
-            return entry[1]
+        fn, refresh = _lookup_deployed(key, ttl, max_stale)
+        if refresh:
+            task = asyncio.get_running_loop().create_task(_refresh_deployed_async(key, ttl, jitter))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        if fn is not None:
+            return fn
 
     async with _deployed_async_lock:
         # another coroutine might have filled the cache
         if not force_refresh:
-            entry = _deployed_cache.get(key)
-            if entry and not _expired(entry[0], ttl):
-                return entry[1]
+            fn, _ = _lookup_deployed(key, ttl, 0.0)
+            if fn is not None:
+                return fn
 
-        client = get_async_client()
-        fn = await client.projects.functions.name.retrieve_deployed(
-            project_uuid=project_uuid,
-            function_name=function_name,
-        )
-        _deployed_cache[key] = (time(), fn)
-        return fn
+        return await _fetch_deployed_async(key, ttl, jitter, force_refresh)  # pyright: ignore [reportReturnType]
+
+
+def invalidate_deployed_function(project_uuid: str, function_name: str | None = None) -> int:
+    """Evict cached deployments of *function_name*, or of every function in the project.
+
+    Returns:
+        The number of evicted entries.
+    """
+    with _deployed_sync_lock:
+        keys = [
+            key
+            for key in _deployed_cache
+            if key[0] == project_uuid and (function_name is None or key[1] == function_name)
+        ]
+        for key in keys:
+            del _deployed_cache[key]
+    if (disk := get_disk_cache()) is not None:
+        if function_name is None:
+            disk.delete("deployed", (project_uuid,), prefix=True)
+        else:
+            disk.delete("deployed", (project_uuid, function_name))
+    return len(keys)
 
 
 _T = TypeVar("_T")
@@ -196,27 +538,85 @@ _MAX_ENTRIES: Final[int] = 256
 _CLOSURE_CACHE: Final[_LRU[Closure]] = _LRU(_MAX_ENTRIES)
 
 
+_pinned_closures: dict[str, Closure] = {}  # function uuid -> closure, never evicted
+_pinned_uuids: dict[tuple[str, ...], str] = {}  # (project_uuid, function_name[, environment]) -> pinned uuid
+
+
+def _build_closure(function: FunctionPublic) -> Closure:
+    return Closure(
+        name=function.name,
+        code=function.code,
+        signature=function.signature,
+        hash=function.hash,
+        dependencies={k: v.model_dump(mode="python") for k, v in (function.dependencies or {}).items()},
+    )
+
+
 def get_cached_closure(function: FunctionPublic) -> Closure:
     """Return a `Closure` for *function*, caching by its UUID."""
     key = str(function.uuid)
+    if (closure := _pinned_closures.get(key)) is not None:
+        return closure
+    return _CLOSURE_CACHE.get_or_create(key, lambda: _build_closure(function))
 
-    def _build() -> Closure:
-        return Closure(
-            name=function.name,
-            code=function.code,
-            signature=function.signature,
-            hash=function.hash,
-            dependencies={k: v.model_dump(mode="python") for k, v in (function.dependencies or {}).items()},
-        )
 
-    return _CLOSURE_CACHE.get_or_create(key, _build)
+def prime_deployed_functions(
+    project_uuid: str,
+    functions: Iterable[FunctionPublic],
+    *,
+    stored_at: float | None = None,
+    environment: str | None = None,
+) -> int:
+    """Store *functions* as the deployed versions of their names.
+
+    Their closures are pinned so they are never evicted from the closure cache;
+    pinning a new version of a name releases the previous one.
+
+    Args:
+        project_uuid: The project the functions belong to.
+        functions: The deployed functions.
+        stored_at: When the functions were fetched. Defaults to now; older
+            values are treated like any other aging cache entry.
+        environment: The environment the functions are deployed to, or `None`
+            for the default environment, whose deployments `.remote()` runs.
+            Functions of any other environment only have their closures pinned
+            and are never served as the deployed version by `.remote()`.
+
+    Returns:
+        The number of primed functions.
+    """
+    ttl, _, jitter = _deploy_policy(None, None, None)
+    disk = get_disk_cache() if stored_at is None and environment is None else None
+    count = 0
+    for fn in functions:
+        key: _Key = (project_uuid, fn.name)
+        if environment is None:
+            _store_deployed(key, fn, ttl, jitter, time() if stored_at is None else stored_at)
+            if disk is not None:
+                disk.set("deployed", key, fn)
+        pin_key = key if environment is None else (*key, environment)
+        closure = _build_closure(fn)
+        with _CLOSURE_CACHE._lock:
+            previous = _pinned_uuids.get(pin_key)
+            _pinned_uuids[pin_key] = fn.uuid
+            if previous is not None and previous not in _pinned_uuids.values():
+                _pinned_closures.pop(previous, None)
+            _pinned_closures[fn.uuid] = closure
+        count += 1
+    return count
 
 
 __all__ = [
+    "create_function_sync",
+    "create_function_async",
     "get_function_by_hash_sync",
     "get_function_by_hash_async",
+    "get_function_by_closure_sync",
+    "get_function_by_closure_async",
     "get_deployed_function_sync",
     "get_deployed_function_async",
     "get_function_by_version_sync",
     "get_function_by_version_async",
+    "invalidate_deployed_function",
+    "prime_deployed_functions",
 ]
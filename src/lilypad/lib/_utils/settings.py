@@ -19,6 +19,26 @@ class Settings(BaseSettings):
     remote_client_url: str = Field(default=REMOTE_CLIENT_URL)
     api_key: str | None = None
     project_id: str | None = None
+    deployed_cache_ttl: float = 30.0
+    """Seconds a deployed function is considered fresh."""
+    deployed_cache_max_stale: float = 300.0
+    """Seconds past its TTL that a deployed function may be served while it is refreshed."""
+    deployed_cache_jitter: float = 0.1
+    """Fraction of the TTL used to randomly spread expiry of deployed function entries."""
+    not_found_cache_ttl: float = 5.0
+    """Seconds a function hash that was not found is remembered before it is looked up again."""
+    function_cache_path: str | None = None
+    """Path of an SQLite file used to share function metadata between processes on a host."""
+    webhook_secret: str | None = None
+    """Shared secret used to verify deployment webhooks."""
+    sandbox_max_concurrency: int | None = None
+    """Sandbox executions allowed to run at once; unlimited by default."""
+    sandbox_max_concurrency_per_function: int | None = None
+    """Sandbox executions of a single function allowed to run at once; unlimited by default."""
+    closure_cache_size: int | None = 1024
+    """Closures kept in memory by `Closure.from_fn`; `None` keeps every closure."""
+    closure_manifest_path: str | None = None
+    """Path of a manifest written by `lilypad build` to read closures from instead of computing them."""
 
     def update(self, **kwargs: Any) -> None:  # noqa: D401
         """Update non-None fields in place."""
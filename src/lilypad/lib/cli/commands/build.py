@@ -0,0 +1,82 @@
+"""Build command for precomputing the closures of functions decorated with lilypad.lib.traces."""
+
+import os
+import sys
+import json
+import importlib
+from pathlib import Path
+
+import typer
+from rich import print
+
+from .sync import (
+    DEFAULT_EXCLUDE,
+    DEFAULT_VERBOSE,
+    DEFAULT_DIRECTORY,
+    _find_python_files,
+    _import_module_safely,
+    _module_path_from_file,
+)
+from ...traces import (
+    TRACE_MODULE_NAME,
+    clear_registry,
+    enable_recording,
+    disable_recording,
+    get_decorated_functions,
+)
+from ..._utils.closure import build_closure_manifest
+
+DEFAULT_OUTPUT: Path = typer.Option(
+    Path("lilypad-closures.json"), "--output", "-o", help="Path of the closure manifest to write."
+)
+DEFAULT_WORKERS: int = typer.Option(
+    0, "--workers", "-w", help="Processes used to compute closures; 0 uses one per CPU."
+)
+
+
+def build_command(
+    directory: Path = DEFAULT_DIRECTORY,
+    exclude: list[str] | None = DEFAULT_EXCLUDE,
+    output: Path = DEFAULT_OUTPUT,
+    verbose: bool = DEFAULT_VERBOSE,
+    workers: int = DEFAULT_WORKERS,
+) -> None:
+    """Write a manifest with the closures of functions decorated with lilypad.lib.traces.
+
+    Point the `LILYPAD_CLOSURE_MANIFEST_PATH` setting at the manifest to read
+    closures from it at runtime instead of computing them.
+    """
+    exclude_dirs: set[str] = {"venv", ".venv", "env", ".git", ".github", "__pycache__", "build", "dist"}
+    for item in exclude if isinstance(exclude, list) else []:
+        exclude_dirs.update(dir_name.strip() for dir_name in item.split(","))
+    directory_abs = str(directory.absolute())
+    python_files = _find_python_files(directory_abs, exclude_dirs)
+    if not python_files:
+        print(f"No Python files found in {directory_abs}")
+        raise typer.Exit(1)
+
+    parent_dir = os.path.dirname(directory_abs)
+    sys.path.insert(0, parent_dir)
+    enable_recording()
+    try:
+        for file_path in python_files:
+            _import_module_safely(_module_path_from_file(file_path, parent_dir))
+        functions = get_decorated_functions(TRACE_MODULE_NAME)[TRACE_MODULE_NAME]
+        fns = []
+        for _file_path, function_name, _lineno, module_name, _context in functions:
+            try:
+                fns.append(getattr(importlib.import_module(module_name), function_name))
+            except Exception as e:
+                print(f"[red]Error retrieving function {function_name} from {module_name}: {e}[/red]")
+        manifest = build_closure_manifest(fns, workers=workers if isinstance(workers, int) and workers > 0 else None)
+    finally:
+        disable_recording()
+        clear_registry()
+        sys.path.pop(0)
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    if verbose:
+        for key, entry in manifest["closures"].items():
+            print(f"[blue]{key}[/blue] [dim]{entry['closure']['hash']}[/dim]")
+    print(f"Wrote [bold green]{len(manifest['closures'])}[/bold green] closure(s) to [bold]{output}[/bold]")
@@ -4,11 +4,13 @@ import os
 import ast
 import sys
 import json
+import math
 import inspect
 import importlib
-from typing import Any, TypeAlias
+from typing import Any, TypeAlias, NamedTuple
 from pathlib import Path
 from textwrap import dedent
+from concurrent.futures import ProcessPoolExecutor
 
 import typer
 from rich import print
@@ -27,7 +29,7 @@ from ...traces import (
     disable_recording,
     get_decorated_functions,
 )
-from ..._utils.closure import Closure, _run_ruff
+from ..._utils.closure import _run_ruff, get_qualified_name
 
 app = typer.Typer()
 console = Console()
@@ -35,13 +37,19 @@ DEBUG: bool = False
 
 FilePath: TypeAlias = str
 ModulePath: TypeAlias = str
-FunctionInfo: TypeAlias = tuple[str, str, int, str]
+FunctionInfo: TypeAlias = tuple[str, str, int, str, dict[str, Any]]
 
 DEFAULT_DIRECTORY: Path = typer.Argument(Path("."), help="Directory to scan for decorated functions.")
 DEFAULT_EXCLUDE: list[str] | None = typer.Option(
     None, "--exclude", "-e", help="Comma-separated list of directories to exclude."
 )
 DEFAULT_VERBOSE: bool = typer.Option(False, "--verbose", "-v", help="Show verbose output.")
+DEFAULT_STATIC: bool = typer.Option(
+    False,
+    "--static",
+    help="Find decorated functions by parsing files instead of importing them; "
+    "only files that cannot be resolved statically are imported.",
+)
 
 
 def _find_python_files(directory: str, exclude_dirs: set[str] | None = None) -> list[FilePath]:
@@ -81,6 +89,123 @@ def _import_module_safely(module_path: ModulePath) -> bool:
         return False
 
 
+_TRACE_PATHS = {"lilypad.trace", "lilypad.lib.trace", f"{TRACE_MODULE_NAME}.trace"}
+_STATIC_SCAN_CHUNK_SIZE = 32
+
+
+class _StaticScan(NamedTuple):
+    """The decorated functions found in a file without importing it."""
+
+    functions: list[tuple[str, int, bool, dict[str, Any]]]
+    """The name, line number, whether it is async and the decorator context of each function."""
+    ambiguous: bool
+    """Whether the file uses the decorator in a way that requires importing it to resolve."""
+
+
+def _import_aliases(tree: ast.Module) -> dict[str, str]:
+    """Returns the dotted path each name bound by a top-level import refers to."""
+    aliases: dict[str, str] = {}
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    aliases[alias.asname] = alias.name
+                else:
+                    name = alias.name.split(".", 1)[0]
+                    aliases[name] = name
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            for alias in node.names:
+                aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+    return aliases
+
+
+def _dotted_path(node: ast.expr, aliases: dict[str, str]) -> str | None:
+    """Returns the dotted path a name or attribute access refers to, if it starts with an imported name."""
+    attrs: list[str] = []
+    while isinstance(node, ast.Attribute):
+        attrs.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name) or node.id not in aliases:
+        return None
+    return ".".join([aliases[node.id], *reversed(attrs)])
+
+
+def _literal_argument(call: ast.Call, name: str) -> tuple[bool, Any]:
+    """Returns whether the keyword argument `name` of `call` is a literal, and its value."""
+    for keyword in call.keywords:
+        if keyword.arg == name:
+            try:
+                return True, ast.literal_eval(keyword.value)
+            except ValueError:
+                return False, None
+    return True, None
+
+
+def _scan_file(file_path: FilePath) -> _StaticScan:
+    """Finds the functions decorated with `trace(versioning="automatic")` in a file by parsing it.
+
+    Only decorators of top-level functions with literal arguments are resolved;
+    any other reference to `trace`, a `**kwargs` argument, a star import from
+    `lilypad`, or a decorator with a `versioning` argument that does not refer
+    to `trace` marks the file as ambiguous.
+    """
+    try:
+        source = Path(file_path).read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        return _StaticScan([], True)
+    if "trace" not in source and "versioning" not in source:
+        return _StaticScan([], False)
+    try:
+        tree = ast.parse(source, filename=file_path)
+    except SyntaxError:
+        return _StaticScan([], False)  # importing it fails too
+    aliases = _import_aliases(tree)
+    ambiguous = any(
+        isinstance(node, ast.ImportFrom)
+        and (node.module or "").split(".", 1)[0] == "lilypad"
+        and any(alias.name == "*" for alias in node.names)
+        for node in tree.body
+    )
+    functions: list[tuple[str, int, bool, dict[str, Any]]] = []
+    resolved: set[int] = set()
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            if not (isinstance(decorator, ast.Call) and _dotted_path(decorator.func, aliases) in _TRACE_PATHS):
+                continue
+            resolved.add(id(decorator.func))
+            arguments = {name: _literal_argument(decorator, name) for name in ("versioning", "mode", "tags")}
+            if any(keyword.arg is None for keyword in decorator.keywords) or not all(
+                is_literal for is_literal, _ in arguments.values()
+            ):
+                ambiguous = True
+            elif arguments["versioning"][1] == "automatic":
+                tags = arguments["tags"][1]
+                context = {"mode": arguments["mode"][1], "tags": sorted(set(tags)) if tags else None}
+                functions.append((node.name, node.lineno, isinstance(node, ast.AsyncFunctionDef), context))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name | ast.Attribute) and id(node) not in resolved:
+            if _dotted_path(node, aliases) in _TRACE_PATHS:
+                ambiguous = True
+        elif isinstance(node, ast.Call) and id(node.func) not in resolved:
+            if (
+                any(keyword.arg == "versioning" for keyword in node.keywords)
+                and _dotted_path(node.func, aliases) not in _TRACE_PATHS
+            ):
+                ambiguous = True
+    return _StaticScan(functions, ambiguous)
+
+
+def _scan_files(python_files: list[FilePath]) -> list[_StaticScan]:
+    """Scans files with `_scan_file`, in a process pool when there are many of them."""
+    workers = min(os.cpu_count() or 1, math.ceil(len(python_files) / _STATIC_SCAN_CHUNK_SIZE))
+    if workers <= 1:
+        return [_scan_file(file_path) for file_path in python_files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_scan_file, python_files, chunksize=_STATIC_SCAN_CHUNK_SIZE))
+
+
 def _normalize_signature(signature_text: str) -> str:
     # Return only the function definition line (ignoring import lines and decorators)
     lines = signature_text.splitlines()
@@ -367,8 +492,15 @@ def sync_command(
     exclude: list[str] | None = DEFAULT_EXCLUDE,
     verbose: bool = DEFAULT_VERBOSE,
     debug: bool = False,
+    static: bool = DEFAULT_STATIC,
 ) -> None:
-    """Generate type stubs for functions decorated with lilypad.lib.generation."""
+    """Generate type stubs for functions decorated with lilypad.lib.generation.
+
+    By default every Python file under *directory* is imported so that the
+    decorators register their functions. With `--static`, the files are parsed
+    in parallel instead, and only those that use the decorator in a way that
+    cannot be resolved without running them are imported.
+    """
     global DEBUG
     DEBUG = debug
     if not isinstance(exclude, list):
@@ -394,21 +526,34 @@ def sync_command(
             return
         directory_abs: str = os.path.abspath(dir_str)
         parent_dir: str = os.path.dirname(directory_abs)
-        sys.path.insert(0, parent_dir)
-        enable_recording()
-        try:
-            for file_path in python_files:
-                module_path: ModulePath = _module_path_from_file(file_path, parent_dir)
-                _import_module_safely(module_path)
-            results = get_decorated_functions(TRACE_MODULE_NAME)
-        finally:
-            disable_recording()
-            clear_registry()
-            sys.path.pop(0)
+        functions: list[FunctionInfo] = []
+        if static:
+            scans = _scan_files(python_files)
+            for file_path, scan in zip(python_files, scans, strict=False):
+                module_name = _module_path_from_file(file_path, parent_dir).removesuffix(".__init__")
+                for function_name, lineno, is_async, context in scan.functions:
+                    functions.append((file_path, function_name, lineno, module_name, {**context, "is_async": is_async}))
+            import_files = [file_path for file_path, scan in zip(python_files, scans, strict=False) if scan.ambiguous]
+        else:
+            import_files = python_files
+        if import_files:
+            sys.path.insert(0, parent_dir)
+            enable_recording()
+            try:
+                for file_path in import_files:
+                    module_path: ModulePath = _module_path_from_file(file_path, parent_dir)
+                    _import_module_safely(module_path)
+                # with --static, functions in the other files were already found by parsing them
+                imported = set(import_files)
+                registered = get_decorated_functions(TRACE_MODULE_NAME).get(TRACE_MODULE_NAME, [])
+                functions += [info for info in registered if not static or info[0] in imported]
+            finally:
+                disable_recording()
+                clear_registry()
+                sys.path.pop(0)
     settings = get_settings()
     client = get_sync_client(api_key=settings.api_key)
     decorator_name = TRACE_MODULE_NAME
-    functions = results.get(decorator_name, [])
     if not functions:
         print(f"No functions found with decorator [bold]{decorator_name}[/bold]")
         return
@@ -422,18 +567,20 @@ def sync_command(
     has_async_trace = False
     has_sync_trace = False
     for file_path, function_name, _lineno, module_name, context in sorted(functions, key=lambda x: x[0]):
-        try:
-            mod = importlib.import_module(module_name)
-            fn = getattr(mod, function_name)
-            is_async = inspect.iscoroutinefunction(fn)
-        except Exception as e:
-            print(f"[red]Error retrieving function {function_name} from {module_name}: {e}[/red]")
-            continue
-        closure = Closure.from_fn(fn)
+        if context is not None and "is_async" in context:
+            qualified_name, is_async = function_name, context["is_async"]
+        else:
+            try:
+                mod = importlib.import_module(module_name)
+                fn = getattr(mod, function_name)
+                qualified_name, is_async = get_qualified_name(fn), inspect.iscoroutinefunction(fn)
+            except Exception as e:
+                print(f"[red]Error retrieving function {function_name} from {module_name}: {e}[/red]")
+                continue
         try:
             with console.status(f"Fetching versions for [bold]{function_name}[/bold]..."):
                 raw_response = client.projects.functions.name.retrieve_by_name(
-                    function_name=closure.name, project_uuid=settings.project_id
+                    function_name=qualified_name, project_uuid=settings.project_id
                 )
                 versions = NameRetrieveByNameAdapter.validate_python(raw_response)
             if not versions:
@@ -7,6 +7,7 @@ from typer import Typer
 
 from .commands import local_command
 from .commands.sync import sync_command
+from .commands.build import build_command
 
 app = Typer()
 
@@ -18,3 +19,7 @@ app.command(
     "sync",
     help="Scan the specified module directory and generate stub files for version assignments.",
 )(sync_command)
+app.command(
+    "build",
+    help="Scan the specified module directory and write a manifest of precomputed function closures.",
+)(build_command)
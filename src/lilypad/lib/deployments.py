@@ -0,0 +1,338 @@
+"""Utilities for keeping deployed function caches in sync with the Lilypad API."""
+
+from __future__ import annotations
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
+from typing import Any
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections.abc import Mapping
+
+import orjson
+from pydantic import BaseModel, ValidationError
+
+from .exceptions import LilypadValueError
+from ._utils.client import get_sync_client
+from ..types.projects import DeploymentPublic
+from ._utils.settings import get_settings
+from .sandbox.environments import EnvironmentCache
+from ._utils.function_cache import get_cached_closure, prime_deployed_functions, invalidate_deployed_function
+from ..types.projects.functions import FunctionPublic
+from ..types.webhook_handle_response import WebhookHandleResponse
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "Lilypad-Signature"
+DEPLOYMENT_EVENTS = frozenset({"deployment.created", "deployment.activated", "deployment.deactivated"})
+
+
+class DeploymentSnapshot(BaseModel):
+    """The deployed functions of an environment, as saved by `preload_deployments`."""
+
+    project_uuid: str
+    environment: str | None
+    is_default: bool
+    """Whether the environment is the default one, whose deployments `.remote()` runs."""
+    saved_at: float
+    functions: list[FunctionPublic]
+
+
+class DeploymentEvent(BaseModel):
+    """A deployment change notification."""
+
+    event: str
+    data: DeploymentPublic
+
+
+def _sign(payload: bytes, secret: str) -> str:
+    return "sha256=" + hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()
+
+
+def verify_signature(payload: bytes, signature: str | None, secret: str) -> bool:
+    """Return whether *signature* is the HMAC-SHA256 of *payload* under *secret*."""
+    if not signature:
+        return False
+    return hmac.compare_digest(_sign(payload, secret), signature)
+
+
+def handle_deployment_event(
+    payload: bytes | str | Mapping[str, Any],
+    *,
+    signature: str | None = None,
+    secret: str | None = None,
+) -> WebhookHandleResponse:
+    """Evict the deployed function cache entries affected by a deployment event.
+
+    Args:
+        payload: The raw request body (or an already decoded mapping).
+        signature: The value of the `Lilypad-Signature` header.
+        secret: The shared webhook secret. Defaults to `LILYPAD_WEBHOOK_SECRET`.
+            When a secret is configured, unsigned or mis-signed raw payloads
+            are rejected.
+
+    Returns:
+        A `WebhookHandleResponse` describing whether the event was applied.
+    """
+    secret = secret if secret is not None else get_settings().webhook_secret
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if secret and (not isinstance(payload, bytes) or not verify_signature(payload, signature, secret)):
+        raise LilypadValueError("Invalid webhook signature")
+
+    try:
+        event = (
+            DeploymentEvent.model_validate_json(payload)
+            if isinstance(payload, bytes)
+            else DeploymentEvent.model_validate(payload)
+        )
+    except ValidationError as e:
+        return WebhookHandleResponse(status="error", message=str(e))
+
+    if event.event not in DEPLOYMENT_EVENTS:
+        return WebhookHandleResponse(status="ignored", event=event.event)
+
+    deployment = event.data
+    project_uuid = deployment.project_uuid or (deployment.function.project_uuid if deployment.function else None)
+    if project_uuid is None:
+        return WebhookHandleResponse(status="error", event=event.event, message="Missing project_uuid")
+    function_name = deployment.function.name if deployment.function else None
+    # Without a function name we cannot tell which entries changed, so drop the whole project.
+    evicted = invalidate_deployed_function(project_uuid, function_name)
+    logger.debug("Evicted %d deployed function(s) for %s/%s", evicted, project_uuid, function_name or "*")
+    return WebhookHandleResponse(status="success", event=event.event)
+
+
+class _DeploymentWebhookHandler(BaseHTTPRequestHandler):
+    server: DeploymentWebhookServer
+
+    def do_POST(self) -> None:
+        if self.path.split("?", 1)[0] != self.server.path:
+            self._respond(404, WebhookHandleResponse(status="error", message="Not found"))
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            response = handle_deployment_event(
+                body, signature=self.headers.get(SIGNATURE_HEADER), secret=self.server.secret or ""
+            )
+        except LilypadValueError as e:
+            self._respond(401, WebhookHandleResponse(status="error", message=str(e)))
+            return
+        self._respond(400 if response.status == "error" else 200, response)
+
+    def _respond(self, status: int, response: WebhookHandleResponse) -> None:
+        body = orjson.dumps(response.model_dump(exclude_none=True))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+class DeploymentWebhookServer(ThreadingHTTPServer):
+    """A small HTTP server that receives deployment webhooks in a background thread.
+
+    Requests must be signed with *secret*; a server without a secret, which
+    lets anyone who can reach it evict deployed functions, is only created
+    with `allow_unsigned=True`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, path: str, secret: str | None, *, allow_unsigned: bool = False) -> None:
+        if not secret and not allow_unsigned:
+            raise LilypadValueError(
+                "A webhook secret is required; set LILYPAD_WEBHOOK_SECRET or pass allow_unsigned=True"
+            )
+        super().__init__((host, port), _DeploymentWebhookHandler)
+        self.path = path
+        self.secret = secret
+        self._thread = threading.Thread(target=self.serve_forever, name="LilypadDeploymentWebhooks", daemon=True)
+
+    @property
+    def url(self) -> str:
+        """The URL to register as the webhook endpoint."""
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}{self.path}"
+
+    def start(self) -> DeploymentWebhookServer:
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Stop serving and release the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> DeploymentWebhookServer:
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+
+def start_deployment_webhook_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    *,
+    path: str = "/webhooks/deployments",
+    secret: str | None = None,
+    allow_unsigned: bool = False,
+) -> DeploymentWebhookServer:
+    """Start a background webhook receiver that evicts deployed function caches.
+
+    With push invalidation in place the deployed function TTL
+    (`LILYPAD_DEPLOYED_CACHE_TTL`) can be raised substantially, since deploys are
+    picked up as soon as the webhook arrives.
+
+    Args:
+        host: The interface to bind.
+        port: The port to bind. `0` picks a free port; see `DeploymentWebhookServer.url`.
+        path: The request path webhooks are posted to.
+        secret: The shared secret used to verify the `Lilypad-Signature` header.
+            Defaults to `LILYPAD_WEBHOOK_SECRET`.
+        allow_unsigned: Accept unsigned requests when no secret is configured.
+            Only use this when the port is unreachable from untrusted networks.
+
+    Returns:
+        The running server. Call `close()` to stop it.
+
+    Raises:
+        LilypadValueError: If no secret is configured and `allow_unsigned` is not set.
+    """
+    secret = secret if secret is not None else get_settings().webhook_secret
+    return DeploymentWebhookServer(host, port, path, secret, allow_unsigned=allow_unsigned).start()
+
+
+def _load_snapshot(path: Path, project_uuid: str, environment: str | None) -> list[FunctionPublic]:
+    try:
+        snapshot = DeploymentSnapshot.model_validate_json(path.read_bytes())
+    except (OSError, ValidationError) as e:
+        logger.debug("Ignoring deployment snapshot %s: %s", path, e)
+        return []
+    if snapshot.project_uuid != project_uuid or snapshot.environment != environment:
+        return []
+    prime_deployed_functions(
+        project_uuid,
+        snapshot.functions,
+        stored_at=snapshot.saved_at,
+        environment=None if snapshot.is_default else snapshot.environment,
+    )
+    return snapshot.functions
+
+
+def _save_snapshot(path: Path, snapshot: DeploymentSnapshot) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(snapshot.model_dump_json().encode())
+    os.replace(tmp, path)  # atomic, so concurrent boots never read a partial file
+
+
+def _activated_at(deployment: DeploymentPublic) -> float:
+    return deployment.activated_at.timestamp() if deployment.activated_at else 0.0
+
+
+def _fetch_deployed_functions(project_uuid: str, environment: str | None) -> tuple[bool, list[FunctionPublic]] | None:
+    """Fetch the active deployments of *environment*, or `None` if the API call failed softly.
+
+    Returns:
+        Whether the environment is the default one, and its deployed functions.
+    """
+    client = get_sync_client(api_key=get_settings().api_key)
+    environments = client.environments.list()
+    if environments is None:
+        return None
+    env = next((e for e in environments if (e.name == environment if environment else e.is_default)), None)
+    if env is None:
+        raise LilypadValueError(
+            f"Environment {environment!r} not found" if environment else "No default environment found"
+        )
+    history = client.projects.environments.get_deployment_history(env.uuid, project_uuid=project_uuid)
+    if history is None:
+        return None
+    # keep the most recently activated deployment of each function name
+    latest: dict[str, DeploymentPublic] = {}
+    for deployment in history:
+        if not deployment.is_active or deployment.function is None:
+            continue
+        current = latest.get(deployment.function.name)
+        if current is None or _activated_at(deployment) > _activated_at(current):
+            latest[deployment.function.name] = deployment
+    return bool(env.is_default), [deployment.function for deployment in latest.values()]  # pyright: ignore [reportReturnType]
+
+
+def preload_deployments(
+    environment: str | None = None,
+    *,
+    snapshot_path: str | os.PathLike[str] | None = None,
+    environments: EnvironmentCache | None = None,
+) -> list[FunctionPublic]:
+    """Fetch every deployed function of an environment and prime the caches with them.
+
+    Without preloading, each function's first `.remote()` call pays its own
+    `retrieve_deployed` round-trip and closure build. Preloading does this for
+    the whole environment at startup and pins the closures so they are never
+    evicted.
+
+    `.remote()` always runs the deployments of the default environment, so
+    the functions of any other environment are not served by it; only their
+    closures (and sandbox environments) are prepared.
+
+    Args:
+        environment: The environment name. Defaults to the default environment.
+        snapshot_path: An optional file to persist the snapshot to. If it exists
+            on the next boot, its functions are loaded before the API is
+            called, and they are used on their own if the API is unreachable.
+        environments: An optional sandbox environment cache in which to build
+            the environments of the deployed functions, so that their first
+            `.remote()` call does not resolve dependencies.
+
+    Returns:
+        The deployed functions.
+    """
+    settings = get_settings()
+    project_uuid = settings.project_id
+    if not project_uuid:
+        raise LilypadValueError("A project ID is required to preload deployments")
+
+    path = Path(snapshot_path).expanduser() if snapshot_path is not None else None
+    cached = _load_snapshot(path, project_uuid, environment) if path is not None and path.exists() else []
+
+    fetched = _fetch_deployed_functions(project_uuid, environment)
+    if fetched is None:
+        logger.warning("Could not fetch deployments; using %d function(s) from the snapshot", len(cached))
+        functions = cached
+    else:
+        is_default, functions = fetched
+        prime_deployed_functions(project_uuid, functions, environment=None if is_default else environment)
+        if path is not None:
+            snapshot = DeploymentSnapshot(
+                project_uuid=project_uuid,
+                environment=environment,
+                is_default=is_default,
+                saved_at=time.time(),
+                functions=functions,
+            )
+            _save_snapshot(path, snapshot)
+
+    if environments is not None:
+        environments.prepare(get_cached_closure(fn) for fn in functions)
+    return functions
+
+
+__all__ = [
+    "DeploymentEvent",
+    "DeploymentSnapshot",
+    "DeploymentWebhookServer",
+    "handle_deployment_event",
+    "preload_deployments",
+    "start_deployment_webhook_server",
+    "verify_signature",
+]
@@ -2,16 +2,28 @@
 
 from contextlib import suppress
 
-from .runner import SandboxRunner
+from .pool import PooledSandboxRunner
+from .runner import SandboxRunner, AsyncSandboxRunner
+from .scheduler import SchedulerStats, SandboxScheduler, get_scheduler, set_scheduler
+from .forkserver import ForkServerSandboxRunner
 from .subprocess import SubprocessSandboxRunner
+from .environments import EnvironmentCache
 
 with suppress(ImportError):
     from .docker import DockerSandboxRunner as DockerSandboxRunner
 
 
 __all__ = [
+    "AsyncSandboxRunner",
     "DockerSandboxRunner",
+    "EnvironmentCache",
+    "ForkServerSandboxRunner",
+    "PooledSandboxRunner",
+    "SandboxScheduler",
+    "SchedulerStats",
     "SubprocessSandboxRunner",
     "SandboxRunner",
     "DockerSandboxRunner",
+    "get_scheduler",
+    "set_scheduler",
 ]
@@ -1,85 +1,440 @@
 """Docker sandbox runner."""
 
 import io
+import shlex
+import struct
 import tarfile
+import threading
 from typing import Any, cast
+from functools import lru_cache  # noqa: TID251
 from contextlib import suppress
+from collections import deque
+from collections.abc import Iterable, Iterator
 
 import docker
+import orjson
+from docker.errors import DockerException
+from docker.utils.socket import STDERR, frames_iter
+from docker.models.containers import Container
 
 from . import SandboxRunner
-from .runner import Result
+from .runner import RUNTIME_SOURCE, Result
 from .._utils import Closure
+from .forkserver import _imports
+from .environments import dependency_key
 
 _DEFAULT_IMAGE = "ghcr.io/astral-sh/uv:python3.10-alpine"
+_ENV_DIR = "/opt/lilypad-env"
+_WORK_DIR = "/lilypad"
+
+_HEADER = struct.Struct(">BI")  # status, payload length
+
+_REQUEST = struct.Struct(">II")  # request header length, pickled arguments length
+
+# The resident interpreter of a pooled container. It forks each call into a fresh working directory,
+# removed once the call has replied, so calls share neither memory nor files.
+_SERVER_SOURCE = """
+import atexit
+import shutil
+import tempfile
+import importlib
+
+_HEADER = struct.Struct(">BI")
+_REQUEST = struct.Struct(">II")
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def _preload(names):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception:  # reported by the call whose program imports it
+            pass
+
+
+def _run(request, arguments):
+    module = _load_program(request["program"])
+    if not request["batch"]:
+        return _call(module, arguments)
+    payload = _load_arguments(module, arguments)
+    lines = []
+    _call_batch(module, payload["calls"], payload["concurrency"], lines.append)
+    return [b"\\n".join(lines)]
+
+
+def _child(directory, request, arguments, writer):
+    os.chdir(directory)
+    os.environ["TMPDIR"] = tempfile.tempdir = directory
+    try:
+        status, parts = 0, _run(request, arguments)
+    except (Exception, SystemExit) as e:
+        status, parts = 1, _body(_error(e))
+    with os.fdopen(writer, "wb") as pipe:
+        pipe.writelines([bytes([status]), *parts])
+    atexit._run_exitfuncs()  # e.g. flush the spans exported by the call
+
+
+def _serve(work_dir):
+    requests = sys.stdin.buffer
+    replies = _take_stdout()
+    replies.write(_HEADER.pack(0, 0))
+    replies.flush()
+    while True:
+        try:
+            request_length, arguments_length = _REQUEST.unpack(_read(requests, _REQUEST.size))
+            request = json.loads(_read(requests, request_length))
+            arguments = _read(requests, arguments_length)
+        except EOFError:
+            return
+        _preload(request["imports"])
+        directory = tempfile.mkdtemp(dir=work_dir)
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            try:
+                _child(directory, request, arguments, writer)
+            finally:
+                os._exit(0)
+        os.close(writer)
+        with os.fdopen(reader, "rb") as pipe:
+            reply = pipe.read()
+        code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        shutil.rmtree(directory, ignore_errors=True)
+        if not reply:
+            message = f"Sandbox call exited with status {code}"
+            error = {"error_type": "RuntimeError", "error_message": message, "traceback": ""}
+            reply = b"\\x01" + b"".join(_body(error))
+        replies.writelines([_HEADER.pack(reply[0], len(reply) - 1), memoryview(reply)[1:]])
+        replies.flush()
+
+
+if __name__ == "__main__":
+    _serve(sys.argv[1])
+"""
+
+
+@lru_cache(maxsize=1)
+def _docker_client() -> docker.DockerClient:
+    """Return a Docker client shared by every runner, so its connection pool is reused."""
+    return docker.from_env()
+
+
+class _PooledContainer:
+    """A warm container and the attached socket of its resident interpreter."""
+
+    def __init__(self, container: Container, socket: Any) -> None:
+        self.container = container
+        self.calls = 0
+        self.broken = False
+        self._socket = socket
+        self._frames = frames_iter(socket, tty=False)
+        self._stdout = bytearray()
+        self._stderr: deque[bytes] = deque(maxlen=256)
+
+    def _read(self, size: int) -> bytes:
+        while len(self._stdout) < size:
+            frame = next(self._frames, None)
+            if frame is None:
+                raise RuntimeError(
+                    f"Sandbox process exited before replying.\nStderr: {self.stderr().decode(errors='replace')}"
+                )
+            stream, data = frame
+            if stream == STDERR:
+                self._stderr.append(data)
+            else:
+                self._stdout += data
+        data = bytes(self._stdout[:size])
+        del self._stdout[:size]
+        return data
+
+    def stderr(self) -> bytes:
+        return b"".join(self._stderr)
+
+    def wait_ready(self) -> None:
+        self._read(_HEADER.size)
+
+    def call(self, request: bytes) -> tuple[int, bytes]:
+        self._stderr.clear()
+        getattr(self._socket, "_sock", self._socket).sendall(request)
+        status, length = _HEADER.unpack(self._read(_HEADER.size))
+        return status, self._read(length)
 
 
 class DockerSandboxRunner(SandboxRunner):
-    """Runs code in a Docker container."""
+    """Runs code in a Docker container.
+
+    With `cache_environments`, the closure's dependencies are installed once
+    into a named volume per dependency set (see `dependency_key`) that later
+    containers mount, instead of being resolved by `uv run` in every container.
+
+    With `pool_size`, up to that many containers per dependency set are kept
+    running between calls. Each runs a resident interpreter with the
+    dependencies loaded, which forks every call into a fresh working directory
+    that is removed afterwards, so calls share neither memory nor files and do
+    not pay for an interpreter start. Containers are replaced after
+    `max_calls` calls. Call `close()` to stop them.
+    """
 
     def __init__(
         self,
         image: str = _DEFAULT_IMAGE,
         environment: dict[str, str] | None = None,
+        *,
+        cache_environments: bool = False,
+        pool_size: int = 0,
+        max_calls: int = 100,
     ) -> None:
         super().__init__(environment)
         self.image = image
+        self.cache_environments = cache_environments
+        self.pool_size = pool_size
+        self.max_calls = max_calls
+        self._condition = threading.Condition()
+        self._idle: dict[str, list[_PooledContainer]] = {}
+        self._busy: dict[str, int] = {}
+        self._closed = False
+
+    def _build_command(self, closure: Closure) -> str:
+        """Return a shell command that builds the volume's environment unless it is ready."""
+        install = f"uv venv --quiet {_ENV_DIR}/venv"
+        if requirements := self.dependency_specifiers(closure):
+            install += f" && uv pip install --quiet --python {_ENV_DIR}/venv/bin/python {shlex.join(requirements)}"
+        build = f"[ -f {_ENV_DIR}/.ready ] || {{ rm -rf {_ENV_DIR}/venv && {install} && touch {_ENV_DIR}/.ready; }}"
+        return f"flock {_ENV_DIR}/.lock sh -c {shlex.quote(build)} 1>&2"
+
+    def _environment_command(
+        self, closure: Closure, script: str = "/main.py", arguments: str = "/args.pkl"
+    ) -> list[str]:
+        """Build the volume's environment on first use, then run the script on its interpreter."""
+        return [
+            "sh",
+            "-c",
+            f"{self._build_command(closure)} && exec {_ENV_DIR}/venv/bin/python {script} {arguments}",
+        ]
+
+    def _run_command(self, closure: Closure, script: str, arguments: str) -> list[str]:
+        if self.cache_environments:
+            return self._environment_command(closure, script, arguments)
+        return ["uv", "run", script, arguments]
 
     @classmethod
-    def _create_tar_stream(cls, files: dict[str, str]) -> io.BytesIO:
+    def _create_tar_stream(cls, files: dict[str, str | bytes]) -> io.BytesIO:
         """Creates a tar stream from a dictionary of files."""
         stream = io.BytesIO()
         with tarfile.open(fileobj=stream, mode="w") as tar:
             for name, content in files.items():
                 info = tarfile.TarInfo(name=name)
-                encoded_content = content.encode("utf-8")
+                encoded_content = content.encode("utf-8") if isinstance(content, str) else content
                 info.size = len(encoded_content)
                 tar.addfile(info, io.BytesIO(encoded_content))
         stream.seek(0)
         return stream
 
+    def _start_container(self, closure: Closure, command: str | list[str] = "tail -f /dev/null") -> Container:
+        volumes = (
+            {f"lilypad-env-{dependency_key(closure)[:32]}": {"bind": _ENV_DIR, "mode": "rw"}}
+            if self.cache_environments
+            else None
+        )
+        return _docker_client().containers.run(
+            self.image,
+            command,  # Keep container running
+            remove=True,
+            detach=True,
+            security_opt=["no-new-privileges"],  # Prevent privilege escalation
+            cap_drop=["ALL"],  # Drop all capabilities
+            environment=self.environment,
+            volumes=volumes,
+        )
+
+    def _server_script(self, closure: Closure) -> str:
+        return f"{self.generate_script_metadata(closure)}\n{RUNTIME_SOURCE}\n{_SERVER_SOURCE}"
+
+    def _start_pooled_container(self, closure: Closure) -> _PooledContainer:
+        container = self._start_container(closure, ["sh", "-c", f"mkdir -p {_WORK_DIR} && exec tail -f /dev/null"])
+        try:
+            server = f"{_WORK_DIR}/server.py"
+            container.put_archive("/", self._create_tar_stream({server[1:]: self._server_script(closure)}))
+            # Start the resident interpreter, building or resolving the dependencies before the first call.
+            _, socket = container.exec_run(cmd=self._run_command(closure, server, _WORK_DIR), stdin=True, socket=True)
+            pooled = _PooledContainer(container, socket)
+            pooled.wait_ready()
+        except BaseException:
+            with suppress(Exception):
+                container.kill()
+            raise
+        return pooled
+
+    def _acquire(self, key: str, closure: Closure) -> _PooledContainer:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The sandbox runner is closed")
+                if idle := self._idle.setdefault(key, []):
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    return idle.pop()
+                if self._busy.get(key, 0) < self.pool_size:
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    break
+                self._condition.wait()
+        try:
+            return self._start_pooled_container(closure)
+        except BaseException:
+            with self._condition:
+                self._busy[key] -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, key: str, pooled: _PooledContainer) -> None:
+        recycle = self._closed or pooled.broken or pooled.calls >= self.max_calls
+        with self._condition:
+            self._busy[key] -= 1
+            if not recycle:
+                self._idle.setdefault(key, []).append(pooled)
+            self._condition.notify()
+        if recycle:
+            with suppress(Exception):
+                pooled.container.kill()
+
+    def prewarm(self, closures: Iterable[Closure], count: int = 1) -> None:
+        """Start up to *count* warm containers for each dependency set of *closures*."""
+        if not self.pool_size:
+            return
+        for key, closure in {dependency_key(closure): closure for closure in closures}.items():
+            started = [self._acquire(key, closure) for _ in range(min(count, self.pool_size))]
+            for pooled in started:
+                self._release(key, pooled)
+
+    def _execute_pooled(
+        self, closure: Closure, program: str, arguments: bytes, *, batch: bool = False
+    ) -> tuple[int, bytes, bytes]:
+        """Run *program* in a warm container and return the reply's status, payload and stderr."""
+        key = dependency_key(closure)
+        pooled = self._acquire(key, closure)
+        try:
+            header = orjson.dumps({"program": program, "imports": _imports(closure.code), "batch": batch})
+            status, payload = pooled.call(_REQUEST.pack(len(header), len(arguments)) + header + arguments)
+            pooled.calls += 1
+            stderr = pooled.stderr()  # before another call can reuse the container and clear it
+        except (DockerException, OSError, RuntimeError):
+            pooled.broken = True
+            raise
+        finally:
+            self._release(key, pooled)
+        return status, payload, stderr
+
+    def _execute(self, closure: Closure, script: bytes, arguments: bytes) -> tuple[int, bytes, bytes]:
+        """Run the script with the pickled arguments and return its exit code, stdout and stderr."""
+        container = None
+        try:
+            container = self._start_container(closure)
+            contents = {"main.py": script, "args.pkl": arguments}
+            stream = self._create_tar_stream(contents)
+            container.put_archive("/", stream)
+            exit_code, (stdout, stderr) = container.exec_run(
+                cmd=self._run_command(closure, "/main.py", "/args.pkl"),
+                demux=True,
+            )
+            return exit_code, stdout or b"", stderr or b""
+        finally:
+            if container:
+                with suppress(Exception):
+                    container.stop()
+
     def execute_function(
         self,
         closure: Closure,
+        *args: Any,
         custom_result: dict[str, str] | None = None,
         pre_actions: list[str] | None = None,
         after_actions: list[str] | None = None,
         extra_imports: list[str] | None = None,
-        *args: Any,
         **kwargs: Any,
     ) -> Result:
         """Execute the function in the sandbox."""
-        script = self.generate_script(
+        if self.pool_size:
+            program = self.generate_program(
+                closure,
+                custom_result=custom_result,
+                pre_actions=pre_actions,
+                after_actions=after_actions,
+                extra_imports=extra_imports,
+            )
+            status, payload, stderr = self._execute_pooled(closure, program, self.encode_arguments(args, kwargs))
+            return self.parse_result_frame(status, payload, stderr)
+        script = self.script_path(
             closure,
-            *args,
             custom_result=custom_result,
             pre_actions=pre_actions,
             after_actions=after_actions,
             extra_imports=extra_imports,
-            **kwargs,
-        )
-        client = docker.from_env()
-        container = None
-        try:
-            container = client.containers.run(
-                self.image,
-                "tail -f /dev/null",  # Keep container running
-                remove=True,
-                detach=True,
-                security_opt=["no-new-privileges"],  # Prevent privilege escalation
-                cap_drop=["ALL"],  # Drop all capabilities
-                environment=self.environment,
+        ).read_bytes()
+        exit_code, stdout, stderr = self._execute(closure, script, self.encode_arguments(args, kwargs))
+        return self.parse_execution_result(stdout, stderr, exit_code)
+
+    def execute_batch(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> Iterator[Result | Exception]:
+        """Execute the whole batch in one container.
+
+        The results are yielded once the container has run every call.
+        """
+        calls = list(calls)
+        if not calls:
+            return
+        if self.pool_size:
+            program = self.generate_program(
+                closure,
+                custom_result=custom_result,
+                pre_actions=pre_actions,
+                after_actions=after_actions,
+                extra_imports=extra_imports,
             )
-            contents = {"main.py": script}
-            stream = self._create_tar_stream(contents)
-            container.put_archive("/", stream)
-            exit_code, (stdout, stderr) = container.exec_run(
-                cmd=["uv", "run", "/main.py"],
-                demux=True,
+            status, payload, stderr = self._execute_pooled(
+                closure, program, self.encode_batch(calls, concurrency), batch=True
             )
+            if status:
+                self.parse_result_frame(status, payload, stderr)  # raises
+            yield from self.parse_batch_output(payload.splitlines(), len(calls), lambda: stderr)
+            return
+        script = self.script_path(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        ).read_bytes()
+        _, stdout, stderr = self._execute(closure, script, self.encode_batch(calls, concurrency))
+        yield from self.parse_batch_output(stdout.splitlines(), len(calls), lambda: stderr)
 
-            return self.parse_execution_result(stdout or b"", stderr or b"", exit_code)
-        finally:
-            if container:
-                with suppress(Exception):
-                    container.stop()
+    def close(self) -> None:
+        """Stop the pooled containers."""
+        with self._condition:
+            self._closed = True
+            pooled = [pooled for idle in self._idle.values() for pooled in idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for entry in pooled:
+            with suppress(Exception):
+                entry.container.kill()
+
+    def __enter__(self) -> "DockerSandboxRunner":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
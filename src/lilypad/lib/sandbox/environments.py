@@ -0,0 +1,214 @@
+"""Content-addressed virtual environments for sandbox runners."""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from typing import IO, Any
+from pathlib import Path
+from collections.abc import Iterable
+
+import orjson
+
+from .runner import SandboxRunner, DependencyError, cache_directory
+from .._utils import Closure
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_STALE_BUILD_SECONDS = 3_600
+_LOCK_FILE = ".lilypad.lock"
+
+
+def dependency_key(closure: Closure) -> str:
+    """Return a stable hash of the closure's dependency set."""
+    return hashlib.sha256(orjson.dumps(closure.dependencies, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _interpreter(venv: Path) -> Path:
+    return venv / "Scripts" / "python.exe" if sys.platform == "win32" else venv / "bin" / "python"
+
+
+class EnvironmentLease:
+    """A shared lock on a cached environment, held while its interpreter may run."""
+
+    def __init__(self, python: Path, handle: IO[str] | None) -> None:
+        self.python = python
+        self._handle = handle
+
+    def release(self) -> None:
+        if self._handle is not None:
+            self._handle.close()  # closing the file releases its lock
+            self._handle = None
+
+    def __enter__(self) -> EnvironmentLease:
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.release()
+
+
+class EnvironmentCache:
+    """Virtual environments built once per dependency set and shared by sandbox runners.
+
+    Environments live under *root* in a directory named after `dependency_key`.
+    They are built with `uv venv` and `uv pip install` into a temporary directory
+    and renamed into place, so concurrent builders (threads or processes) never
+    observe a half-built environment. Each use refreshes the directory's
+    modification time, and the least recently used environments beyond
+    *max_environments* are removed whenever a new one is built. Environments
+    with a `lease` held, in any process, are not removed.
+
+    *python* selects the interpreter the environments are created with; by
+    default uv picks one.
+    """
+
+    def __init__(
+        self,
+        root: str | os.PathLike[str] | None = None,
+        *,
+        max_environments: int = 32,
+        python: str | None = None,
+        uv: str = "uv",
+        environment: dict[str, str] | None = None,
+    ) -> None:
+        self.root = Path(root).expanduser() if root is not None else cache_directory() / "environments"
+        self.max_environments = max_environments
+        self.python_request = python
+        self.uv = uv
+        self.environment = environment if environment is not None else os.environ.copy()
+        self._lock = threading.Lock()
+        self._building: dict[str, threading.Lock] = {}
+
+    def path(self, closure: Closure) -> Path:
+        """Return the directory of the closure's environment, whether or not it exists."""
+        return self.root / dependency_key(closure)
+
+    def python(self, closure: Closure) -> Path:
+        """Return the interpreter of the closure's environment, building it if needed."""
+        venv = self.path(closure)
+        if not _interpreter(venv).exists():
+            with self._lock:
+                building = self._building.setdefault(venv.name, threading.Lock())
+            with building:
+                if not _interpreter(venv).exists():
+                    self._build(venv, SandboxRunner.dependency_specifiers(closure))
+                    self.collect_garbage(keep=venv)
+        os.utime(venv)
+        return _interpreter(venv)
+
+    def lease(self, closure: Closure) -> EnvironmentLease:
+        """Return a lease on the closure's environment, building it if needed.
+
+        The lease holds a shared file lock that `collect_garbage` respects, so
+        hold it for as long as the interpreter runs and release it afterwards,
+        or use it as a context manager. Without `fcntl` no lock is taken.
+        """
+        while True:
+            python = self.python(closure)
+            if fcntl is None:
+                return EnvironmentLease(python, None)
+            path = self.path(closure) / _LOCK_FILE
+            try:
+                handle = open(path, "a")
+            except FileNotFoundError:
+                continue  # removed since it was built
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            try:
+                if python.exists() and os.path.samestat(os.fstat(handle.fileno()), os.stat(path)):
+                    return EnvironmentLease(python, handle)
+            except FileNotFoundError:
+                pass
+            handle.close()  # removed while we waited for the lock
+
+    def _run(self, *args: str) -> None:
+        try:
+            # run from the cache root so that uv does not pick up the caller's project settings
+            subprocess.run([self.uv, *args], check=True, capture_output=True, env=self.environment, cwd=self.root)
+        except subprocess.CalledProcessError as e:
+            raise DependencyError(e.stderr.decode(errors="replace").strip() or str(e)) from e
+
+    def _build(self, venv: Path, requirements: list[str]) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging = self.root / f".{venv.name}.{uuid.uuid4().hex}"
+        try:
+            self._run(
+                "venv", "--quiet", *(["--python", self.python_request] if self.python_request else []), str(staging)
+            )
+            if requirements:
+                self._run("pip", "install", "--quiet", "--python", str(_interpreter(staging)), *requirements)
+            try:
+                staging.rename(venv)
+            except OSError:
+                if not _interpreter(venv).exists():  # someone else won the race otherwise
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        logger.debug("Built sandbox environment %s for %s", venv.name, requirements)
+
+    def prepare(self, closures: Iterable[Closure]) -> int:
+        """Build the environments of *closures* ahead of time.
+
+        Failures are logged rather than raised so that one bad dependency set
+        does not prevent the others from being prepared.
+
+        Returns:
+            The number of environments that are ready.
+        """
+        ready = 0
+        for key, closure in {dependency_key(closure): closure for closure in closures}.items():
+            try:
+                self.python(closure)
+                ready += 1
+            except DependencyError as e:
+                logger.warning("Failed to prepare sandbox environment %s: %s", key, e)
+        return ready
+
+    def collect_garbage(self, keep: Path | None = None) -> None:
+        """Remove the least recently used environments beyond `max_environments`."""
+        if not self.root.exists():
+            return
+        now = time.time()
+        environments: list[tuple[float, Path]] = []
+        for entry in self.root.iterdir():
+            mtime = entry.stat().st_mtime
+            if entry.name.startswith("."):
+                if now - mtime > _STALE_BUILD_SECONDS:  # left behind by an interrupted build
+                    shutil.rmtree(entry, ignore_errors=True)
+            elif entry != keep:
+                environments.append((mtime, entry))
+        environments.sort(reverse=True)
+        for _, entry in environments[max(self.max_environments - (keep is not None), 0) :]:
+            self._remove(entry)
+
+    def _remove(self, venv: Path) -> None:
+        """Remove *venv* unless a lease on it is held."""
+        if fcntl is None:
+            shutil.rmtree(venv, ignore_errors=True)
+            return
+        try:
+            handle = open(venv / _LOCK_FILE, "a")
+        except OSError:
+            shutil.rmtree(venv, ignore_errors=True)
+            return
+        with handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Keeping sandbox environment %s, which is in use", venv.name)
+                return
+            shutil.rmtree(venv, ignore_errors=True)
+
+
+__all__ = ["EnvironmentCache", "EnvironmentLease", "dependency_key"]
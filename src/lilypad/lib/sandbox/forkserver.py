@@ -0,0 +1,372 @@
+"""Sandbox runner that forks each call from a warm server process."""
+
+from __future__ import annotations
+
+import os
+import ast
+import shutil
+import socket
+import struct
+import asyncio
+import tempfile
+import threading
+import subprocess
+from typing import IO, Any
+from pathlib import Path
+from functools import lru_cache  # noqa: TID251
+from contextlib import suppress
+from collections import deque
+from collections.abc import Iterable, Sequence
+
+import orjson
+
+from .runner import RUNTIME_SOURCE, Result, AsyncSandboxRunner
+from .._utils import Closure
+from .environments import EnvironmentCache, EnvironmentLease, dependency_key
+
+_HEADER = struct.Struct(">BI")  # status, payload length
+
+_REQUEST = struct.Struct(">II")  # request header length, pickled arguments length
+
+_SERVER_SOURCE = """
+import atexit
+import socket
+import struct
+import importlib
+import selectors
+
+_HEADER = struct.Struct(">BI")
+_REQUEST = struct.Struct(">II")
+
+
+def _receive(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return bytes(data)
+
+
+def _preload(names):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception:  # reported by the call whose program imports it
+            pass
+
+
+def _reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+
+
+def _child(listener, conn, request, arguments):
+    listener.close()
+    try:
+        parts = _call(_load_program(request["program"]), arguments)
+        status = 0
+    except (Exception, SystemExit) as e:
+        parts = _body(_error(e))
+        status = 1
+    conn.sendall(_HEADER.pack(status, sum(len(part) for part in parts)))
+    for part in parts:
+        conn.sendall(part)
+    conn.close()
+    atexit._run_exitfuncs()  # e.g. flush the spans exported by the call
+
+
+def _serve(path, preload):
+    ready = _take_stdout()
+    _preload(preload)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(sys.stdin, selectors.EVENT_READ)
+    ready.write(b"ready\\n")
+    ready.flush()
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is not listener:
+                return  # stdin was closed by the parent
+            conn, _ = listener.accept()
+            try:
+                request_length, arguments_length = _REQUEST.unpack(_receive(conn, _REQUEST.size))
+                request = json.loads(_receive(conn, request_length))
+                arguments = _receive(conn, arguments_length)
+            except (EOFError, OSError, ValueError):
+                conn.close()
+                continue
+            _preload(request["imports"])
+            if os.fork() == 0:
+                try:
+                    _child(listener, conn, request, arguments)
+                finally:
+                    os._exit(0)
+            conn.close()
+            _reap()
+
+
+if __name__ == "__main__":
+    _serve(sys.argv[1], json.loads(sys.argv[2]))
+"""
+
+
+@lru_cache(maxsize=256)
+def _imports(code: str) -> tuple[str, ...]:
+    """Return the modules imported at the top level of *code*."""
+    names: list[str] = []
+    for node in ast.parse(code).body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module not in (None, "__future__"):
+            names.append(node.module)  # pyright: ignore [reportArgumentType]
+    return tuple(dict.fromkeys(names))
+
+
+def _receive(conn: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return bytes(data)
+
+
+class _ForkServer:
+    """A server process that forks a child per call, holding the lease on its environment until it is closed."""
+
+    def __init__(
+        self,
+        command: Sequence[str],
+        environment: dict[str, str],
+        preload: Sequence[str],
+        lease: EnvironmentLease | None = None,
+    ) -> None:
+        self.lease = lease
+        self.directory = Path(tempfile.mkdtemp(prefix="lilypad-forkserver-"))
+        self.path = str(self.directory / "server.sock")
+        self.process = subprocess.Popen(
+            [*command, self.path, orjson.dumps(list(preload)).decode()],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=environment,
+        )
+        self._stderr: deque[bytes] = deque(maxlen=256)
+        threading.Thread(target=self._drain, args=(self.process.stderr,), daemon=True).start()
+        if self.process.stdout.readline() != b"ready\n":  # pyright: ignore [reportOptionalMemberAccess]
+            returncode = self.close()
+            raise RuntimeError(f"Sandbox fork server exited with status {returncode}.\nStderr: {self.stderr()}")
+
+    def _drain(self, stream: IO[bytes]) -> None:
+        for line in iter(stream.readline, b""):
+            self._stderr.append(line)
+
+    def stderr(self) -> str:
+        return b"".join(self._stderr).decode(errors="replace")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def _exited(self) -> RuntimeError:
+        return RuntimeError(f"Sandbox process exited before replying.\nStderr: {self.stderr()}")
+
+    def call(self, request: bytes) -> tuple[int, bytes]:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            try:
+                conn.connect(self.path)
+                conn.sendall(request)
+                status, length = _HEADER.unpack(_receive(conn, _HEADER.size))
+                return status, _receive(conn, length)
+            except (EOFError, OSError) as e:
+                raise self._exited() from e
+
+    async def call_async(self, request: bytes) -> tuple[int, bytes]:
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            raise self._exited() from e
+        try:
+            writer.write(request)
+            await writer.drain()
+            status, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+            return status, await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            raise self._exited() from e
+        finally:
+            writer.close()
+            with suppress(OSError):
+                await writer.wait_closed()
+
+    def close(self) -> int:
+        if self.process.stdin is not None:
+            with suppress(OSError):
+                self.process.stdin.close()
+        try:
+            returncode = self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            returncode = self.process.wait()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream is not None:
+                stream.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if self.lease is not None:
+            self.lease.release()
+        return returncode
+
+
+class ForkServerSandboxRunner(AsyncSandboxRunner):
+    """Runs each call in a child forked from a warm server process.
+
+    One server is started per dependency set, with `uv run --no-project` or,
+    with *environments*, on the interpreter of a cached environment. It imports
+    the modules in *preload* and, before forking, the modules the closure
+    imports, so each call starts from a copy-on-write process with its
+    dependencies already loaded. The child runs the closure's program, replies
+    over a Unix socket and exits.
+
+    Calls are isolated from each other but share the server's imported state,
+    so use this runner only for trusted code. It requires `os.fork`.
+    """
+
+    def __init__(
+        self,
+        environment: dict[str, str] | None = None,
+        *,
+        preload: Sequence[str] = ("lilypad",),
+        command: Sequence[str] = ("uv", "run", "--no-project"),
+        environments: EnvironmentCache | None = None,
+    ) -> None:
+        if not hasattr(os, "fork"):
+            raise RuntimeError("ForkServerSandboxRunner requires a platform that supports os.fork")
+        super().__init__(environment)
+        if "PATH" not in self.environment:
+            self.environment["PATH"] = os.environ["PATH"]
+        self.preload = tuple(preload)
+        self.command = tuple(command)
+        self.environments = environments
+        self._directory = Path(tempfile.mkdtemp(prefix="lilypad-sandbox-"))
+        self._lock = threading.Lock()
+        self._starting: dict[str, threading.Lock] = {}
+        self._servers: dict[str, _ForkServer] = {}
+        self._closed = False
+
+    def _script(self, key: str, closure: Closure) -> Path:
+        path = self._directory / f"forkserver-{key[:16]}.py"
+        if not path.exists():
+            path.write_text(f"{self.generate_script_metadata(closure)}\n{RUNTIME_SOURCE}\n{_SERVER_SOURCE}")
+        return path
+
+    def _server(self, closure: Closure) -> _ForkServer:
+        key = dependency_key(closure)
+        with self._lock:
+            starting = self._starting.setdefault(key, threading.Lock())
+        with starting:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("The sandbox runner is closed")
+                server = self._servers.get(key)
+            if server is not None and server.alive:
+                return server
+            if server is not None:
+                server.close()
+            lease = self.environments.lease(closure) if self.environments else None
+            command = [str(lease.python)] if lease else [*self.command]
+            try:
+                server = _ForkServer(
+                    [*command, str(self._script(key, closure))],
+                    self.environment,
+                    [*self.preload, *_imports(closure.code)],
+                    lease,
+                )
+            except BaseException:
+                if lease is not None:
+                    lease.release()
+                raise
+            with self._lock:
+                self._servers[key] = server
+            return server
+
+    def prewarm(self, closures: Iterable[Closure]) -> None:
+        """Start the servers of *closures* ahead of their first call."""
+        for closure in {dependency_key(closure): closure for closure in closures}.values():
+            self._server(closure)
+
+    def _request(self, closure: Closure, program: str, arguments: bytes) -> bytes:
+        header = orjson.dumps({"program": program, "imports": _imports(closure.code)})
+        return _REQUEST.pack(len(header), len(arguments)) + header + arguments
+
+    def execute_function(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in a forked child."""
+        program = self.generate_program(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        server = self._server(closure)
+        status, payload = server.call(self._request(closure, program, self.encode_arguments(args, kwargs)))
+        return self.parse_result_frame(status, payload, server.stderr().encode())
+
+    async def execute_function_async(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in a forked child without blocking the event loop."""
+        program = self.generate_program(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        server = await asyncio.to_thread(self._server, closure)
+        status, payload = await server.call_async(self._request(closure, program, self.encode_arguments(args, kwargs)))
+        return self.parse_result_frame(status, payload, server.stderr().encode())
+
+    def close(self) -> None:
+        """Stop the servers and remove the generated scripts."""
+        with self._lock:
+            self._closed = True
+            servers = list(self._servers.values())
+            self._servers.clear()
+        for server in servers:
+            server.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self) -> ForkServerSandboxRunner:
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+
+__all__ = ["ForkServerSandboxRunner"]
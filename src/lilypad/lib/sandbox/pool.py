@@ -0,0 +1,364 @@
+"""Pooled sandbox runner that reuses long-lived worker processes."""
+
+from __future__ import annotations
+
+import os
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+import subprocess
+from typing import IO, Any
+from pathlib import Path
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+
+import orjson
+
+from .runner import RUNTIME_SOURCE, Result, SandboxRunner
+from .._utils import Closure
+from .environments import EnvironmentCache, EnvironmentLease, dependency_key
+
+_HEADER = struct.Struct(">BIQ")  # status, payload length, worker RSS in bytes
+_STATUS_OK = 0
+_STATUS_ERROR = 1
+
+_REQUEST = struct.Struct(">II")  # request header length, pickled arguments length
+
+_WORKER_SOURCE = """
+import struct
+
+_HEADER = struct.Struct(">BIQ")
+_REQUEST = struct.Struct(">II")
+
+
+def _rss():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def _serve():
+    requests = sys.stdin.buffer
+    replies = _take_stdout()
+    programs = {}
+
+    def reply(status, parts):
+        replies.writelines([_HEADER.pack(status, sum(len(part) for part in parts), _rss()), *parts])
+        replies.flush()
+
+    reply(0, [])
+    while True:
+        header = requests.read(_REQUEST.size)
+        if len(header) < _REQUEST.size:
+            return
+        request_length, arguments_length = _REQUEST.unpack(header)
+        request = json.loads(requests.read(request_length))
+        arguments = requests.read(arguments_length)
+        program_id = request["program_id"]
+        try:
+            if request.get("program") is not None:
+                programs[program_id] = _load_program(request["program"])
+            module = programs[program_id]
+            if request.get("batch"):
+                # one frame per call, in order
+                payload = _load_arguments(module, arguments)
+                _call_batch(module, payload["calls"], payload["concurrency"], lambda line: reply(0, [line]))
+                continue
+            data = _call(module, arguments)
+        except (Exception, SystemExit) as e:
+            reply(1, _body(_error(e)))
+            continue
+        reply(0, data)
+
+
+if __name__ == "__main__":
+    _serve()
+"""
+
+
+class _Worker:
+    """A single long-lived worker process, holding the lease on its environment until it is closed."""
+
+    def __init__(
+        self, command: Sequence[str], environment: dict[str, str], lease: EnvironmentLease | None = None
+    ) -> None:
+        self.lease = lease
+        self.process = subprocess.Popen(
+            list(command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=environment,
+        )
+        self.calls = 0
+        self.rss = 0
+        self.programs: set[str] = set()
+        self._stderr: deque[bytes] = deque(maxlen=256)
+        threading.Thread(target=self._drain, args=(self.process.stderr,), daemon=True).start()
+        try:
+            self._read()  # wait for the worker to report that it is ready
+        except RuntimeError:
+            self.close()
+            raise
+
+    def _drain(self, stream: IO[bytes]) -> None:
+        for line in iter(stream.readline, b""):
+            self._stderr.append(line)
+
+    def stderr(self) -> str:
+        return b"".join(self._stderr).decode(errors="replace")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def _read(self) -> tuple[int, bytes]:
+        stdout = self.process.stdout
+        assert stdout is not None
+        header = stdout.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            returncode = self.process.wait()
+            raise RuntimeError(f"Sandbox worker exited with status {returncode}.\nStderr: {self.stderr()}")
+        status, length, self.rss = _HEADER.unpack(header)
+        return status, stdout.read(length)
+
+    def _send(self, program_id: str, program: str, arguments: bytes, *, batch: int = 0) -> None:
+        stdin = self.process.stdin
+        assert stdin is not None
+        request = orjson.dumps(
+            {
+                "program_id": program_id,
+                "program": None if program_id in self.programs else program,
+                "batch": bool(batch),
+            }
+        )
+        self._stderr.clear()
+        try:
+            stdin.write(_REQUEST.pack(len(request), len(arguments)) + request + arguments)
+            stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RuntimeError(f"Sandbox worker is not running.\nStderr: {self.stderr()}") from e
+        self.calls += batch or 1
+
+    def _receive(self, program_id: str) -> tuple[int, bytes]:
+        status, payload = self._read()
+        if status == _STATUS_OK:
+            self.programs.add(program_id)
+        else:
+            self.programs.discard(program_id)
+        return status, payload
+
+    def call(self, program_id: str, program: str, arguments: bytes) -> tuple[int, bytes]:
+        self._send(program_id, program, arguments)
+        return self._receive(program_id)
+
+    def call_batch(self, program_id: str, program: str, arguments: bytes, count: int) -> Iterator[tuple[int, bytes]]:
+        """Send a batch of *count* calls and yield a frame per call; an error frame ends the batch."""
+        self._send(program_id, program, arguments, batch=count)
+        for _ in range(count):
+            status, payload = self._receive(program_id)
+            yield status, payload
+            if status != _STATUS_OK:
+                return
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.close()
+
+    def close(self) -> None:
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream is not None:
+                stream.close()
+        if self.lease is not None:
+            self.lease.release()
+
+
+class PooledSandboxRunner(SandboxRunner):
+    """Runs code in a pool of long-lived worker processes.
+
+    Each distinct dependency set gets its own workers, started with
+    `uv run --no-project` the first time it is needed. A worker loads each
+    function (running the pre-actions) once and then serves calls over a pipe,
+    so repeated calls skip interpreter startup and dependency resolution.
+    Workers are recycled after `max_calls` calls or once their peak RSS exceeds
+    `max_memory_mb`.
+
+    With *environments*, workers run on the interpreter of a prebuilt,
+    cached environment instead of `uv run`.
+
+    Arguments are pickled, as with `SubprocessSandboxRunner`. `execute_batch`
+    sends a whole batch to one worker, which streams back a frame per call.
+    """
+
+    def __init__(
+        self,
+        environment: dict[str, str] | None = None,
+        *,
+        max_workers: int = 4,
+        max_calls: int = 1_000,
+        max_memory_mb: int | None = None,
+        command: Sequence[str] = ("uv", "run", "--no-project"),
+        environments: EnvironmentCache | None = None,
+    ) -> None:
+        super().__init__(environment)
+        if "PATH" not in self.environment:
+            self.environment["PATH"] = os.environ["PATH"]
+        self.max_workers = max_workers
+        self.max_calls = max_calls
+        self.max_memory_mb = max_memory_mb
+        self.command = tuple(command)
+        self.environments = environments
+        self._directory = Path(tempfile.mkdtemp(prefix="lilypad-sandbox-"))
+        self._condition = threading.Condition()
+        self._idle: dict[str, list[_Worker]] = {}
+        self._busy: dict[str, int] = {}
+        self._closed = False
+
+    def _script(self, key: str, closure: Closure) -> Path:
+        path = self._directory / f"worker-{key[:16]}.py"
+        if not path.exists():
+            path.write_text(f"{self.generate_script_metadata(closure)}\n{RUNTIME_SOURCE}\n{_WORKER_SOURCE}")
+        return path
+
+    def _acquire(self, key: str, closure: Closure) -> _Worker:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The sandbox runner is closed")
+                idle = self._idle.setdefault(key, [])
+                while idle:
+                    worker = idle.pop()
+                    if worker.alive:
+                        self._busy[key] = self._busy.get(key, 0) + 1
+                        return worker
+                    worker.close()
+                if self._busy.get(key, 0) < self.max_workers:
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    break
+                self._condition.wait()
+        lease = None
+        try:
+            lease = self.environments.lease(closure) if self.environments else None
+            command = [str(lease.python)] if lease else [*self.command]
+            return _Worker([*command, str(self._script(key, closure))], self.environment, lease)
+        except BaseException:
+            if lease is not None:
+                lease.release()
+            with self._condition:
+                self._busy[key] -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, key: str, worker: _Worker) -> None:
+        recycle = (
+            self._closed
+            or not worker.alive
+            or worker.calls >= self.max_calls
+            or (self.max_memory_mb is not None and worker.rss > self.max_memory_mb * 1024 * 1024)
+        )
+        with self._condition:
+            self._busy[key] -= 1
+            if not recycle:
+                self._idle.setdefault(key, []).append(worker)
+            self._condition.notify()
+        if recycle:
+            worker.close()
+
+    def execute_function(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in a pooled worker."""
+        program = self.generate_program(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        program_id = hashlib.sha256(program.encode()).hexdigest()
+        key = dependency_key(closure)
+        worker = self._acquire(key, closure)
+        try:
+            status, payload = worker.call(program_id, program, self.encode_arguments(args, kwargs))
+            stderr = worker.stderr().encode()
+        finally:
+            self._release(key, worker)
+        return self.parse_result_frame(status, payload, stderr)
+
+    def execute_batch(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> Iterator[Result | Exception]:
+        """Execute the whole batch in one pooled worker, yielding results as they are produced."""
+        calls = list(calls)
+        if not calls:
+            return
+        program = self.generate_program(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        program_id = hashlib.sha256(program.encode()).hexdigest()
+        key = dependency_key(closure)
+        worker = self._acquire(key, closure)
+        finished = False
+        try:
+            frames = worker.call_batch(program_id, program, self.encode_batch(calls, concurrency), len(calls))
+            for status, payload in frames:
+                if status != _STATUS_OK:
+                    finished = True
+                    self.parse_result_frame(status, payload, worker.stderr().encode())  # raises
+                yield self.parse_batch_line(payload)
+            finished = True
+        finally:
+            if not finished:
+                worker.kill()  # frames the caller did not read would corrupt the next call
+            self._release(key, worker)
+
+    def close(self) -> None:
+        """Stop every worker and remove the generated worker scripts."""
+        with self._condition:
+            self._closed = True
+            workers = [worker for idle in self._idle.values() for worker in idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for worker in workers:
+            worker.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self) -> PooledSandboxRunner:
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
@@ -1,14 +1,245 @@
 """This module contains the SandboxRunner abstract base class."""
 
-import inspect
+import os
+import base64
+import pickle
+import struct
+import asyncio
+import hashlib
+import functools
+import threading
 from abc import ABC, abstractmethod
-from typing import Any, TypeVar, cast
+from typing import Any, TypeVar, OrderedDict, cast
+from pathlib import Path
+from contextlib import suppress
+from collections.abc import Callable, Iterable, Iterator, AsyncIterator
 from typing_extensions import TypedDict
 
 import orjson
 
 from .._utils import Closure
 
+_PICKLE_PROTOCOL = 4  # readable by every Python version a sandbox may run
+_BODY = struct.Struct(">II")  # JSON length, number of out-of-band buffers
+_BUFFER = struct.Struct(">Q")  # buffer length
+RESULT_FD_VARIABLE = "LILYPAD_RESULT_FD"
+"""Environment variable naming the file descriptor a generated script writes its result frame to."""
+_MAX_SCRIPT_PATHS = 256
+_script_paths: OrderedDict[tuple[Any, ...], Path] = OrderedDict()
+_script_paths_lock = threading.Lock()
+
+# Helpers shared by the generated scripts and the pooled workers; standard library only.
+RUNTIME_SOURCE = """
+import io
+import os
+import sys
+import json
+import base64
+import types
+import base64
+import pickle
+import struct
+import asyncio
+import inspect
+import traceback
+
+_BODY = struct.Struct(">II")
+_BUFFER = struct.Struct(">Q")
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, module):
+        super().__init__(file)
+        self.module = module
+
+    def find_class(self, module, name):
+        try:
+            return super().find_class(module, name)
+        except (ImportError, AttributeError):
+            # fall back to the definitions in the program, e.g. classes from the caller's own modules
+            obj = self.module
+            for part in name.split("."):
+                obj = getattr(obj, part)
+            return obj
+
+
+def _error(e):
+    return {
+        "error_type": e.__class__.__name__,
+        "error_message": str(e),
+        "is_dependency_error": isinstance(e, ImportError),
+        "module_name": getattr(e, "name", None),
+        "traceback": traceback.format_exc(),
+    }
+
+
+def _body(result):
+    # JSON with bytes-like values moved out of band, as a list of parts to write without joining them.
+    buffers = []
+
+    def default(obj):
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable") from None
+        buffers.append(view.cast("B") if view.contiguous else memoryview(view.tobytes()))
+        return {"__lilypad_buffer__": len(buffers) - 1}
+
+    data = json.dumps(result, default=default).encode()
+    parts = [_BODY.pack(len(data), len(buffers)), data]
+    for view in buffers:
+        parts += [_BUFFER.pack(view.nbytes), view]
+    return parts
+
+
+def _line(result):
+    # One JSON line; bytes-like values are inlined as base64 since a line cannot carry them raw.
+    def default(obj):
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable") from None
+        return {"__lilypad_base64__": base64.b64encode(view.cast("B") if view.contiguous else view.tobytes()).decode()}
+
+    return json.dumps(result, default=default).encode()
+
+
+def _take_stdout():
+    # Keep a private copy of stdout for the result; anything the function prints goes to stderr.
+    replies = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    return replies
+
+
+def _load_program(source):
+    module = types.ModuleType("__main__")
+    sys.modules["__main__"] = module
+    exec(compile(source, "<lilypad>", "exec"), module.__dict__)
+    return module
+
+
+def _load_arguments(module, arguments):
+    sys.modules["__main__"] = module
+    return _Unpickler(io.BytesIO(arguments), module).load()
+
+
+def _invoke(module, args, kwargs):
+    result = module._lilypad_main(*args, **kwargs)
+    if inspect.iscoroutine(result):
+        result = asyncio.run(result)
+    return result
+
+
+def _call(module, arguments):
+    args, kwargs = _load_arguments(module, arguments)
+    return _body(_invoke(module, args, kwargs))
+
+
+def _call_batch(module, calls, concurrency, emit):
+    # Emits one JSON line per call, in order; a failing call reports its error instead of its result.
+    def run(call):
+        try:
+            return _line({"result": _invoke(module, *call)})
+        except (Exception, SystemExit) as e:
+            return _line({"error": _error(e)})
+
+    if concurrency <= 1:
+        for call in calls:
+            emit(run(call))
+        return
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for line in executor.map(run, calls):
+            emit(line)
+"""
+
+_SCRIPT_MAIN = """
+
+if __name__ == "__main__":
+    _replies = _take_stdout()
+    _channel = os.environ.pop("LILYPAD_RESULT_FD", None)
+    _channel = os.fdopen(int(_channel), "wb") if _channel else None
+    try:
+        if len(sys.argv) > 1:
+            with open(sys.argv[1], "rb") as _file:
+                _arguments = _file.read()
+        else:
+            _arguments = sys.stdin.buffer.read()
+        _module = _load_program(_PROGRAM)
+        _payload = _load_arguments(_module, _arguments)
+        if isinstance(_payload, dict):
+
+            def _emit(line):
+                _replies.write(line + b"\\n")
+                _replies.flush()
+
+            _call_batch(_module, _payload["calls"], _payload["concurrency"], _emit)
+            _parts = []
+        elif _channel:
+            _parts = [b"\\x00", *_body(_invoke(_module, *_payload))]
+        else:
+            _parts = [json.dumps(_invoke(_module, *_payload)).encode()]
+    except (Exception, SystemExit) as e:
+        if _channel:
+            _channel.writelines([b"\\x01", *_body(_error(e))])
+            _channel.flush()
+        else:
+            _replies.write(json.dumps(_error(e)).encode())
+            _replies.flush()
+        sys.exit(1)
+    (_channel or _replies).writelines(_parts)
+    (_channel or _replies).flush()
+"""
+
+
+def cache_directory() -> Path:
+    """Return the directory Lilypad caches sandbox artifacts in."""
+    return Path(os.environ.get("XDG_CACHE_HOME") or "~/.cache").expanduser() / "lilypad"
+
+
+def _restore_buffers(value: Any, buffers: list[memoryview]) -> Any:
+    if isinstance(value, dict):
+        if len(value) == 1 and "__lilypad_buffer__" in value:
+            return buffers[value["__lilypad_buffer__"]]
+        return {k: _restore_buffers(v, buffers) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_restore_buffers(v, buffers) for v in value]
+    return value
+
+
+def _restore_base64(value: Any) -> Any:
+    if isinstance(value, dict):
+        if len(value) == 1 and "__lilypad_base64__" in value:
+            return memoryview(base64.b64decode(value["__lilypad_base64__"]))
+        return {k: _restore_base64(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_restore_base64(v) for v in value]
+    return value
+
+
+def decode_result(body: bytes | memoryview) -> Any:
+    """Decode a result body written by the sandbox runtime.
+
+    A body is a JSON document followed by the raw contents of the bytes-like
+    values it contained. Those values are returned as memoryviews of *body*,
+    so a body backed by a memory map is read without being copied.
+    """
+    view = memoryview(body)
+    json_length, count = _BODY.unpack_from(view)
+    offset = _BODY.size + json_length
+    document = orjson.loads(view[_BODY.size : offset])
+    if not count:
+        return document
+    buffers: list[memoryview] = []
+    for _ in range(count):
+        (length,) = _BUFFER.unpack_from(view, offset)
+        offset += _BUFFER.size
+        buffers.append(view[offset : offset + length])
+        offset += length
+    return _restore_buffers(document, buffers)
+
 
 class DependencyError(Exception):
     """Represents an error caused by missing or incompatible dependencies."""
@@ -49,6 +280,104 @@ class SandboxRunner(ABC):
         """Execute the function in the sandbox."""
         ...
 
+    async def execute_function_async(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in the sandbox without blocking the event loop.
+
+        Runs `execute_function` in a worker thread. `AsyncSandboxRunner`
+        subclasses provide a native implementation instead.
+        """
+        return await asyncio.to_thread(
+            functools.partial(
+                self.execute_function,
+                closure,
+                *args,
+                custom_result=custom_result,
+                pre_actions=pre_actions,
+                after_actions=after_actions,
+                extra_imports=extra_imports,
+                **kwargs,
+            )
+        )
+
+    def execute_batch(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> Iterator[Result | Exception]:
+        """Execute the function once per `(args, kwargs)` pair in *calls*, yielding results in order.
+
+        A failing call yields its exception instead of raising, so one bad
+        input does not abort the batch. Errors that affect every call, such as
+        a missing dependency, are raised.
+
+        This default runs `execute_function` once per call. Runners that can
+        ship the whole batch to a single sandbox override it, and run the calls
+        there with up to *concurrency* threads.
+        """
+        for args, kwargs in calls:
+            try:
+                yield self.execute_function(
+                    closure,
+                    *args,
+                    custom_result=custom_result,
+                    pre_actions=pre_actions,
+                    after_actions=after_actions,
+                    extra_imports=extra_imports,
+                    **kwargs,
+                )
+            except DependencyError:
+                raise
+            except Exception as e:
+                yield e
+
+    async def execute_batch_async(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> AsyncIterator[Result | Exception]:
+        """Asynchronous version of `execute_batch`.
+
+        Iterates `execute_batch` in a worker thread unless the runner provides
+        a native implementation.
+        """
+        results = self.execute_batch(
+            closure,
+            calls,
+            concurrency=concurrency,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        done = object()
+        try:
+            while (item := await asyncio.to_thread(next, results, done)) is not done:
+                yield cast("Result | Exception", item)
+        finally:
+            with suppress(ValueError):  # still running in the worker thread if we were cancelled
+                results.close()
+
     @classmethod
     def _is_async_func(cls, closure: Closure) -> bool:
         lines = closure.signature.splitlines()
@@ -83,120 +412,229 @@ class SandboxRunner(ABC):
         return cast(Result, orjson.loads(stdout.strip()))
 
     @classmethod
-    def generate_script(
+    def parse_result_frame(cls, status: int, body: bytes | memoryview, stderr: bytes) -> Result:
+        """Parse a result body (see `decode_result`) reported with *status*, 0 meaning success."""
+        if status == 0:
+            return cast(Result, decode_result(body))
+        json_length, _ = _BODY.unpack_from(body)
+        return cls.parse_execution_result(bytes(body[_BODY.size : _BODY.size + json_length]), stderr, 1)
+
+    @classmethod
+    def _call_error(cls, error: dict[str, Any]) -> Exception:
+        if error.get("is_dependency_error", False) or error["error_type"] in ["ImportError", "ModuleNotFoundError"]:
+            return DependencyError(
+                message=error.get("error_message", "Unknown dependency error"),
+                module_name=error.get("module_name"),
+                error_class=error.get("error_type"),
+            )
+        return RuntimeError(f"{error['error_type']}: {error['error_message']}\n{error['traceback']}")
+
+    @classmethod
+    def parse_batch_line(cls, line: bytes, stderr: bytes = b"") -> Result | Exception:
+        """Parse one line of a batch's output into the call's result or the exception it raised.
+
+        Bytes-like values in the result are returned as memoryviews, as with `decode_result`.
+
+        Raises if the line reports an error that ended the whole batch.
+        """
+        try:
+            data = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            data = None
+        if isinstance(data, dict) and "result" in data:
+            if b"__lilypad_base64__" in line:
+                return cast(Result, _restore_base64(data["result"]))
+            return cast(Result, data["result"])
+        if isinstance(data, dict) and "error" in data:
+            return cls._call_error(data["error"])
+        return cls.parse_execution_result(line, stderr, 1)  # raises
+
+    @classmethod
+    def parse_batch_output(
+        cls, lines: Iterable[bytes], expected: int, stderr: Callable[[], bytes]
+    ) -> Iterator[Result | Exception]:
+        """Parse a batch's output lines as they arrive.
+
+        Raises if the sandbox stops before reporting all *expected* calls.
+        """
+        received = 0
+        for line in lines:
+            if line.strip():
+                yield cls.parse_batch_line(line, stderr())
+                received += 1
+        if received < expected:
+            raise RuntimeError(
+                f"Sandbox exited after {received} of {expected} calls.\nStderr: {stderr().decode(errors='replace')}"
+            )
+
+    @classmethod
+    def dependency_specifiers(cls, closure: Closure) -> list[str]:
+        """Return the closure's dependencies as pinned requirement specifiers."""
+        return [
+            f"{key}[{','.join(extras)}]=={value['version']}"
+            if (extras := value["extras"])
+            else f"{key}=={value['version']}"
+            for key, value in closure.dependencies.items()
+        ]
+
+    @classmethod
+    def generate_script_metadata(cls, closure: Closure) -> str:
+        """Generate the PEP 723 inline metadata declaring the closure's dependencies."""
+        dependencies_str = ",\n#   ".join(f'"{specifier}"' for specifier in cls.dependency_specifiers(closure))
+        return f"# /// script\n# dependencies = [\n#   {dependencies_str}\n# ]\n# ///"
+
+    @classmethod
+    def generate_program(
         cls,
         closure: Closure,
-        *args: Any,
         custom_result: dict[str, str] | None = None,
         pre_actions: list[str] | None = None,
         after_actions: list[str] | None = None,
         extra_imports: list[str] | None = None,
-        **kwargs: Any,
     ) -> str:
-        """Generate a script that executes the function in the sandbox."""
+        """Generate a module that defines the function and a `_lilypad_main` entry point.
+
+        Unlike `generate_script`, the arguments are not baked into the source:
+        `_lilypad_main(*args, **kwargs)` calls the function, runs the after
+        actions and returns the result dictionary, so one program can serve
+        many calls. For async functions `_lilypad_main` is a coroutine function.
+        """
         if custom_result:
             result_content = "{" + ", ".join(f'"{k}": ({v})' for k, v in custom_result.items()) + "}"
         else:
             result_content = '{"result": result}'
-
-        base_run = "{name}(*{args}, **{kwargs})".format(name=closure.name, args=args, kwargs=kwargs)
-
         is_async = cls._is_async_func(closure)
-        if is_async:
-            extra_imports = extra_imports or []
-            extra_imports.append("import asyncio")
-            result_code = inspect.cleandoc("""
-            async def main():
-                    result = await {base_run}
-                    {after_actions}
-                    return {result_content}
-                result = asyncio.run(main())
-            """).format(
-                base_run=base_run,
-                result_content=result_content,
-                after_actions="\n        ".join(after_actions) if after_actions else "",
-            )
-        else:
-            result_code = inspect.cleandoc("""
-            def main():
-                    result = {base_run}
-                    {after_actions}
-                    return {result_content}
-                result = main()
-            """).format(
-                base_run=base_run,
-                result_content=result_content,
-                after_actions="\n        ".join(after_actions) if after_actions else "",
-            )
-
-        dependencies_str = ",\n#   ".join(
+        call = f"await {closure.name}(*args, **kwargs)" if is_async else f"{closure.name}(*args, **kwargs)"
+        body = "\n    ".join([f"result = {call}", *(after_actions or []), f"return {result_content}"])
+        return "\n".join(
             [
-                f'"{key}[{",".join(extras)}]=={value["version"]}"'
-                if (extras := value["extras"])
-                else f'"{key}=={value["version"]}"'
-                for key, value in closure.dependencies.items()
+                closure.code,
+                *(extra_imports or []),
+                *(pre_actions or []),
+                "",
+                "",
+                f"{'async def' if is_async else 'def'} _lilypad_main(*args, **kwargs):",
+                f"    {body}",
+                "",
             ]
         )
 
-        error_handler = """
-    try:
-        {code}
-        
-        {extra_imports}
-        {pre_actions}
-        {result}
-        print(json.dumps(result))
-    except ImportError as e:
-        import traceback
-        error_info = {{
-            "error_type": "ImportError",
-            "error_message": str(e),
-            "is_dependency_error": True,
-            "module_name": getattr(e, "name", None),
-            "traceback": traceback.format_exc()
-        }}
-        print(json.dumps(error_info))
-        sys.exit(1)
-    except ModuleNotFoundError as e:
-        import traceback
-        error_info = {{
-            "error_type": "ModuleNotFoundError",
-            "error_message": str(e),
-            "is_dependency_error": True,
-            "module_name": getattr(e, "name", None),
-            "traceback": traceback.format_exc()
-        }}
-        print(json.dumps(error_info))
-        sys.exit(1)
-    except Exception as e:
-        import traceback
-        error_info = {{
-            "error_type": e.__class__.__name__,
-            "error_message": str(e),
-            "traceback": traceback.format_exc()
-        }}
-        print(json.dumps(error_info))
-        sys.exit(1)
-        """.format(
-            code="\n        ".join(closure.code.splitlines()),
-            extra_imports="\n        ".join(extra_imports) if extra_imports else "",
-            pre_actions="\n        ".join(pre_actions) if pre_actions else "",
-            result="\n    ".join(result_code.splitlines()),
+    @classmethod
+    def generate_script(
+        cls,
+        closure: Closure,
+        *,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> str:
+        """Generate a script that executes the function in the sandbox.
+
+        The script does not depend on the call's arguments: it reads them as a
+        pickle from the file named by its first argument, or from stdin, and
+        writes the JSON result to stdout. Output printed by the function goes to
+        stderr. See `encode_arguments`. Given a batch (see `encode_batch`), it
+        writes one JSON line per call instead.
+
+        If `RESULT_FD_VARIABLE` names an inherited file descriptor, the result
+        of a single call is written there instead, as a status byte followed
+        by a result body (see `decode_result`), so bytes-like results are
+        transferred without being encoded.
+        """
+        program = cls.generate_program(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
         )
+        return f"{cls.generate_script_metadata(closure)}\n{RUNTIME_SOURCE}\n_PROGRAM = {program!r}\n{_SCRIPT_MAIN}"
 
-        return inspect.cleandoc(f"""
-# /// script
-# dependencies = [
-#   {dependencies_str}
-# ]
-# ///
+    @classmethod
+    def script_path(
+        cls,
+        closure: Closure,
+        *,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> Path:
+        """Return the path of the cached script for the closure, writing it if needed.
 
+        Scripts are content-addressed files under the Lilypad cache directory,
+        so they are generated once per closure and shared between processes.
+        """
+        key = (
+            closure.name,
+            closure.code,
+            closure.signature,
+            orjson.dumps(closure.dependencies, option=orjson.OPT_SORT_KEYS),
+            tuple((custom_result or {}).items()),
+            tuple(pre_actions or ()),
+            tuple(after_actions or ()),
+            tuple(extra_imports or ()),
+        )
+        with _script_paths_lock:
+            if (path := _script_paths.get(key)) is not None and path.exists():
+                _script_paths.move_to_end(key)
+                return path
+        script = cls.generate_script(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        directory = cache_directory() / "scripts"
+        path = directory / f"{hashlib.sha256(script.encode()).hexdigest()}.py"
+        if not path.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+            tmp = directory / f".{path.name}.{os.getpid()}.{threading.get_ident()}"
+            tmp.write_text(script)
+            os.replace(tmp, path)
+        with _script_paths_lock:
+            _script_paths[key] = path
+            if len(_script_paths) > _MAX_SCRIPT_PATHS:
+                _script_paths.popitem(last=False)
+        return path
 
-if __name__ == "__main__":
-    import json
-    import sys
-{error_handler}
-""")
+    @classmethod
+    def encode_arguments(cls, args: tuple[Any, ...], kwargs: dict[str, Any]) -> bytes:
+        """Serialize call arguments for the sandbox.
+
+        Arguments are pickled. Instances of classes that the sandbox cannot
+        import are resolved against the definitions in the closure's code.
+        """
+        return pickle.dumps((args, kwargs), protocol=_PICKLE_PROTOCOL)
+
+    @classmethod
+    def encode_batch(cls, calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]], concurrency: int) -> bytes:
+        """Serialize a batch of `(args, kwargs)` pairs for the sandbox, like `encode_arguments`."""
+        return pickle.dumps({"calls": list(calls), "concurrency": concurrency}, protocol=_PICKLE_PROTOCOL)
+
+
+class AsyncSandboxRunner(SandboxRunner):
+    """A sandbox runner with native asynchronous execution.
+
+    Subclasses must implement both `execute_function` and
+    `execute_function_async`.
+    """
+
+    @abstractmethod
+    async def execute_function_async(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in the sandbox without blocking the event loop."""
+        ...
 
 
 SandboxRunnerT = TypeVar("SandboxRunnerT", bound=SandboxRunner)
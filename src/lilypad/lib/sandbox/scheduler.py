@@ -0,0 +1,216 @@
+"""Bounded concurrency for sandbox executions."""
+
+from __future__ import annotations
+
+import time
+import bisect
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from collections.abc import Iterator, AsyncIterator
+
+from .._utils.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class SchedulerStats:
+    """A snapshot of a `SandboxScheduler`'s load and queue times."""
+
+    running: int
+    """Executions currently holding a slot."""
+    queued: int
+    """Executions waiting for a slot."""
+    started: int
+    """Executions that have been granted a slot so far."""
+    total_queue_time: float
+    """Seconds spent waiting for a slot, summed over every started execution."""
+    max_queue_time: float
+    """Longest time in seconds an execution waited for a slot."""
+
+
+class _Waiter:
+    __slots__ = ("name", "enqueued_at", "granted", "event", "loop", "future")
+
+    def __init__(self, name: str, loop: asyncio.AbstractEventLoop | None = None) -> None:
+        self.name = name
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.event = threading.Event() if loop is None else None
+        self.loop = loop
+        self.future: asyncio.Future[None] | None = loop.create_future() if loop is not None else None
+
+
+def _resolve(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class SandboxScheduler:
+    """Limits how many sandbox executions run at once.
+
+    At most *max_concurrency* executions run in total and at most
+    *max_per_function* per function name (`None` means unlimited). Executions
+    that cannot start wait in a queue ordered by priority, higher first, and
+    then by arrival. A waiter held back only by its function's limit does not
+    block waiters of other functions.
+
+    Threads use `slot` and coroutines `slot_async`; both share the same slots.
+    """
+
+    def __init__(self, max_concurrency: int | None = None, *, max_per_function: int | None = None) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_per_function = max_per_function
+        self._lock = threading.Lock()
+        self._queue: list[tuple[int, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._running_by_name: dict[str, int] = {}
+        self._started = 0
+        self._total_queue_time = 0.0
+        self._max_queue_time = 0.0
+
+    def _can_start(self, name: str) -> bool:
+        return (self.max_concurrency is None or self._running < self.max_concurrency) and (
+            self.max_per_function is None or self._running_by_name.get(name, 0) < self.max_per_function
+        )
+
+    def _start(self, name: str, queue_time: float) -> None:
+        self._running += 1
+        self._running_by_name[name] = self._running_by_name.get(name, 0) + 1
+        self._started += 1
+        self._total_queue_time += queue_time
+        self._max_queue_time = max(self._max_queue_time, queue_time)
+
+    def _enqueue(self, name: str, priority: int, loop: asyncio.AbstractEventLoop | None) -> _Waiter | None:
+        """Take a slot, or return the waiter queued for one."""
+        with self._lock:
+            # whenever slots are free, the queued waiters are all held back by their function's limit
+            if self._can_start(name):
+                self._start(name, 0.0)
+                return None
+            waiter = _Waiter(name, loop)
+            bisect.insort(self._queue, (-priority, next(self._sequence), waiter))
+            return waiter
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        for index, entry in enumerate(self._queue):
+            if entry[2] is waiter:
+                del self._queue[index]
+                return
+
+    def _release(self, name: str) -> None:
+        with self._lock:
+            self._running -= 1
+            if not (remaining := self._running_by_name[name] - 1):
+                del self._running_by_name[name]
+            else:
+                self._running_by_name[name] = remaining
+            self._grant()
+
+    def _grant(self) -> None:
+        """Hand free slots to the first eligible waiters; called with the lock held."""
+        index = 0
+        while index < len(self._queue) and (self.max_concurrency is None or self._running < self.max_concurrency):
+            waiter = self._queue[index][2]
+            if not self._can_start(waiter.name):
+                index += 1
+                continue
+            del self._queue[index]
+            if waiter.event is not None:
+                waiter.event.set()
+            else:
+                try:
+                    waiter.loop.call_soon_threadsafe(_resolve, waiter.future)  # pyright: ignore [reportOptionalMemberAccess, reportArgumentType]
+                except RuntimeError:  # the waiter's event loop is closed
+                    continue
+            waiter.granted = True
+            queue_time = time.monotonic() - waiter.enqueued_at
+            self._start(waiter.name, queue_time)
+            if queue_time > 1.0:
+                logger.debug("Sandbox execution of %s waited %.2fs for a slot", waiter.name, queue_time)
+
+    @contextmanager
+    def slot(self, name: str, *, priority: int = 0) -> Iterator[None]:
+        """Hold a slot for an execution of the function *name*, waiting for one if needed."""
+        waiter = self._enqueue(name, priority, None)
+        if waiter is not None:
+            try:
+                waiter.event.wait()  # pyright: ignore [reportOptionalMemberAccess]
+            except BaseException:
+                with self._lock:
+                    if not waiter.granted:
+                        self._dequeue(waiter)
+                        raise
+                self._release(name)
+                raise
+        try:
+            yield
+        finally:
+            self._release(name)
+
+    @asynccontextmanager
+    async def slot_async(self, name: str, *, priority: int = 0) -> AsyncIterator[None]:
+        """Asynchronous version of `slot` that waits without blocking the event loop."""
+        waiter = self._enqueue(name, priority, asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await waiter.future  # pyright: ignore [reportGeneralTypeIssues]
+            except BaseException:
+                with self._lock:
+                    if not waiter.granted:
+                        self._dequeue(waiter)
+                        raise
+                self._release(name)
+                raise
+        try:
+            yield
+        finally:
+            self._release(name)
+
+    def stats(self) -> SchedulerStats:
+        """Return the current load and the queue times observed so far."""
+        with self._lock:
+            return SchedulerStats(
+                running=self._running,
+                queued=len(self._queue),
+                started=self._started,
+                total_queue_time=self._total_queue_time,
+                max_queue_time=self._max_queue_time,
+            )
+
+
+_scheduler: SandboxScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> SandboxScheduler:
+    """Return the scheduler shared by `.remote()` and `.version()` calls.
+
+    It is created on first use from the `sandbox_max_concurrency` and
+    `sandbox_max_concurrency_per_function` settings; both are unlimited unless
+    set.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            settings = get_settings()
+            _scheduler = SandboxScheduler(
+                settings.sandbox_max_concurrency,
+                max_per_function=settings.sandbox_max_concurrency_per_function,
+            )
+        return _scheduler
+
+
+def set_scheduler(scheduler: SandboxScheduler | None) -> None:
+    """Replace the shared scheduler; `None` recreates it from the settings on next use."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+__all__ = ["SandboxScheduler", "SchedulerStats", "get_scheduler", "set_scheduler"]
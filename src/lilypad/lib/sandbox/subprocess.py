@@ -1,25 +1,77 @@
 """Subprocess sandbox runner."""
 
 import os
+import mmap
+import asyncio
 import tempfile
+import threading
 import subprocess
-from typing import Any, cast
-from pathlib import Path
+from typing import IO, Any, ContextManager, cast
+from contextlib import suppress, nullcontext
+from collections import deque
+from collections.abc import Iterable, Iterator, AsyncIterator
 
-from . import SandboxRunner
-from .runner import Result
+from .runner import RESULT_FD_VARIABLE, Result, AsyncSandboxRunner
 from .._utils import Closure
+from .environments import EnvironmentCache
 
+_BATCH_LINE_LIMIT = 64 * 1024 * 1024  # longest result line accepted from a batch
+_SHARED_MEMORY = "/dev/shm"
 
-class SubprocessSandboxRunner(SandboxRunner):
-    """Runs code in a subprocess."""
 
-    def __init__(self, environment: dict[str, str] | None = None) -> None:
+def _result_channel() -> ContextManager[IO[bytes] | None]:
+    """Return an anonymous file the script writes its result to, or `None` where fds cannot be passed."""
+    if os.name != "posix":
+        return nullcontext()
+    return tempfile.TemporaryFile(dir=_SHARED_MEMORY if os.path.isdir(_SHARED_MEMORY) else None)
+
+
+class SubprocessSandboxRunner(AsyncSandboxRunner):
+    """Runs code in a subprocess.
+
+    By default each call runs under `uv run`, which resolves the closure's
+    dependencies. With *environments*, the script runs on the interpreter of a
+    prebuilt, cached environment instead.
+
+    `execute_function_async` runs the subprocess with asyncio, so async
+    callers do not block their event loop.
+
+    On POSIX the script writes its result to an anonymous file passed as an
+    extra file descriptor (in shared memory where available), which is then
+    memory-mapped. Bytes-like values in the result are returned as
+    memoryviews of that mapping rather than copied.
+
+    `execute_batch` runs a whole batch in one subprocess and streams the
+    results back as they are produced.
+    """
+
+    def __init__(
+        self,
+        environment: dict[str, str] | None = None,
+        *,
+        environments: EnvironmentCache | None = None,
+    ) -> None:
         super().__init__(environment)
+        self.environments = environments
         if "PATH" not in self.environment:
             # Set uv path to the default value if not provided
             self.environment["PATH"] = os.environ["PATH"]
 
+    def _command(self, closure: Closure) -> tuple[list[str], ContextManager[Any]]:
+        """Return the command that runs a script and a context that holds its environment meanwhile."""
+        if self.environments is None:
+            return ["uv", "run", "--no-project"], nullcontext()
+        lease = self.environments.lease(closure)
+        return [str(lease.python)], lease
+
+    async def _command_async(self, closure: Closure) -> tuple[list[str], ContextManager[Any]]:
+        """Asynchronous version of `_command`."""
+        if self.environments is None:
+            return ["uv", "run", "--no-project"], nullcontext()
+        # building an environment can take a while, so do it off the loop
+        lease = await asyncio.to_thread(self.environments.lease, closure)
+        return [str(lease.python)], lease
+
     def execute_function(
         self,
         closure: Closure,
@@ -31,26 +83,192 @@ class SubprocessSandboxRunner(SandboxRunner):
         **kwargs: Any,
     ) -> Result:
         """Execute the function in the sandbox."""
-        script = self.generate_script(
+        script_path = self.script_path(
             closure,
-            *args,
             custom_result=custom_result,
             pre_actions=pre_actions,
             after_actions=after_actions,
             extra_imports=extra_imports,
-            **kwargs,
         )
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as tmp_file:
-            tmp_file.write(script)
-            tmp_path = Path(tmp_file.name)
-        try:
+        command, lease = self._command(closure)
+        with lease, _result_channel() as channel:
             result = subprocess.run(
-                ["uv", "run", "--no-project", str(tmp_path)],
+                [*command, str(script_path)],
+                input=self.encode_arguments(args, kwargs),
                 capture_output=True,
-                text=False,
-                env=self.environment,
+                **self._channel_options(channel),
             )
+            return self._parse_result(channel, result.stdout, result.stderr, result.returncode)
+
+    async def execute_function_async(
+        self,
+        closure: Closure,
+        *args: Any,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Result:
+        """Execute the function in the sandbox without blocking the event loop."""
+        script_path = self.script_path(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        command, lease = await self._command_async(closure)
+        with lease, _result_channel() as channel:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                str(script_path),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                **self._channel_options(channel),
+            )
+            try:
+                stdout, stderr = await process.communicate(self.encode_arguments(args, kwargs))
+            except asyncio.CancelledError:
+                with suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+                raise
+            return self._parse_result(channel, stdout, stderr, cast(int, process.returncode))
+
+    def _channel_options(self, channel: IO[bytes] | None) -> dict[str, Any]:
+        """Return the process options that hand *channel* to the script as its result channel."""
+        if channel is None:
+            return {"env": self.environment}
+        return {
+            "env": {**self.environment, RESULT_FD_VARIABLE: str(channel.fileno())},
+            "pass_fds": (channel.fileno(),),
+        }
+
+    def _parse_result(self, channel: IO[bytes] | None, stdout: bytes, stderr: bytes, returncode: int) -> Result:
+        if channel is not None and (size := os.fstat(channel.fileno()).st_size):
+            frame = memoryview(mmap.mmap(channel.fileno(), size, access=mmap.ACCESS_READ))
+            return self.parse_result_frame(frame[0], frame[1:], stderr)
+        # no frame: the script failed before it could report, e.g. while resolving dependencies
+        return self.parse_execution_result(stdout, stderr, returncode)
+
+    def _write_batch(self, calls: list[tuple[tuple[Any, ...], dict[str, Any]]], concurrency: int) -> str:
+        with tempfile.NamedTemporaryFile(prefix="lilypad-batch-", suffix=".pkl", delete=False) as file:
+            file.write(self.encode_batch(calls, concurrency))
+        return file.name
+
+    def execute_batch(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> Iterator[Result | Exception]:
+        """Execute the whole batch in one subprocess, yielding results as they are produced."""
+        calls = list(calls)
+        if not calls:
+            return
+        script_path = self.script_path(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        command, lease = self._command(closure)
+        with lease:
+            arguments_path = self._write_batch(calls, concurrency)
+            try:
+                process = subprocess.Popen(
+                    [*command, str(script_path), arguments_path],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=self.environment,
+                )
+                stdout, stderr = cast(IO[bytes], process.stdout), cast(IO[bytes], process.stderr)
+                errors: deque[bytes] = deque(maxlen=256)
+                drain = threading.Thread(target=lambda: errors.extend(iter(stderr.readline, b"")), daemon=True)
+                drain.start()
+                try:
+                    yield from self.parse_batch_output(stdout, len(calls), lambda: b"".join(errors))
+                finally:
+                    if process.poll() is None:
+                        process.kill()  # the caller stopped iterating early
+                    process.wait()
+                    drain.join()
+                    stdout.close()
+                    stderr.close()
+            finally:
+                os.unlink(arguments_path)
+
+    async def execute_batch_async(
+        self,
+        closure: Closure,
+        calls: Iterable[tuple[tuple[Any, ...], dict[str, Any]]],
+        *,
+        concurrency: int = 1,
+        custom_result: dict[str, str] | None = None,
+        pre_actions: list[str] | None = None,
+        after_actions: list[str] | None = None,
+        extra_imports: list[str] | None = None,
+    ) -> AsyncIterator[Result | Exception]:
+        """Execute the whole batch in one subprocess without blocking the event loop."""
+        calls = list(calls)
+        if not calls:
+            return
+        script_path = self.script_path(
+            closure,
+            custom_result=custom_result,
+            pre_actions=pre_actions,
+            after_actions=after_actions,
+            extra_imports=extra_imports,
+        )
+        command, lease = await self._command_async(closure)
+        with lease:
+            arguments_path = self._write_batch(calls, concurrency)
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    str(script_path),
+                    arguments_path,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=self.environment,
+                    limit=_BATCH_LINE_LIMIT,
+                )
+                stdout, stderr = cast(asyncio.StreamReader, process.stdout), cast(asyncio.StreamReader, process.stderr)
+                errors: deque[bytes] = deque(maxlen=256)
+
+                async def drain() -> None:
+                    async for line in stderr:
+                        errors.append(line)
 
-            return self.parse_execution_result(result.stdout, result.stderr, result.returncode)
-        finally:
-            tmp_path.unlink()
+                draining = asyncio.create_task(drain())
+                try:
+                    received = 0
+                    async for line in stdout:
+                        if line.strip():
+                            yield self.parse_batch_line(line, b"".join(errors))
+                            received += 1
+                    await process.wait()
+                    await draining
+                    if received < len(calls):
+                        raise RuntimeError(
+                            f"Sandbox exited after {received} of {len(calls)} calls.\n"
+                            f"Stderr: {b''.join(errors).decode(errors='replace')}"
+                        )
+                finally:
+                    if process.returncode is None:
+                        with suppress(ProcessLookupError):
+                            process.kill()
+                        await process.wait()
+                    draining.cancel()
+            finally:
+                os.unlink(arguments_path)
@@ -3,7 +3,10 @@
 from __future__ import annotations
 
 import os
+import queue
+import asyncio
 import inspect
+import threading
 from types import MappingProxyType
 from typing import (
     Any,
@@ -13,12 +16,14 @@ from typing import (
     Protocol,
     ParamSpec,
     TypeAlias,
+    NamedTuple,
     overload,
 )
-from functools import wraps
-from contextlib import contextmanager
-from contextvars import ContextVar
-from collections.abc import Callable, Coroutine, Generator
+from functools import wraps, partial
+from itertools import islice
+from contextlib import closing, aclosing, suppress, contextmanager
+from contextvars import ContextVar, copy_context
+from collections.abc import Callable, Iterable, Iterator, Coroutine, Generator, AsyncIterator
 
 import orjson
 from pydantic import BaseModel
@@ -34,22 +39,26 @@ from ._utils import (
     get_qualified_name,
     create_mirascope_middleware,
 )
-from .sandbox import SandboxRunner, SubprocessSandboxRunner
+from .sandbox import SandboxRunner, SubprocessSandboxRunner, get_scheduler
 from .._client import Lilypad, AsyncLilypad
+from ._configure import current_traceparent, export_sandbox_spans
 from .exceptions import RemoteFunctionError
 from ._utils.json import to_text, json_dumps, fast_jsonable
 from .._exceptions import NotFoundError
 from ._utils.client import get_sync_client, get_async_client
+from .sandbox.runner import Result
 from ._utils.settings import get_settings
 from ._utils.functions import get_signature
 from ..types.ee.projects import Label, EvaluationType, annotation_create_params
 from ._utils.function_cache import (
     get_cached_closure,
-    get_function_by_hash_sync,
+    create_function_sync,
+    create_function_async,
     get_deployed_function_sync,
-    get_function_by_hash_async,
     get_deployed_function_async,
+    get_function_by_closure_sync,
     get_function_by_version_sync,
+    get_function_by_closure_async,
     get_function_by_version_async,
 )
 from ..types.projects.functions import FunctionPublic
@@ -304,6 +313,62 @@ def get_decorated_functions(decorator_name: str | None = None) -> DecoratorRegis
     return _DECORATOR_REGISTRY.copy()
 
 
+class SyncRemoteFunction(Protocol[_P, _R_CO]):
+    """Protocol for the `remote` attribute of a `VersionedFunction`."""
+
+    def __call__(
+        self,
+        sandbox_runner: SandboxRunner | None = None,
+    ) -> _R_CO:
+        """Protocol for the `VersionFunction` decorator return type."""
+        ...
+
+    def map(
+        self,
+        *iterables: Iterable[Any],
+        sandbox: SandboxRunner | None = None,
+        concurrency: int = 1,
+        batch_size: int = 1_000,
+        return_exceptions: bool = False,
+    ) -> Iterator[_R_CO]:
+        """Protocol for the batched `remote.map` call.
+
+        Results are yielded as the sandbox produces them. Each batch of
+        `batch_size` calls holds a scheduler slot until it finishes; if the
+        caller falls more than `_MAP_BUFFER_SIZE` results behind, the batch
+        waits for it while still holding the slot.
+        """
+        ...
+
+
+class AsyncRemoteFunction(Protocol[_P, _R_CO]):
+    """Protocol for the `remote` attribute of an async `VersionedFunction`."""
+
+    def __call__(
+        self,
+        sandbox_runner: SandboxRunner | None = None,
+    ) -> Coroutine[Any, Any, _R_CO]:
+        """Protocol for the `VersionFunction` decorator return type."""
+        ...
+
+    def map(
+        self,
+        *iterables: Iterable[Any],
+        sandbox: SandboxRunner | None = None,
+        concurrency: int = 1,
+        batch_size: int = 1_000,
+        return_exceptions: bool = False,
+    ) -> AsyncIterator[_R_CO]:
+        """Protocol for the batched `remote.map` call.
+
+        Results are yielded as the sandbox produces them. Each batch of
+        `batch_size` calls holds a scheduler slot until it finishes; if the
+        caller falls more than `_MAP_BUFFER_SIZE` results behind, the batch
+        waits for it while still holding the slot.
+        """
+        ...
+
+
 class SyncVersionedFunction(Protocol[_P, _R_CO]):
     """Protocol for the `VersionedFunction` decorator return type."""
 
@@ -319,10 +384,8 @@ class SyncVersionedFunction(Protocol[_P, _R_CO]):
         """Protocol for the `VersionFunction` decorator return type."""
         ...
 
-    def remote(
-        self,
-        sandbox_runner: SandboxRunner | None = None,
-    ) -> _R_CO:
+    @property
+    def remote(self) -> SyncRemoteFunction[_P, _R_CO]:
         """Protocol for the `VersionFunction` decorator return type."""
         ...
 
@@ -342,10 +405,16 @@ class AsyncVersionedFunction(Protocol[_P, _R_CO]):
         """Protocol for the `VersionFunction` decorator return type."""
         ...
 
-    def remote(
+    def version_async(
         self,
+        forced_version: int,
         sandbox_runner: SandboxRunner | None = None,
-    ) -> Coroutine[Any, Any, _R_CO]:
+    ) -> Coroutine[Any, Any, Callable[_P, Coroutine[Any, Any, _R_CO]]]:
+        """Like `version`, but the returned function runs the sandbox without blocking the event loop."""
+        ...
+
+    @property
+    def remote(self) -> AsyncRemoteFunction[_P, _R_CO]:
         """Protocol for the `VersionFunction` decorator return type."""
         ...
 
@@ -551,9 +620,17 @@ def _construct_trace_attributes(
 _SANDBOX_CUSTOM_RESULT = {
     "result": "result",
     "trace_context": "_get_trace_context()",
+    "spans": "_lilypad_collect_sandbox_spans()",
 }
 _SANDBOX_PRE_ACTIONS = [
-    "lilypad.configure(log_handlers=[logging.StreamHandler(sys.stderr)])",
+    "try:\n"
+    "    from lilypad.lib._configure import configure_sandbox as _lilypad_configure_sandbox\n"
+    "    from lilypad.lib._configure import propagate_context as _lilypad_propagate_context\n"
+    "    from lilypad.lib._configure import collect_sandbox_spans as _lilypad_collect_sandbox_spans\n"
+    "except ImportError:  # the sandbox runs a lilypad release without span propagation\n"
+    "    _lilypad_configure_sandbox, _lilypad_collect_sandbox_spans = lilypad.configure, list\n"
+    "    _lilypad_propagate_context = lambda fn: lambda *args, _lilypad_traceparent=None, **kwargs: fn(*args, **kwargs)",
+    "_lilypad_configure_sandbox(log_handlers=[logging.StreamHandler(sys.stderr)])",
 ]
 _SANDBOX_AFTER_ACTIONS = [
     "result = result.response if isinstance(result, AsyncTrace | Trace) else result",
@@ -569,6 +646,87 @@ _SANDBOX_EXTRA_IMPORT = [
 ]
 
 
+def _sandbox_pre_actions(closure: Closure) -> list[str]:
+    """Return the pre-actions that also run the closure's function in its caller's trace context."""
+    return [*_SANDBOX_PRE_ACTIONS, f"{closure.name} = _lilypad_propagate_context({closure.name})"]
+
+
+_MAP_BUFFER_SIZE = 64
+"""The number of `.remote.map()` results a running batch may get ahead of its caller by."""
+
+
+class _BatchFailure(NamedTuple):
+    """An error that ended a batch, as opposed to a call's exception yielded as its result."""
+
+    error: BaseException
+
+
+def _stream_batch(function_name: str, run: Callable[[], Iterator[Result | Exception]]) -> Iterator[Result | Exception]:
+    """Yield the results of the batch started by *run* as the sandbox produces them.
+
+    The batch runs in a thread that holds a scheduler slot for *function_name*
+    and hands its results over through a queue of `_MAP_BUFFER_SIZE`, so the
+    slot is not held while the caller processes results. Once the caller
+    stops iterating, the batch is closed and the slot released.
+    """
+    handoff: queue.Queue[Result | Exception | _BatchFailure | None] = queue.Queue(_MAP_BUFFER_SIZE)
+    stopped = threading.Event()
+
+    def produce() -> None:
+        try:
+            with get_scheduler().slot(function_name), closing(run()) as results:
+                for result in results:
+                    handoff.put(result)
+                    if stopped.is_set():
+                        return
+        except BaseException as e:
+            handoff.put(_BatchFailure(e))
+        else:
+            handoff.put(None)
+
+    producer = threading.Thread(target=copy_context().run, args=(produce,), daemon=True)
+    producer.start()
+    try:
+        while (item := handoff.get()) is not None:
+            if isinstance(item, _BatchFailure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        while producer.is_alive():  # unblock a producer waiting for room in the queue
+            with suppress(queue.Empty):
+                handoff.get(timeout=0.05)
+        producer.join()
+
+
+async def _stream_batch_async(
+    function_name: str, run: Callable[[], AsyncIterator[Result | Exception]]
+) -> AsyncIterator[Result | Exception]:
+    """Asynchronous version of `_stream_batch`, running the batch in a task."""
+    handoff: asyncio.Queue[Result | Exception | _BatchFailure | None] = asyncio.Queue(_MAP_BUFFER_SIZE)
+
+    async def produce() -> None:
+        try:
+            async with get_scheduler().slot_async(function_name), aclosing(run()) as results:
+                async for result in results:
+                    await handoff.put(result)
+        except Exception as e:
+            await handoff.put(_BatchFailure(e))
+        else:
+            await handoff.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await handoff.get()) is not None:
+            if isinstance(item, _BatchFailure):
+                raise item.error
+            yield item
+    finally:
+        producer.cancel()
+        with suppress(asyncio.CancelledError):
+            await producer
+
+
 @overload
 def trace(
     name: str | None = None,
@@ -656,7 +814,7 @@ def trace(
 
         if _RECORDING_ENABLED and versioning == "automatic":
             _register_decorated_function(
-                TRACE_MODULE_NAME, fn, Closure.from_fn(fn).name, {"mode": mode, "tags": decorator_tags}
+                TRACE_MODULE_NAME, fn, get_qualified_name(fn), {"mode": mode, "tags": decorator_tags}
             )
 
         local_serializers = serializers or {}
@@ -698,20 +856,22 @@ def trace(
                     @wraps(fn)
                     async def get_or_create_function_async() -> FunctionPublic | None:
                         try:
-                            return await get_function_by_hash_async(
-                                project_uuid=settings.project_id, function_hash=closure.hash
-                            )
+                            return await get_function_by_closure_async(settings.project_id, closure)
                         except NotFoundError:
-                            return await async_lilypad_client.projects.functions.create(
-                                path_project_uuid=settings.project_id,
-                                code=closure.code,
-                                hash=closure.hash,
-                                name=closure.name,
-                                signature=closure.signature,
-                                arg_types=arg_types,
-                                dependencies=closure.dependencies,
-                                is_versioned=True,
-                                prompt_template=prompt_template,
+                            return await create_function_async(
+                                settings.project_id,
+                                closure.hash,
+                                lambda: async_lilypad_client.projects.functions.create(
+                                    path_project_uuid=settings.project_id,
+                                    code=closure.code,
+                                    hash=closure.hash,
+                                    name=closure.name,
+                                    signature=closure.signature,
+                                    arg_types=arg_types,
+                                    dependencies=closure.dependencies,
+                                    is_versioned=True,
+                                    prompt_template=prompt_template,
+                                ),
                             )
 
                     if versioning == "automatic":
@@ -757,35 +917,74 @@ def trace(
 
             function_name = get_qualified_name(fn)
 
-            async def _specific_function_version_async(
-                forced_version: int,
-                sandbox: SandboxRunner | None = None,
-            ) -> Callable[_P, _R]:
+            async def _versioned_function_closure_async(forced_version: int) -> Closure:
                 try:
                     versioned_function = await get_function_by_version_async(
                         version_num=forced_version,
                         project_uuid=settings.project_id,
                         function_name=function_name,
                     )
-                    versioned_function_closure = get_cached_closure(versioned_function)
+                    return get_cached_closure(versioned_function)
                 except Exception as e:
                     raise RemoteFunctionError(f"Failed to retrieve function {fn.__name__}: {e}")
 
+            async def _specific_function_version_async(
+                forced_version: int,
+                sandbox: SandboxRunner | None = None,
+            ) -> Callable[_P, _R]:
+                versioned_function_closure = await _versioned_function_closure_async(forced_version)
+                if sandbox is None:
+                    sandbox = SubprocessSandboxRunner(os.environ.copy())
+
+                # A blocking callable; `version_async` returns a coroutine function instead. It has no
+                # local fallback, since running the coroutine function `fn` would need an event loop.
+                @wraps(fn)
+                def _inner_version(*args: _P.args, **kwargs: _P.kwargs) -> _R:
+                    with get_scheduler().slot(function_name):
+                        result = sandbox.execute_function(
+                            versioned_function_closure,
+                            *args,
+                            custom_result=_SANDBOX_CUSTOM_RESULT,
+                            pre_actions=_sandbox_pre_actions(versioned_function_closure),
+                            after_actions=_SANDBOX_AFTER_ACTIONS,
+                            extra_imports=_SANDBOX_EXTRA_IMPORT,
+                            _lilypad_traceparent=current_traceparent(),
+                            **kwargs,
+                        )
+                    export_sandbox_spans(result["spans"])
+                    if mode == "wrap":
+                        return AsyncTrace(
+                            response=result["result"],
+                            span_id=result["trace_context"]["span_id"],
+                            function_uuid=result["trace_context"]["function_uuid"],
+                        )  # pyright: ignore [reportReturnType]
+                    return result["result"]
+
+                return _inner_version
+
+            async def _specific_function_version_coroutine(
+                forced_version: int,
+                sandbox: SandboxRunner | None = None,
+            ) -> Callable[_P, Coroutine[Any, Any, _R]]:
+                versioned_function_closure = await _versioned_function_closure_async(forced_version)
                 if sandbox is None:
                     sandbox = SubprocessSandboxRunner(os.environ.copy())
 
                 @call_safely(fn)  # pyright: ignore [reportArgumentType]
                 @wraps(fn)
-                def _inner_async(*args: _P.args, **kwargs: _P.kwargs) -> _R:
-                    result = sandbox.execute_function(
-                        versioned_function_closure,
-                        *args,
-                        custom_result=_SANDBOX_CUSTOM_RESULT,
-                        pre_actions=_SANDBOX_PRE_ACTIONS,
-                        after_actions=_SANDBOX_AFTER_ACTIONS,
-                        extra_imports=_SANDBOX_EXTRA_IMPORT,
-                        **kwargs,
-                    )
+                async def _inner_async(*args: _P.args, **kwargs: _P.kwargs) -> _R:
+                    async with get_scheduler().slot_async(function_name):
+                        result = await sandbox.execute_function_async(
+                            versioned_function_closure,
+                            *args,
+                            custom_result=_SANDBOX_CUSTOM_RESULT,
+                            pre_actions=_sandbox_pre_actions(versioned_function_closure),
+                            after_actions=_SANDBOX_AFTER_ACTIONS,
+                            extra_imports=_SANDBOX_EXTRA_IMPORT,
+                            _lilypad_traceparent=current_traceparent(),
+                            **kwargs,
+                        )
+                    export_sandbox_spans(result["spans"])
                     if mode == "wrap":
                         return AsyncTrace(
                             response=result["result"],
@@ -796,6 +995,7 @@ def trace(
 
                 return _inner_async
 
+            inner_async.version_async = _specific_function_version_coroutine  # pyright: ignore [reportAttributeAccessIssue, reportFunctionMemberAccess]
             inner_async.version = _specific_function_version_async  # pyright: ignore [reportAttributeAccessIssue, reportFunctionMemberAccess]
 
             async def _deployed_version_async(
@@ -819,15 +1019,18 @@ def trace(
                 if sandbox is None:
                     sandbox = SubprocessSandboxRunner(os.environ.copy())
 
-                result = sandbox.execute_function(
-                    deployed_function_closure,
-                    *args,
-                    custom_result=_SANDBOX_CUSTOM_RESULT,
-                    pre_actions=_SANDBOX_PRE_ACTIONS,
-                    after_actions=_SANDBOX_AFTER_ACTIONS,
-                    extra_imports=_SANDBOX_EXTRA_IMPORT,
-                    **kwargs,
-                )
+                async with get_scheduler().slot_async(function_name):
+                    result = await sandbox.execute_function_async(
+                        deployed_function_closure,
+                        *args,
+                        custom_result=_SANDBOX_CUSTOM_RESULT,
+                        pre_actions=_sandbox_pre_actions(deployed_function_closure),
+                        after_actions=_SANDBOX_AFTER_ACTIONS,
+                        extra_imports=_SANDBOX_EXTRA_IMPORT,
+                        _lilypad_traceparent=current_traceparent(),
+                        **kwargs,
+                    )
+                export_sandbox_spans(result["spans"])
                 if mode == "wrap":
                     return AsyncTrace(
                         response=result["result"],
@@ -836,6 +1039,63 @@ def trace(
                     )
                 return result["result"]
 
+            async def _deployed_version_map_async(
+                *iterables: Iterable[Any],
+                sandbox: SandboxRunner | None = None,
+                concurrency: int = 1,
+                batch_size: int = 1_000,
+                return_exceptions: bool = False,
+                ttl: float | None = None,
+                force_refresh: bool = False,
+            ) -> AsyncIterator[_R | Exception]:
+                try:
+                    deployed_function = await get_deployed_function_async(
+                        project_uuid=settings.project_id,
+                        ttl=ttl,
+                        force_refresh=force_refresh,
+                        function_name=function_name,
+                    )
+                    deployed_function_closure = get_cached_closure(deployed_function)
+                except Exception as e:
+                    raise RemoteFunctionError(f"Failed to retrieve function {fn.__name__}: {e}")
+
+                if sandbox is None:
+                    sandbox = SubprocessSandboxRunner(os.environ.copy())
+
+                traceparent = current_traceparent()
+                calls = ((args, {"_lilypad_traceparent": traceparent}) for args in zip(*iterables, strict=False))
+                while batch := list(islice(calls, batch_size)):
+                    results = _stream_batch_async(
+                        function_name,
+                        partial(
+                            sandbox.execute_batch_async,
+                            deployed_function_closure,
+                            batch,
+                            concurrency=concurrency,
+                            custom_result=_SANDBOX_CUSTOM_RESULT,
+                            pre_actions=_sandbox_pre_actions(deployed_function_closure),
+                            after_actions=_SANDBOX_AFTER_ACTIONS,
+                            extra_imports=_SANDBOX_EXTRA_IMPORT,
+                        ),
+                    )
+                    async with aclosing(results):
+                        async for result in results:
+                            if isinstance(result, Exception):
+                                if not return_exceptions:
+                                    raise result
+                                yield result
+                                continue
+                            export_sandbox_spans(result["spans"])
+                            if mode == "wrap":
+                                yield AsyncTrace(
+                                    response=result["result"],
+                                    span_id=result["trace_context"]["span_id"],
+                                    function_uuid=result["trace_context"]["function_uuid"],
+                                )
+                            else:
+                                yield result["result"]
+
+            _deployed_version_async.map = _deployed_version_map_async  # pyright: ignore [reportFunctionMemberAccess]
             inner_async.remote = _deployed_version_async
             return inner_async
         else:
@@ -868,20 +1128,22 @@ def trace(
                     @wraps(fn)
                     def get_or_create_function_sync() -> FunctionPublic | None:
                         try:
-                            return get_function_by_hash_sync(
-                                project_uuid=settings.project_id, function_hash=closure.hash
-                            )
+                            return get_function_by_closure_sync(settings.project_id, closure)
                         except NotFoundError:
-                            return lilypad_client.projects.functions.create(
-                                path_project_uuid=settings.project_id,
-                                code=closure.code,
-                                hash=closure.hash,
-                                name=closure.name,
-                                signature=closure.signature,
-                                arg_types=arg_types,
-                                dependencies=closure.dependencies,
-                                is_versioned=True,
-                                prompt_template=prompt_template,
+                            return create_function_sync(
+                                settings.project_id,
+                                closure.hash,
+                                lambda: lilypad_client.projects.functions.create(
+                                    path_project_uuid=settings.project_id,
+                                    code=closure.code,
+                                    hash=closure.hash,
+                                    name=closure.name,
+                                    signature=closure.signature,
+                                    arg_types=arg_types,
+                                    dependencies=closure.dependencies,
+                                    is_versioned=True,
+                                    prompt_template=prompt_template,
+                                ),
                             )
 
                     if versioning == "automatic":
@@ -953,15 +1215,18 @@ def trace(
                 @call_safely(fn)  # pyright: ignore [reportArgumentType]
                 @wraps(fn)
                 def _inner(*args: _P.args, **kwargs: _P.kwargs) -> _R:
-                    result = sandbox.execute_function(
-                        versioned_function_closure,
-                        *args,
-                        custom_result=_SANDBOX_CUSTOM_RESULT,
-                        pre_actions=_SANDBOX_PRE_ACTIONS,
-                        after_actions=_SANDBOX_AFTER_ACTIONS,
-                        extra_imports=_SANDBOX_EXTRA_IMPORT,
-                        **kwargs,
-                    )
+                    with get_scheduler().slot(function_name):
+                        result = sandbox.execute_function(
+                            versioned_function_closure,
+                            *args,
+                            custom_result=_SANDBOX_CUSTOM_RESULT,
+                            pre_actions=_sandbox_pre_actions(versioned_function_closure),
+                            after_actions=_SANDBOX_AFTER_ACTIONS,
+                            extra_imports=_SANDBOX_EXTRA_IMPORT,
+                            _lilypad_traceparent=current_traceparent(),
+                            **kwargs,
+                        )
+                    export_sandbox_spans(result["spans"])
                     if mode == "wrap":
                         return Trace(
                             response=result["result"],
@@ -995,15 +1260,18 @@ def trace(
                 if sandbox is None:
                     sandbox = SubprocessSandboxRunner(os.environ.copy())
 
-                result = sandbox.execute_function(
-                    deployed_function_closure,
-                    *args,
-                    custom_result=_SANDBOX_CUSTOM_RESULT,
-                    pre_actions=_SANDBOX_PRE_ACTIONS,
-                    after_actions=_SANDBOX_AFTER_ACTIONS,
-                    extra_imports=_SANDBOX_EXTRA_IMPORT,
-                    **kwargs,
-                )
+                with get_scheduler().slot(function_name):
+                    result = sandbox.execute_function(
+                        deployed_function_closure,
+                        *args,
+                        custom_result=_SANDBOX_CUSTOM_RESULT,
+                        pre_actions=_sandbox_pre_actions(deployed_function_closure),
+                        after_actions=_SANDBOX_AFTER_ACTIONS,
+                        extra_imports=_SANDBOX_EXTRA_IMPORT,
+                        _lilypad_traceparent=current_traceparent(),
+                        **kwargs,
+                    )
+                export_sandbox_spans(result["spans"])
                 if mode == "wrap":
                     return Trace(
                         response=result["result"],
@@ -1012,6 +1280,63 @@ def trace(
                     )
                 return result["result"]
 
+            def _deployed_version_map(
+                *iterables: Iterable[Any],
+                sandbox: SandboxRunner | None = None,
+                concurrency: int = 1,
+                batch_size: int = 1_000,
+                return_exceptions: bool = False,
+                ttl: float | None = None,
+                force_refresh: bool = False,
+            ) -> Iterator[_R | Exception]:
+                try:
+                    deployed_function = get_deployed_function_sync(
+                        project_uuid=settings.project_id,
+                        ttl=ttl,
+                        force_refresh=force_refresh,
+                        function_name=function_name,
+                    )
+                    deployed_function_closure = get_cached_closure(deployed_function)
+                except Exception as e:
+                    raise RemoteFunctionError(f"Failed to retrieve function {fn.__name__}: {e}")
+
+                if sandbox is None:
+                    sandbox = SubprocessSandboxRunner(os.environ.copy())
+
+                traceparent = current_traceparent()
+                calls = ((args, {"_lilypad_traceparent": traceparent}) for args in zip(*iterables, strict=False))
+                while batch := list(islice(calls, batch_size)):
+                    results = _stream_batch(
+                        function_name,
+                        partial(
+                            sandbox.execute_batch,
+                            deployed_function_closure,
+                            batch,
+                            concurrency=concurrency,
+                            custom_result=_SANDBOX_CUSTOM_RESULT,
+                            pre_actions=_sandbox_pre_actions(deployed_function_closure),
+                            after_actions=_SANDBOX_AFTER_ACTIONS,
+                            extra_imports=_SANDBOX_EXTRA_IMPORT,
+                        ),
+                    )
+                    with closing(results):
+                        for result in results:
+                            if isinstance(result, Exception):
+                                if not return_exceptions:
+                                    raise result
+                                yield result
+                                continue
+                            export_sandbox_spans(result["spans"])
+                            if mode == "wrap":
+                                yield Trace(
+                                    response=result["result"],
+                                    span_id=result["trace_context"]["span_id"],
+                                    function_uuid=result["trace_context"]["function_uuid"],
+                                )
+                            else:
+                                yield result["result"]
+
+            _deployed_version.map = _deployed_version_map  # pyright: ignore [reportFunctionMemberAccess]
             inner.remote = _deployed_version
             return inner
 
@@ -1,17 +1,29 @@
 """Tests for the `Closure` class"""
 
 import os
+import ast
 import sys
+import hashlib
 import inspect
 import subprocess
 import importlib.metadata
 from uuid import UUID
+from types import ModuleType
 from unittest.mock import Mock
 from collections.abc import Callable
 
 import pytest
 
 from lilypad.lib._utils import Closure, get_qualified_name
+from lilypad.lib._utils.closure import (
+    _module_source,
+    _canonical_hash,
+    _QualifiedNameRewriter,
+    _get_distribution_index,
+    _clean_source_from_string,
+    _get_class_from_unbound_method,
+)
+from lilypad.lib._utils.settings import get_settings
 
 from .closure_test_functions import (
     sub_fn,
@@ -598,12 +610,12 @@ def test_instance_method_on_local() -> None:
 
 
 def test_from_fn_failure(monkeypatch):
-    """Test that Closure.from_fn propagates exceptions from _run_ruff."""
+    """Test that Closure.from_fn propagates exceptions from _run_ruff_batch."""
 
-    def fake_run_ruff(code: str) -> str:
+    def fake_run_ruff_batch(codes: list[str]) -> list[str]:
         raise RuntimeError("Ruff failed")
 
-    monkeypatch.setattr("lilypad.lib._utils.closure._run_ruff", fake_run_ruff)
+    monkeypatch.setattr("lilypad.lib._utils.closure._run_ruff_batch", fake_run_ruff_batch)
 
     def dummy_func(x):
         return x
@@ -659,6 +671,79 @@ def test_run_ruff_exit_code_1(monkeypatch):
     assert closure.code.endswith("def dummy(): ...")
 
 
+def test_from_fn_formats_code_and_signature_in_one_batch(monkeypatch):
+    """Test that the code and the signature share one ruff check and one ruff format."""
+    mock_run = Mock(return_value=subprocess.CompletedProcess(args=["ruff"], returncode=0, stdout="", stderr=""))
+    monkeypatch.setattr("subprocess.run", mock_run)
+
+    def dummy_batch(x: int) -> int:
+        return x
+
+    Closure.from_fn(dummy_batch)
+    assert mock_run.call_count == 2
+    assert all(len([arg for arg in call.args[0] if arg.endswith(".py")]) == 2 for call in mock_run.call_args_list)
+
+
+def test_canonical_hash_ignores_formatting() -> None:
+    """Test that the hash does not depend on formatting, import order or docstring indentation."""
+    code = 'import sys\nfrom os import path, sep\n\ndef fn(a,b):\n    """Doc.\n\n    More."""\n    return (a+b)\n'
+    reformatted = (
+        "from os import sep\nfrom os import path\nimport sys\n\n\n"
+        'def fn(a, b):\n    """Doc.\n\n        More."""\n    return a + b\n'
+    )
+    assert _canonical_hash(code) == _canonical_hash(reformatted)
+    assert _canonical_hash(code) != _canonical_hash(code.replace("a+b", "a-b"))
+    assert _canonical_hash(code) != _canonical_hash(code.replace("More.", "Less."))
+
+
+def test_clean_source_keeps_formatting() -> None:
+    """Test that docstrings are removed without reformatting the rest of the code."""
+    source = (
+        "class A:  # header\n"
+        '    """Doc."""\n\n'
+        "    @dec(lambda a: a[1:2])\n"
+        "    def f(self, x):  # trailing\n"
+        '        """Doc."""\n'
+        "        # kept\n"
+        "        return (x+1)\n\n"
+        "    async def g(self):\n"
+        "        '''Doc.'''\n"
+    )
+    assert _clean_source_from_string(source) == (
+        "class A:  # header\n\n"
+        "    @dec(lambda a: a[1:2])\n"
+        "    def f(self, x):  # trailing\n"
+        "        # kept\n"
+        "        return (x+1)\n\n"
+        "    async def g(self):..."
+    )
+    assert _clean_source_from_string(source, exclude_fn_body=True) == "class A:  # header\n    pass"
+    assert _clean_source_from_string("def f(): 'not a docstring'\n") == "def f(): 'not a docstring'"
+
+
+def test_qualified_name_rewriter() -> None:
+    """Test that qualified local names are collapsed and aliases resolved in place."""
+    rewriter = _QualifiedNameRewriter({"helper"}, {"from mod import original as alias"})
+    code = 'def fn(x):\n    # mod.helper\n    return pkg.mod.helper(alias(x)), f"{alias}", pkg.other\n'
+    assert (
+        rewriter.rewrite(code)
+        == 'def fn(x):\n    # mod.helper\n    return helper(original(x)), f"{original}", pkg.other\n'
+    )
+
+
+def test_qualified_name_rewriter_fstrings() -> None:
+    """Test that names inside f-string replacement fields are rewritten, but not the literal text."""
+    rewriter = _QualifiedNameRewriter({"helper"}, {"from mod import original as alias"})
+    code = (
+        "x = f'alias {{alias}} {alias!r:>{alias}} {pkg.helper(y)[\"k\"]} {alias=} {alias != 1}'\n"
+        "y = f'''\n{\n  alias\n} {f\"{alias}\"}'''\n"
+    )
+    assert rewriter.rewrite(code) == (
+        "x = f'alias {{alias}} {original!r:>{original}} {helper(y)[\"k\"]} {original=} {original != 1}'\n"
+        "y = f'''\n{\n  original\n} {f\"{original}\"}'''\n"
+    )
+
+
 def test_module_without_qualname_time():
     """Test the `Closure` class with a module that doesn't have __qualname__ attribute (time)."""
 
@@ -675,3 +760,117 @@ def test_module_without_qualname_random():
     assert closure.code == _expected(fn_using_random_module)
     assert "random" in closure.code
     assert closure.dependencies == {}
+
+
+class _Outer:
+    class Inner:
+        def method(self) -> None: ...
+
+
+_Alias = _Outer.Inner
+
+
+def test_get_class_from_unbound_method_uses_module(monkeypatch):
+    """Test that classes are resolved through their module without scanning every object."""
+    monkeypatch.setattr("gc.get_objects", Mock(side_effect=AssertionError("gc scan")))
+    assert _get_class_from_unbound_method(_Outer.Inner.method) is _Outer.Inner
+    assert _get_class_from_unbound_method(Chatbot.__init__) is Chatbot
+
+    # found through the module's class index when the qualified name no longer resolves
+    monkeypatch.delattr(sys.modules[__name__], "_Outer")
+    assert _get_class_from_unbound_method(_Alias.method) is _Alias
+
+
+def test_get_class_from_unbound_method_local_class():
+    """Test that classes defined inside functions are still found."""
+
+    class Local:
+        def method(self) -> None: ...
+
+    assert _get_class_from_unbound_method(Local.method) is Local
+
+
+def test_module_source_cached_by_mtime(tmp_path, monkeypatch):
+    """Test that a module is parsed once until its file changes."""
+    path = tmp_path / "cached_module.py"
+    path.write_text("x = 1\n")
+    module = ModuleType("cached_module")
+    module.__file__ = str(path)
+    parse = Mock(wraps=ast.parse)
+    monkeypatch.setattr("ast.parse", parse)
+
+    source, tree = _module_source(module)
+    assert source == "x = 1\n"
+    assert _module_source(module) == (source, tree)
+    assert parse.call_count == 1
+
+    path.write_text("x = 2\n")
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000))
+    assert _module_source(module)[0] == "x = 2\n"
+    assert parse.call_count == 2
+
+
+def test_distribution_index_rebuilt_when_sys_path_changes(monkeypatch, tmp_path):
+    """Test that installed distributions are indexed once per `sys.path`."""
+    index = _get_distribution_index()
+    assert _get_distribution_index() is index
+    extras = index.extras(index.installed["mirascope"])
+    assert index.extras(index.installed["mirascope"]) == extras
+
+    monkeypatch.setattr(sys, "path", [*sys.path, str(tmp_path)])
+    assert _get_distribution_index() is not index
+
+
+def test_definition_hashes_are_shared_across_closures():
+    """Test that a definition has the same Merkle hash in every closure that includes it."""
+    Closure.from_fn.cache_clear()
+    inner = Closure.from_fn(inner_sub_fn)
+    sub = Closure.from_fn(sub_fn)
+    assert set(inner.definition_hashes) == {"single_fn", "sub_fn", "inner_sub_fn"}
+    assert inner.definition_hashes["sub_fn"] == sub.definition_hashes["sub_fn"]
+    assert inner.definition_hashes["single_fn"] == Closure.from_fn(single_fn).definition_hashes["single_fn"]
+    assert len({inner.hash, sub.hash, *inner.definition_hashes.values()}) == 5
+
+
+def test_legacy_hash_is_hash_of_formatted_code():
+    """Test that a closure keeps the version 1 hash, the SHA-256 hash of its formatted code."""
+    closure = Closure.from_fn(single_fn)
+    assert closure.legacy_hash == hashlib.sha256(closure.code.encode("utf-8")).hexdigest()
+    assert closure.legacy_hash != closure.hash
+
+
+def test_from_fns_matches_from_fn(caplog):
+    """Test that closures built in a process pool equal those built one by one, in input order."""
+
+    def local_fn() -> str:
+        return sub_fn()
+
+    fns = [inner_sub_fn, local_fn, sub_fn, inner_sub_fn]
+    Closure.from_fn.cache_clear()
+    closures = Closure.from_fns(fns, workers=2)
+    assert closures == [Closure.from_fn(fn) for fn in fns]
+    assert [record.args[0] for record in caplog.records if record.name == "lilypad.lib._utils.closure"] == [  # pyright: ignore [reportOptionalSubscript]
+        get_qualified_name(local_fn)
+    ]
+    assert Closure.from_fns([]) == []
+
+
+def test_from_fn_cache_keyed_by_code(monkeypatch):
+    """Test that re-created functions hit the cache and that its size is bounded."""
+
+    def make(value: int) -> Callable[[], int]:
+        def made() -> int:
+            return value
+
+        return made
+
+    Closure.from_fn.cache_clear()
+    first = Closure.from_fn(make(1))
+    assert Closure.from_fn(make(2)) is first
+    info = Closure.from_fn.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+
+    monkeypatch.setattr(get_settings(), "closure_cache_size", 1)
+    Closure.from_fn(sub_fn)
+    assert Closure.from_fn.cache_info().currsize == 1
+    assert Closure.from_fn(make(3)) is not first
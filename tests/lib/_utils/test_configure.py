@@ -1,5 +1,17 @@
+import orjson
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+
 from lilypad import configure
-from lilypad.lib._configure import lilypad_config
+from lilypad.lib import _configure
+from lilypad.lib._configure import (
+    lilypad_config,
+    propagate_context,
+    current_traceparent,
+    export_sandbox_spans,
+    _CollectingSpanExporter,
+)
 from lilypad.lib._utils.settings import get_settings
 
 
@@ -14,3 +26,51 @@ def test_configure_and_ctx():
 
     outer = get_settings()
     assert (outer.api_key, outer.project_id) == ("A", "P1")
+
+
+def _provider() -> tuple[TracerProvider, _CollectingSpanExporter]:
+    exporter = _CollectingSpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    return provider, exporter
+
+
+@pytest.mark.asyncio
+async def test_propagate_context_parents_sandbox_spans():
+    provider, exporter = _provider()
+    tracer = provider.get_tracer("test")
+
+    def fn(x: int) -> int:
+        with tracer.start_as_current_span("child"):
+            return x + 1
+
+    async def afn(x: int) -> int:
+        with tracer.start_as_current_span("async-child"):
+            return x * 2
+
+    with tracer.start_as_current_span("parent") as parent:
+        traceparent = current_traceparent()
+    assert traceparent is not None
+
+    assert propagate_context(fn)(1, _lilypad_traceparent=traceparent) == 2
+    assert await propagate_context(afn)(2, _lilypad_traceparent=traceparent) == 4
+    assert propagate_context(fn)(3) == 4
+
+    _, child, async_child, orphan = exporter.collect()
+    parent_span_id = f"{parent.get_span_context().span_id:016x}"
+    assert child["parent_span_id"] == async_child["parent_span_id"] == parent_span_id
+    assert child["trace_id"] == f"{parent.get_span_context().trace_id:032x}"
+    assert orphan["parent_span_id"] is None
+    assert exporter.collect() == []
+
+
+def test_export_sandbox_spans_rebuilds_spans(monkeypatch: pytest.MonkeyPatch):
+    provider, exporter = _provider()
+    with provider.get_tracer("test").start_as_current_span("remote", attributes={"lilypad.type": "function"}) as span:
+        span.add_event("step", {"n": 1})
+    (data,) = exporter.collect()
+
+    received = _CollectingSpanExporter()
+    monkeypatch.setattr(_configure, "_span_processor", SimpleSpanProcessor(received))
+    export_sandbox_spans([orjson.loads(orjson.dumps(data))])
+    assert received.collect() == [data]
@@ -0,0 +1,179 @@
+"""Tests for lilypad._utils.disk_cache module."""
+
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+
+from lilypad.lib._utils import disk_cache, function_cache
+from lilypad.lib._configure import lilypad_config
+from lilypad.lib._utils.disk_cache import FunctionDiskCache
+from lilypad.types.projects.functions import FunctionPublic
+
+
+def _function(version_num: int = 1) -> FunctionPublic:
+    return FunctionPublic(
+        code="def fn(): ...",
+        hash="hash",
+        name="fn",
+        signature="def fn(): ...",
+        uuid=f"uuid-{version_num}",
+        version_num=version_num,
+    )
+
+
+def test_disk_cache_is_shared_between_instances(tmp_path: Path) -> None:
+    """Values stored by one instance are visible to another on the same file."""
+    writer = FunctionDiskCache(tmp_path / "cache.sqlite")
+    reader = FunctionDiskCache(tmp_path / "cache.sqlite")
+    writer.set("hash", ("p", "h"), _function())
+    hit = reader.get("hash", ("p", "h"))
+    assert hit is not None and hit[1] == _function()
+    assert reader.get("hash", ("p", "other")) is None
+    writer.close()
+    reader.close()
+
+
+def test_disk_cache_respects_max_age(tmp_path: Path) -> None:
+    """Entries older than `max_age` are treated as missing."""
+    cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+    cache.set("deployed", ("p", "fn"), _function())
+    assert cache.get("deployed", ("p", "fn"), max_age=60) is not None
+    time.sleep(0.02)
+    assert cache.get("deployed", ("p", "fn"), max_age=0.01) is None
+    cache.close()
+
+
+def test_disk_cache_delete_prefix(tmp_path: Path) -> None:
+    """Prefix deletes only remove keys that start with the given parts."""
+    cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+    cache.set("deployed", ("p", "a"), _function())
+    cache.set("deployed", ("pp", "a"), _function())
+    cache.delete("deployed", ("p",), prefix=True)
+    assert cache.get("deployed", ("p", "a")) is None
+    assert cache.get("deployed", ("pp", "a")) is not None
+    cache.close()
+
+
+def test_disk_cache_coalesces_concurrent_fetches(tmp_path: Path) -> None:
+    """Concurrent misses from separate instances produce a single fetch."""
+    calls = 0
+
+    def fetch() -> FunctionPublic:
+        nonlocal calls
+        calls += 1
+        time.sleep(0.2)
+        return _function()
+
+    results: list[FunctionPublic | None] = []
+
+    def worker() -> None:
+        cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+        results.append(cache.get_or_fetch("hash", ("p", "h"), fetch)[1])
+        cache.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == 1
+    assert results == [_function()] * 4
+
+
+def test_disk_cache_claim_does_not_block_reads(tmp_path: Path) -> None:
+    """A claim waiting for the database write lock does not hold up lookups from other threads."""
+    cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+    cache.set("hash", ("p", "h"), _function())
+    other = sqlite3.connect(tmp_path / "cache.sqlite", isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    claim = threading.Thread(target=cache._claim, args=("hash", "k"))
+    claim.start()
+    try:
+        time.sleep(0.1)  # let the claim start waiting
+        start = time.monotonic()
+        assert cache.get("hash", ("p", "h")) is not None
+        assert time.monotonic() - start < 1
+    finally:
+        other.execute("COMMIT")
+        other.close()
+        claim.join()
+        cache.close()
+
+
+def test_get_disk_cache_keeps_one_instance_per_path(tmp_path: Path) -> None:
+    """Each path keeps one open cache however many paths are used, and a closed one is reopened."""
+    caches = []
+    for i in range(10):
+        with lilypad_config(function_cache_path=str(tmp_path / f"cache-{i}.sqlite")):
+            caches.append(disk_cache.get_disk_cache())
+    with lilypad_config(function_cache_path=str(tmp_path / "cache-0.sqlite")):
+        assert disk_cache.get_disk_cache() is caches[0]
+        caches[0].close()  # pyright: ignore [reportOptionalMemberAccess]
+        reopened = disk_cache.get_disk_cache()
+        assert reopened is not None and reopened is not caches[0]
+        caches[0] = reopened
+    for cache in caches:
+        cache.close()  # pyright: ignore [reportOptionalMemberAccess]
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd")
+def test_disk_cache_does_not_leak_connections(tmp_path: Path) -> None:
+    """Short-lived threads share the cache's connection instead of opening their own."""
+    cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+    cache.set("hash", ("p", "h"), _function())
+    open_fds = len(os.listdir("/proc/self/fd"))
+    for _ in range(50):
+        thread = threading.Thread(target=cache.get, args=("hash", ("p", "h")))
+        thread.start()
+        thread.join()
+    assert len(os.listdir("/proc/self/fd")) <= open_fds
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_async_does_not_block_event_loop(tmp_path: Path) -> None:
+    """The asynchronous fetch runs its database calls outside the event loop's thread."""
+    cache = FunctionDiskCache(tmp_path / "cache.sqlite")
+    loop_thread = threading.get_ident()
+    threads: set[int] = set()
+    execute = cache._conn.execute
+
+    class _Connection:
+        def execute(self, *args: object) -> object:
+            threads.add(threading.get_ident())
+            return execute(*args)
+
+        def close(self) -> None:
+            pass
+
+    cache._conn = _Connection()  # pyright: ignore [reportAttributeAccessIssue]
+
+    async def fetch() -> FunctionPublic:
+        await asyncio.sleep(0)
+        return _function()
+
+    assert (await cache.get_or_fetch_async("hash", ("p", "h"), fetch))[1] == _function()
+    assert threads and loop_thread not in threads
+    cache.close()
+    execute.__self__.close()
+
+
+def test_function_cache_uses_disk_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Version lookups are served from disk after the in-process cache is cleared."""
+    client = Mock()
+    client.projects.functions.name.retrieve_by_version.return_value = _function()
+    monkeypatch.setattr(function_cache, "get_sync_client", lambda: client)
+    with lilypad_config(function_cache_path=str(tmp_path / "cache.sqlite")):
+        function_cache.get_function_by_version_sync.cache_clear()
+        assert function_cache.get_function_by_version_sync("p", "fn", 1) == _function()
+        function_cache.get_function_by_version_sync.cache_clear()
+        assert function_cache.get_function_by_version_sync("p", "fn", 1) == _function()
+        function_cache.get_function_by_version_sync.cache_clear()
+        disk_cache.get_disk_cache().close()  # pyright: ignore [reportOptionalMemberAccess]
+    assert client.projects.functions.name.retrieve_by_version.call_count == 1
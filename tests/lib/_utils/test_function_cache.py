@@ -0,0 +1,249 @@
+"""Tests for lilypad._utils.function_cache module."""
+
+import time
+import asyncio
+import threading
+from typing import Any
+from unittest.mock import Mock, AsyncMock
+
+import httpx
+import pytest
+
+from lilypad.lib._utils import Closure, function_cache
+from lilypad._exceptions import NotFoundError
+from lilypad.types.projects.functions import FunctionPublic
+
+
+def _function(version_num: int) -> FunctionPublic:
+    return FunctionPublic(
+        code="def fn(): ...",
+        hash=f"hash-{version_num}",
+        name="fn",
+        signature="def fn(): ...",
+        uuid=f"uuid-{version_num}",
+        version_num=version_num,
+    )
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    caches = (
+        function_cache._deployed_cache,
+        function_cache._deployed_refreshing,
+        function_cache._hash_cache,
+        function_cache._not_found_cache,
+        function_cache._create_sync_futures,
+    )
+    for cache in caches:
+        cache.clear()
+    yield
+    for cache in caches:
+        cache.clear()
+
+
+@pytest.fixture
+def sync_client(monkeypatch: pytest.MonkeyPatch) -> Mock:
+    client = Mock()
+    monkeypatch.setattr(function_cache, "get_sync_client", lambda: client)
+    return client
+
+
+@pytest.fixture
+def async_client(monkeypatch: pytest.MonkeyPatch) -> Mock:
+    client = Mock()
+    client.projects.functions.name.retrieve_deployed = AsyncMock()
+    monkeypatch.setattr(function_cache, "get_async_client", lambda: client)
+    return client
+
+
+def _age(key: tuple[str, str], seconds: float) -> None:
+    ts, fn = function_cache._deployed_cache[key]
+    function_cache._deployed_cache[key] = (ts - seconds, fn)
+
+
+def test_deployed_fresh_entry_is_cached(sync_client: Mock) -> None:
+    """A fresh entry is served without calling the API again."""
+    sync_client.projects.functions.name.retrieve_deployed.return_value = _function(1)
+    first = function_cache.get_deployed_function_sync("p", "fn", ttl=30, jitter=0)
+    second = function_cache.get_deployed_function_sync("p", "fn", ttl=30, jitter=0)
+    assert first is second
+    assert sync_client.projects.functions.name.retrieve_deployed.call_count == 1
+
+
+def test_deployed_stale_entry_is_served_while_refreshing(sync_client: Mock) -> None:
+    """A stale entry is returned immediately and refreshed in the background."""
+    refreshed = threading.Event()
+
+    def retrieve_deployed(**_: Any) -> FunctionPublic:
+        if sync_client.projects.functions.name.retrieve_deployed.call_count > 1:
+            refreshed.set()
+            return _function(2)
+        return _function(1)
+
+    sync_client.projects.functions.name.retrieve_deployed.side_effect = retrieve_deployed
+    function_cache.get_deployed_function_sync("p", "fn", ttl=30, jitter=0)
+    _age(("p", "fn"), 40)
+
+    stale = function_cache.get_deployed_function_sync("p", "fn", ttl=30, max_stale=60, jitter=0)
+    assert stale.version_num == 1
+    assert refreshed.wait(timeout=5)
+    for thread in threading.enumerate():
+        if thread.name == "LilypadDeployedRefresh":
+            thread.join(timeout=5)
+    fresh = function_cache.get_deployed_function_sync("p", "fn", ttl=30, max_stale=60, jitter=0)
+    assert fresh.version_num == 2
+
+
+def test_deployed_entry_past_max_stale_blocks(sync_client: Mock) -> None:
+    """An entry older than the TTL plus `max_stale` is fetched synchronously."""
+    sync_client.projects.functions.name.retrieve_deployed.side_effect = [_function(1), _function(2)]
+    function_cache.get_deployed_function_sync("p", "fn", ttl=30, jitter=0)
+    _age(("p", "fn"), 100)
+
+    fn = function_cache.get_deployed_function_sync("p", "fn", ttl=30, max_stale=60, jitter=0)
+    assert fn.version_num == 2
+    assert not function_cache._deployed_refreshing
+
+
+def test_deployed_jitter_backdates_entries(sync_client: Mock) -> None:
+    """Jitter spreads expiry of entries over a fraction of the TTL."""
+    sync_client.projects.functions.name.retrieve_deployed.return_value = _function(1)
+    before = time.time()
+    function_cache.get_deployed_function_sync("p", "fn", ttl=100, jitter=0.5, force_refresh=True)
+    ts, _ = function_cache._deployed_cache[("p", "fn")]
+    assert before - 50 <= ts <= time.time()
+
+
+@pytest.mark.asyncio
+async def test_deployed_async_stale_entry_is_served_while_refreshing(async_client: Mock) -> None:
+    """The async path refreshes stale entries in a background task."""
+    async_client.projects.functions.name.retrieve_deployed.side_effect = [_function(1), _function(2)]
+    await function_cache.get_deployed_function_async("p", "fn", ttl=30, jitter=0)
+    _age(("p", "fn"), 40)
+
+    stale = await function_cache.get_deployed_function_async("p", "fn", ttl=30, max_stale=60, jitter=0)
+    assert stale.version_num == 1
+    await asyncio.gather(*function_cache._background_tasks)
+
+    fresh = await function_cache.get_deployed_function_async("p", "fn", ttl=30, max_stale=60, jitter=0)
+    assert fresh.version_num == 2
+    assert async_client.projects.functions.name.retrieve_deployed.await_count == 2
+
+
+def _not_found() -> NotFoundError:
+    request = httpx.Request("GET", "https://api.example.com/functions/hash")
+    return NotFoundError("not found", response=httpx.Response(404, request=request), body=None)
+
+
+def test_hash_not_found_is_cached(sync_client: Mock) -> None:
+    """A missing hash raises again without another API call until the TTL expires."""
+    sync_client.projects.functions.retrieve_by_hash.side_effect = [_not_found(), _function(1)]
+    for _ in range(3):
+        with pytest.raises(NotFoundError):
+            function_cache.get_function_by_hash_sync("p", "hash-1")
+    assert sync_client.projects.functions.retrieve_by_hash.call_count == 1
+
+    ts, error = function_cache._not_found_cache[("p", "hash-1")]
+    function_cache._not_found_cache[("p", "hash-1")] = (ts - 60, error)
+    assert function_cache.get_function_by_hash_sync("p", "hash-1").version_num == 1
+
+
+def test_hash_cache_evicts_least_recently_used(sync_client: Mock, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A full hash cache evicts the entry that was looked up least recently, not the oldest one."""
+    monkeypatch.setattr(function_cache, "_HASH_SYNC_MAX", 2)
+    sync_client.projects.functions.retrieve_by_hash.side_effect = lambda project_uuid, function_hash: _function(
+        int(function_hash.removeprefix("hash-"))
+    )
+    function_cache.get_function_by_hash_sync("p", "hash-1")
+    function_cache.get_function_by_hash_sync("p", "hash-2")
+    function_cache.get_function_by_hash_sync("p", "hash-1")  # hit
+    function_cache.get_function_by_hash_sync("p", "hash-3")
+    assert list(function_cache._hash_cache) == [("p", "hash-1"), ("p", "hash-3")]
+    assert sync_client.projects.functions.retrieve_by_hash.call_count == 3
+
+
+def test_get_function_by_closure_falls_back_to_legacy_hash(sync_client: Mock) -> None:
+    """A closure whose hash is unknown is found by the hash older SDKs registered it under."""
+    sync_client.projects.functions.retrieve_by_hash.side_effect = [_not_found(), _function(1)]
+    closure = Closure(name="fn", signature="", code="", hash="hash-2", legacy_hash="hash-1", dependencies={})
+    assert function_cache.get_function_by_closure_sync("p", closure) == _function(1)
+    assert [
+        call.kwargs["function_hash"] for call in sync_client.projects.functions.retrieve_by_hash.call_args_list
+    ] == [
+        "hash-2",
+        "hash-1",
+    ]
+
+    with pytest.raises(NotFoundError):
+        function_cache.get_function_by_closure_sync("p", closure.model_copy(update={"legacy_hash": None}))
+
+
+def test_create_function_sync_coalesces_concurrent_creates(sync_client: Mock) -> None:
+    """Concurrent creates of one hash make a single request and fill the hash cache."""
+    sync_client.projects.functions.retrieve_by_hash.side_effect = _not_found()
+    calls = 0
+
+    def create() -> FunctionPublic:
+        nonlocal calls
+        calls += 1
+        time.sleep(0.1)
+        return _function(1)
+
+    with pytest.raises(NotFoundError):
+        function_cache.get_function_by_hash_sync("p", "hash-1")
+    results: list[FunctionPublic | None] = []
+    threads = [
+        threading.Thread(target=lambda: results.append(function_cache.create_function_sync("p", "hash-1", create)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == 1
+    assert results == [_function(1)] * 4
+    assert function_cache.get_function_by_hash_sync("p", "hash-1") == _function(1)
+
+
+def test_create_function_sync_shares_failures() -> None:
+    """Concurrent creates of one hash share a failed request instead of retrying it one by one."""
+    calls = 0
+
+    def create() -> FunctionPublic:
+        nonlocal calls
+        calls += 1
+        time.sleep(0.1)
+        raise RuntimeError("create failed")
+
+    errors: list[BaseException] = []
+
+    def worker() -> None:
+        try:
+            function_cache.create_function_sync("p", "hash-1", create)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == 1
+    assert len(errors) == 8
+    assert not function_cache._create_sync_futures
+
+
+@pytest.mark.asyncio
+async def test_create_function_async_coalesces_concurrent_creates() -> None:
+    """Concurrent async creates of one hash share a single request."""
+    create = AsyncMock(return_value=_function(1))
+
+    async def slow_create() -> FunctionPublic:
+        await asyncio.sleep(0.05)
+        return await create()
+
+    results = await asyncio.gather(
+        *(function_cache.create_function_async("p", "hash-1", slow_create) for _ in range(4))
+    )
+    assert results == [_function(1)] * 4
+    assert create.await_count == 1
@@ -0,0 +1,70 @@
+"""Tests for the build command."""
+
+import sys
+import json
+import importlib
+from pathlib import Path
+from collections.abc import Iterator
+
+import pytest
+
+from lilypad.lib._utils import Closure
+from lilypad.lib._utils.closure import _DependencyCollector
+from lilypad.lib._utils.settings import get_settings
+from lilypad.lib.cli.commands.build import build_command
+
+MODULE_SOURCE = """
+import lilypad
+
+
+def helper(x: int) -> int:
+    return x + 1
+
+
+@lilypad.trace(versioning="automatic")
+def answer(x: int) -> int:
+    return helper(x) * 2
+"""
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    """Write a package with one decorated function and remove it from `sys.modules` afterwards."""
+    name = f"build_pkg_{tmp_path.name.replace('-', '_')}"
+    directory = tmp_path / "src" / name
+    directory.mkdir(parents=True)
+    (directory / "__init__.py").write_text("")
+    (directory / "fns.py").write_text(MODULE_SOURCE)
+    monkeypatch.syspath_prepend(str(directory.parent))
+    yield directory
+    for module in [module for module in sys.modules if module.startswith(name)]:
+        del sys.modules[module]
+
+
+def test_build_writes_manifest_used_by_from_fn(package: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """The manifest holds each decorated function's closure and `Closure.from_fn` reads it back."""
+    output = tmp_path / "closures.json"
+    build_command(package, None, output, False, workers=1)
+
+    manifest = json.loads(output.read_text())
+    entry = manifest["closures"][f"{package.name}.fns:answer"]
+    assert entry["modules"] == [f"{package.name}.fns"]
+    assert "def helper" in entry["closure"]["code"]
+
+    fn = importlib.import_module(f"{package.name}.fns").answer
+    monkeypatch.setattr(get_settings(), "closure_manifest_path", str(output))
+    Closure.from_fn.cache_clear()
+    with monkeypatch.context() as patch:
+        patch.setattr(_DependencyCollector, "collect", lambda *_: pytest.fail("closure was recomputed"))
+        closure = Closure.from_fn(fn)
+    assert closure.model_dump(mode="json") == entry["closure"]
+
+    # a changed source file invalidates the entry
+    fns_file = package / "fns.py"
+    fns_file.write_text(MODULE_SOURCE.replace("x + 1", "x + 2"))
+    Closure.from_fn.cache_clear()
+    with monkeypatch.context() as patch:
+        patch.setattr(_DependencyCollector, "collect", lambda *_: pytest.fail("closure was recomputed"))
+        with pytest.raises(pytest.fail.Exception, match="recomputed"):
+            Closure.from_fn(fn)
+    Closure.from_fn.cache_clear()
@@ -1,11 +1,16 @@
 """Tests for the sync command."""
 
+from types import SimpleNamespace
 from typing import Any
 from pathlib import Path
+from unittest.mock import Mock
 
 import pytest
 
+from lilypad.lib.cli.commands import sync
 from lilypad.lib.cli.commands.sync import (
+    _scan_file,
+    sync_command,
     _merge_parameters,
     _parse_return_type,
     _normalize_signature,
@@ -186,3 +191,74 @@ def override_dependencies(monkeypatch, tmp_path: Path):
         "retrieve_by_name",
         lambda self, fn: DummyClient("").get_generations_by_name(fn),
     )
+
+
+STATIC_MODULE = """
+import lilypad
+from lilypad import trace as lilypad_trace
+
+
+@lilypad.trace(versioning="automatic", mode="wrap", tags=["b", "a", "b"])
+async def wrapped_fn(x: int) -> int:
+    return x
+
+
+@lilypad_trace(versioning="automatic")
+def plain_fn() -> None: ...
+
+
+@lilypad.trace()
+def unversioned_fn() -> None: ...
+"""
+
+
+def test_scan_file(tmp_path: Path):
+    """Test that decorated top-level functions are found without importing the file."""
+    path = tmp_path / "fns.py"
+    path.write_text(STATIC_MODULE)
+    scan = _scan_file(str(path))
+    assert scan.functions == [
+        ("wrapped_fn", 7, True, {"mode": "wrap", "tags": ["a", "b"]}),
+        ("plain_fn", 12, False, {"mode": None, "tags": None}),
+    ]
+    assert not scan.ambiguous
+
+    # a decorator that can only be resolved by running the module
+    for source in [
+        STATIC_MODULE + "\nclass A:\n    @lilypad.trace(versioning='automatic')\n    def method(self): ...\n",
+        STATIC_MODULE + "\nMODE = 'wrap'\n@lilypad.trace(versioning='automatic', mode=MODE)\ndef fn(): ...\n",
+        STATIC_MODULE + "\ntraced = lilypad.trace(versioning='automatic')(plain_fn)\n",
+        "from app.tracing import my_trace\n\n@my_trace(versioning='automatic')\ndef fn(): ...\n",
+    ]:
+        path.write_text(source)
+        assert _scan_file(str(path)).ambiguous
+
+
+def test_sync_command_static_imports_only_ambiguous_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Test that `--static` imports only the files it cannot resolve by parsing them."""
+    pkg_dir = tmp_path / "pkg"
+    (pkg_dir / "fns.py").write_text(STATIC_MODULE)
+    (pkg_dir / "dynamic.py").write_text("import lilypad\n\ntrace = lilypad.trace\n")
+    (pkg_dir / "other.py").write_text("import heavy_module\n")
+    dynamic_file = str((pkg_dir / "dynamic.py").resolve())
+    imported: list[str] = []
+    monkeypatch.setattr(sync, "_import_module_safely", imported.append)
+    monkeypatch.setattr(
+        sync,
+        "get_decorated_functions",
+        lambda name: {name: [(dynamic_file, "dynamic_fn", 3, "pkg.dynamic", {"mode": None, "tags": None})]},
+    )
+    client = Mock()
+    client.projects.functions.name.retrieve_by_name.return_value = []
+    monkeypatch.setattr(sync, "get_sync_client", lambda api_key: client)
+
+    def dynamic_fn() -> None: ...
+
+    monkeypatch.setattr(sync.importlib, "import_module", lambda name: SimpleNamespace(dynamic_fn=dynamic_fn))
+
+    sync_command(pkg_dir, None, False, False, static=True)
+
+    assert imported == ["pkg.dynamic"]
+    assert sorted(
+        call.kwargs["function_name"] for call in client.projects.functions.name.retrieve_by_name.call_args_list
+    ) == ["dynamic_fn", "plain_fn", "wrapped_fn"]
@@ -0,0 +1,109 @@
+"""Tests for batched sandbox execution."""
+
+import sys
+import time
+import shutil
+from typing import Any
+from pathlib import Path
+
+import pytest
+
+from lilypad.lib._utils import Closure
+from lilypad.lib.sandbox import EnvironmentCache, PooledSandboxRunner, SubprocessSandboxRunner
+from lilypad.lib.sandbox.runner import Result, SandboxRunner, DependencyError
+
+
+def _closure(code: str, name: str = "fn") -> Closure:
+    signature = next(line for line in code.splitlines() if f"def {name}(" in line)
+    return Closure(name=name, code=code, signature=signature, hash=name, dependencies={})
+
+
+_DIVIDE = _closure("import os\n\ndef fn(a, b):\n    return a // b\n")
+_CUSTOM_RESULT = {"result": "result", "pid": "os.getpid()"}
+
+
+def test_pooled_batch_runs_in_one_worker() -> None:
+    """Every call of a batch is served by one worker and failing calls yield their errors."""
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner:
+        results = list(
+            runner.execute_batch(_DIVIDE, [((6, 3), {}), ((1, 0), {}), ((9, 3), {})], custom_result=_CUSTOM_RESULT)
+        )
+        assert [result["result"] for result in results if not isinstance(result, Exception)] == [2, 3]
+        assert isinstance(results[1], RuntimeError) and "ZeroDivisionError" in str(results[1])
+        assert results[0]["pid"] == results[2]["pid"]  # pyright: ignore [reportIndexIssue, reportCallIssue, reportArgumentType]
+        assert runner.execute_function(_DIVIDE, 4, 2) == {"result": 2}
+
+
+def test_pooled_batch_concurrency_keeps_order() -> None:
+    """Calls run concurrently inside the sandbox but are yielded in input order."""
+    closure = _closure("import time\n\ndef fn(delay, value):\n    time.sleep(delay)\n    return value\n")
+    calls: list[tuple[tuple[Any, ...], dict[str, Any]]] = [((0.3 - 0.1 * i, i), {}) for i in range(3)] * 2
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner:
+        runner.execute_function(closure, 0, None)  # start the worker
+        start = time.monotonic()
+        results = list(runner.execute_batch(closure, calls, concurrency=6))
+        assert time.monotonic() - start < 0.6
+    assert [result for result in results] == [{"result": i} for i in range(3)] * 2
+
+
+def test_pooled_batch_stopped_early_replaces_worker() -> None:
+    """Abandoning a batch does not leave unread results behind for the next call."""
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner:
+        results = runner.execute_batch(_DIVIDE, [((i, 1), {}) for i in range(100)])
+        assert next(results) == {"result": 0}
+        results.close()
+        assert runner.execute_function(_DIVIDE, 8, 2) == {"result": 4}
+
+
+def test_pooled_batch_returns_bytes_like_results() -> None:
+    """Bytes-like results come back from a batch as they do from a single call."""
+    closure = _closure("def fn(data):\n    return {'raw': data, 'views': [memoryview(data)]}\n")
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner:
+        results = list(runner.execute_batch(closure, [((b"\x00ab",), {}), ((bytearray(b"c"),), {})]))
+        single = runner.execute_function(closure, b"\x00ab")
+    assert [bytes(result["result"]["raw"]) for result in results] == [b"\x00ab", b"c"]  # pyright: ignore [reportIndexIssue, reportCallIssue, reportArgumentType]
+    assert isinstance(results[0]["result"]["views"][0], memoryview)  # pyright: ignore [reportIndexIssue, reportCallIssue, reportArgumentType]
+    assert bytes(single["result"]["raw"]) == b"\x00ab"
+
+
+def test_pooled_batch_dependency_error_raises() -> None:
+    """Errors that affect every call are raised instead of yielded."""
+    closure = _closure("import not_a_real_module\n\ndef fn(x):\n    return x\n")
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner, pytest.raises(DependencyError):
+        list(runner.execute_batch(closure, [((1,), {})]))
+
+
+class _CountingRunner(SandboxRunner):
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls = 0
+
+    def execute_function(self, closure: Closure, *args: Any, **kwargs: Any) -> Result:
+        self.calls += 1
+        if not args[0]:
+            raise RuntimeError("falsy")
+        return {"result": args[0]}
+
+
+@pytest.mark.asyncio
+async def test_default_batch_calls_execute_function() -> None:
+    """Runners without batch support run one call per item, also when iterated asynchronously."""
+    runner = _CountingRunner()
+    results = [result async for result in runner.execute_batch_async(_DIVIDE, [((1,), {}), ((0,), {}), ((2,), {})])]
+    assert runner.calls == 3
+    assert results[0] == {"result": 1} and results[2] == {"result": 2}
+    assert isinstance(results[1], RuntimeError)
+
+
+@pytest.mark.skipif(shutil.which("uv") is None, reason="uv is not installed")
+@pytest.mark.asyncio
+async def test_subprocess_batch_streams_results(tmp_path: Path) -> None:
+    """A batch runs in a single subprocess, both synchronously and asynchronously."""
+    runner = SubprocessSandboxRunner(environments=EnvironmentCache(tmp_path, python=sys.executable))
+    calls: list[tuple[tuple[Any, ...], dict[str, Any]]] = [((a, 2), {}) for a in range(5)] + [((1, 0), {})]
+    results = list(runner.execute_batch(_DIVIDE, calls, concurrency=2, custom_result=_CUSTOM_RESULT))
+    assert [result["result"] for result in results[:5]] == [0, 0, 1, 1, 2]  # pyright: ignore [reportIndexIssue, reportCallIssue, reportArgumentType]
+    assert len({result["pid"] for result in results[:5]}) == 1  # pyright: ignore [reportIndexIssue, reportCallIssue, reportArgumentType]
+    assert isinstance(results[5], RuntimeError)
+    async_results = [result async for result in runner.execute_batch_async(_DIVIDE, calls[:3])]
+    assert async_results == [{"result": 0}, {"result": 0}, {"result": 1}]
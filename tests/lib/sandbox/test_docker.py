@@ -0,0 +1,134 @@
+"""Tests for the Docker sandbox runner."""
+
+import os
+import sys
+import struct
+import tarfile
+import subprocess
+from typing import Any
+from pathlib import Path
+from unittest.mock import Mock
+from collections.abc import Iterator
+
+import orjson
+import pytest
+
+from lilypad.lib._utils import Closure
+
+docker_sandbox = pytest.importorskip("lilypad.lib.sandbox.docker")
+
+
+def _closure() -> Closure:
+    return Closure(name="fn", code="def fn(x):\n    return x\n", signature="def fn(x): ...", hash="fn", dependencies={})
+
+
+class _Server:
+    """Stands in for the attached socket of a pooled container's resident interpreter."""
+
+    def __init__(self) -> None:
+        self.requests: list[bytes] = []
+
+    def sendall(self, data: bytes) -> None:
+        self.requests.append(data)
+
+    def frames(self) -> Iterator[tuple[int, bytes]]:
+        yield 1, docker_sandbox._HEADER.pack(0, 0)
+        document = orjson.dumps({"result": 1})
+        body = struct.pack(">II", len(document), 0) + document
+        while True:
+            yield 2, b"output\n"
+            yield 1, docker_sandbox._HEADER.pack(0, len(body)) + body
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> _Server:
+    server = _Server()
+    monkeypatch.setattr(docker_sandbox, "frames_iter", lambda socket, tty: socket.frames())
+    return server
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch, server: _Server) -> Mock:
+    client = Mock()
+
+    def exec_run(cmd: Any, **kwargs: Any) -> tuple[Any, Any]:
+        if kwargs.get("socket"):
+            return None, server
+        return 0, (b'{"result": 1}', b"")
+
+    client.containers.run.return_value.exec_run.side_effect = exec_run
+    monkeypatch.setattr(docker_sandbox, "_docker_client", lambda: client)
+    return client
+
+
+def test_pooled_containers_are_reused(client: Mock, server: _Server) -> None:
+    """Pooled calls are sent to the resident interpreter of one warm container."""
+    container = client.containers.run.return_value
+    with docker_sandbox.DockerSandboxRunner(pool_size=1) as runner:
+        assert runner.execute_function(_closure(), 1) == {"result": 1}
+        assert runner.execute_function(_closure(), 2) == {"result": 1}
+    assert client.containers.run.call_count == 1
+    assert container.exec_run.call_count == 1
+    assert tarfile.open(fileobj=container.put_archive.call_args.args[1]).getnames() == ["lilypad/server.py"]
+    assert len(server.requests) == 2
+    container.kill.assert_called_once()
+
+
+def test_pooled_containers_are_recycled(client: Mock) -> None:
+    """Containers are replaced after `max_calls` calls."""
+    with docker_sandbox.DockerSandboxRunner(pool_size=1, max_calls=1) as runner:
+        runner.execute_function(_closure(), 1)
+        runner.execute_function(_closure(), 2)
+    assert client.containers.run.call_count == 2
+
+
+def test_unpooled_runner_stops_container(client: Mock) -> None:
+    """Without a pool every call gets its own container."""
+    runner = docker_sandbox.DockerSandboxRunner()
+    assert runner.execute_function(_closure(), 1) == {"result": 1}
+    names = tarfile.open(fileobj=client.containers.run.return_value.put_archive.call_args.args[1]).getnames()
+    assert sorted(names) == ["args.pkl", "main.py"]
+    client.containers.run.return_value.stop.assert_called_once()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_server_forks_each_call_into_a_fresh_directory(tmp_path: Path) -> None:
+    """The resident interpreter runs each call in its own working directory and removes it afterwards."""
+    closure = Closure(
+        name="fn",
+        code="import os\n\n\ndef fn(x):\n    open('state', 'a').write(x)\n    return sorted(os.listdir('.')), open('state').read()\n",
+        signature="def fn(x): ...",
+        hash="fn",
+        dependencies={},
+    )
+    runner = docker_sandbox.DockerSandboxRunner(pool_size=1)
+    script = tmp_path / "server.py"
+    script.write_text(runner._server_script(closure))
+    process = subprocess.Popen(
+        [sys.executable, str(script), str(tmp_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    assert process.stdin is not None and process.stdout is not None
+    stdin, stdout = process.stdin, process.stdout
+
+    def call(arguments: bytes, batch: bool = False) -> tuple[int, bytes]:
+        header = orjson.dumps({"program": runner.generate_program(closure), "imports": ["os"], "batch": batch})
+        stdin.write(docker_sandbox._REQUEST.pack(len(header), len(arguments)) + header + arguments)
+        stdin.flush()
+        status, length = docker_sandbox._HEADER.unpack(stdout.read(docker_sandbox._HEADER.size))
+        return status, stdout.read(length)
+
+    try:
+        assert stdout.read(docker_sandbox._HEADER.size) == docker_sandbox._HEADER.pack(0, 0)
+        for value in "ab":
+            status, payload = call(runner.encode_arguments((value,), {}))
+            assert runner.parse_result_frame(status, payload, b"") == {"result": [["state"], value]}
+        status, payload = call(runner.encode_batch([(("c",), {}), (("d",), {})], 1), batch=True)
+        assert list(runner.parse_batch_output(payload.splitlines(), 2, lambda: b"")) == [
+            {"result": [["state"], "c"]},
+            {"result": [["state"], "cd"]},
+        ]
+        assert sorted(os.listdir(tmp_path)) == ["server.py"]
+    finally:
+        stdin.close()
+        process.wait()
+        stdout.close()
@@ -0,0 +1,132 @@
+"""Tests for the sandbox environment cache."""
+
+import os
+import sys
+import shutil
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from lilypad.lib._utils import Closure
+from lilypad.lib.sandbox import EnvironmentCache, PooledSandboxRunner, SubprocessSandboxRunner
+from lilypad.lib.sandbox.environments import dependency_key
+
+pytestmark = pytest.mark.skipif(shutil.which("uv") is None, reason="uv is not installed")
+
+
+def _closure(name: str = "fn", dependencies: dict | None = None) -> Closure:
+    return Closure(
+        name=name,
+        code=f"import sys\n\ndef {name}():\n    return sys.prefix\n",
+        signature=f"def {name}(): ...",
+        hash=name,
+        dependencies=dependencies or {},
+    )
+
+
+def test_dependency_key_ignores_order() -> None:
+    """The key only depends on the dependency set."""
+    a = {"version": "1.0", "extras": None}
+    b = {"version": "2.0", "extras": ["x"]}
+    assert dependency_key(_closure(dependencies={"a": a, "b": b})) == dependency_key(
+        _closure("other", dependencies={"b": b, "a": a})
+    )
+    assert dependency_key(_closure(dependencies={"a": a})) != dependency_key(_closure(dependencies={"b": b}))
+
+
+def test_environment_is_built_once_and_reused(tmp_path: Path) -> None:
+    """Closures with the same dependencies share one environment used by the runners."""
+    cache = EnvironmentCache(tmp_path, python=sys.executable)
+    python = cache.python(_closure())
+    assert python.exists()
+    assert cache.python(_closure("other")) == python
+    assert [entry.name for entry in tmp_path.iterdir()] == [dependency_key(_closure())]
+
+    expected = os.path.realpath(cache.path(_closure()))
+    result = SubprocessSandboxRunner(environments=cache).execute_function(_closure())
+    assert os.path.realpath(result["result"]) == expected
+    with PooledSandboxRunner(environments=cache) as runner:
+        assert os.path.realpath(runner.execute_function(_closure())["result"]) == expected
+
+
+def test_least_recently_used_environments_are_collected(tmp_path: Path) -> None:
+    """Building past `max_environments` removes the least recently used environments."""
+    stale = tmp_path / "stale"
+    stale.mkdir()
+    os.utime(stale, (0, 0))
+    cache = EnvironmentCache(tmp_path, max_environments=1, python=sys.executable)
+    cache.python(_closure())
+    assert not stale.exists()
+    assert cache.path(_closure()).exists()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="leases use fcntl")
+def test_leased_environments_are_not_collected(tmp_path: Path) -> None:
+    """An environment with a lease held is kept until the lease is released."""
+    cache = EnvironmentCache(tmp_path, max_environments=1, python=sys.executable)
+    other = _closure("other", dependencies={"six": {"version": "1.16.0", "extras": None}})
+    with cache.lease(_closure()) as lease:
+        cache.path(other).mkdir()  # stands in for a newer environment
+        cache.collect_garbage(keep=cache.path(other))
+        assert lease.python.exists()
+    cache.collect_garbage(keep=cache.path(other))
+    assert not cache.path(_closure()).exists()
+
+
+def test_subprocess_runner_reuses_cached_script(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """The script is written once per closure and output printed by the function is kept off stdout."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    runner = SubprocessSandboxRunner(environments=EnvironmentCache(tmp_path / "envs", python=sys.executable))
+    closure = Closure(
+        name="fn",
+        code="def fn(text, *, times):\n    print('noise')\n    return text * times\n",
+        signature="def fn(text, *, times): ...",
+        hash="fn",
+        dependencies={},
+    )
+    assert runner.execute_function(closure, "ab", times=2) == {"result": "abab"}
+    assert runner.execute_function(closure, "c", times=3) == {"result": "ccc"}
+    assert len(list((tmp_path / "cache" / "lilypad" / "scripts").iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_subprocess_runner_async_does_not_block_loop(tmp_path: Path) -> None:
+    """Async execution runs the subprocess without blocking the event loop."""
+    runner = SubprocessSandboxRunner(environments=EnvironmentCache(tmp_path, python=sys.executable))
+    closure = Closure(
+        name="fn",
+        code="import time\n\ndef fn(x):\n    time.sleep(0.5)\n    return x\n",
+        signature="def fn(x): ...",
+        hash="fn",
+        dependencies={},
+    )
+    await asyncio.to_thread(runner.environments.python, closure)  # pyright: ignore [reportOptionalMemberAccess]
+    ticks = 0
+
+    async def tick() -> None:
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    results = await asyncio.gather(*(runner.execute_function_async(closure, i) for i in range(2)))
+    ticker.cancel()
+    assert [result["result"] for result in results] == [0, 1]
+    assert ticks > 10
+
+
+def test_subprocess_runner_returns_bytes_out_of_band(tmp_path: Path) -> None:
+    """Results travel over a dedicated file descriptor, so bytes survive and prints do not interfere."""
+    runner = SubprocessSandboxRunner(environments=EnvironmentCache(tmp_path, python=sys.executable))
+    closure = Closure(
+        name="fn",
+        code="def fn(size):\n    print('{\"result\": 0}')\n    return b'\\x01' * size\n",
+        signature="def fn(size): ...",
+        hash="fn",
+        dependencies={},
+    )
+    result = runner.execute_function(closure, 1_000_000)["result"]
+    assert isinstance(result, memoryview)
+    assert bytes(result) == b"\x01" * 1_000_000
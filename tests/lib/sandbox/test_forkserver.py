@@ -0,0 +1,62 @@
+"""Tests for the fork server sandbox runner."""
+
+import os
+import sys
+from collections.abc import Iterator
+
+import pytest
+
+from lilypad.lib._utils import Closure
+from lilypad.lib.sandbox import ForkServerSandboxRunner
+from lilypad.lib.sandbox.runner import DependencyError
+from lilypad.lib.sandbox.forkserver import _imports
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+def _closure(code: str, name: str = "fn") -> Closure:
+    signature = next(line for line in code.splitlines() if f"def {name}(" in line)
+    return Closure(name=name, code=code, signature=signature, hash=name, dependencies={})
+
+
+@pytest.fixture
+def runner() -> Iterator[ForkServerSandboxRunner]:
+    with ForkServerSandboxRunner(command=[sys.executable], preload=()) as runner:
+        yield runner
+
+
+def test_calls_run_in_separate_children(runner: ForkServerSandboxRunner) -> None:
+    """Each call runs in a fresh child of the same server, so state does not leak between calls."""
+    closure = _closure("import os\n\ncalls = []\n\ndef fn(a, b=1):\n    calls.append(a)\n    return a + b\n")
+    custom_result = {"result": "result", "parent": "os.getppid()", "pid": "os.getpid()", "calls": "len(calls)"}
+    first = runner.execute_function(closure, 1, b=2, custom_result=custom_result)
+    second = runner.execute_function(closure, 3, custom_result=custom_result)
+    assert (first["result"], second["result"]) == (3, 4)
+    assert first["parent"] == second["parent"]
+    assert first["pid"] != second["pid"]
+    assert second["calls"] == 1
+
+
+def test_preloaded_modules_are_inherited(runner: ForkServerSandboxRunner) -> None:
+    """Modules the closure imports are loaded by the server before it forks."""
+    closure = _closure("import sys\nimport json\n\ndef fn():\n    return 'json' in sys.modules\n")
+    assert _imports(closure.code) == ("sys", "json")
+    assert runner.execute_function(closure, custom_result={"result": "result"}) == {"result": True}
+
+
+def test_errors(runner: ForkServerSandboxRunner) -> None:
+    """Errors are reported like the subprocess runner and do not affect the server."""
+    with pytest.raises(DependencyError):
+        runner.execute_function(_closure("import not_a_real_module\n\ndef fn():\n    return 1\n"))
+    with pytest.raises(RuntimeError, match="ValueError"):
+        runner.execute_function(_closure("def fn():\n    raise ValueError('boom')\n"))
+    with pytest.raises(RuntimeError, match="exited"):
+        runner.execute_function(_closure("import os\n\ndef fn():\n    os._exit(3)\n"))
+    assert runner.execute_function(_closure("def fn():\n    print('noise')\n    return 1\n")) == {"result": 1}
+
+
+@pytest.mark.asyncio
+async def test_async_execution(runner: ForkServerSandboxRunner) -> None:
+    """Async callers talk to the server without blocking the event loop."""
+    closure = _closure("import asyncio\n\nasync def fn(x):\n    await asyncio.sleep(0)\n    return x * 2\n")
+    assert await runner.execute_function_async(closure, "ab") == {"result": "abab"}
@@ -0,0 +1,85 @@
+"""Tests for the pooled sandbox runner."""
+
+import sys
+from collections.abc import Iterator
+
+import pytest
+
+from lilypad.lib._utils import Closure
+from lilypad.lib.sandbox import PooledSandboxRunner
+from lilypad.lib.sandbox.runner import DependencyError
+
+
+def _closure(code: str, name: str = "fn") -> Closure:
+    signature = next(line for line in code.splitlines() if f"def {name}(" in line)
+    return Closure(name=name, code=code, signature=signature, hash=name, dependencies={})
+
+
+@pytest.fixture
+def runner() -> Iterator[PooledSandboxRunner]:
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1) as runner:
+        yield runner
+
+
+def test_pooled_runner_reuses_worker(runner: PooledSandboxRunner) -> None:
+    """Repeated calls are served by the same worker process, with pre-actions run once."""
+    closure = _closure("import os\n\ncalls = []\n\ndef fn(a, b=1):\n    calls.append(a)\n    return a + b\n")
+    custom_result = {"result": "result", "pid": "os.getpid()", "calls": "len(calls)"}
+    first = runner.execute_function(closure, 1, b=2, custom_result=custom_result, pre_actions=["print('ready')"])
+    second = runner.execute_function(closure, 3, custom_result=custom_result, pre_actions=["print('ready')"])
+    assert first["result"] == 3
+    assert second["result"] == 4
+    assert first["pid"] == second["pid"]
+    assert second["calls"] == 2
+
+
+def test_pooled_runner_async_function(runner: PooledSandboxRunner) -> None:
+    """Async functions are awaited inside the worker."""
+    closure = _closure("import asyncio\n\nasync def fn(x):\n    await asyncio.sleep(0)\n    return x * 2\n")
+    assert runner.execute_function(closure, "ab") == {"result": "abab"}
+
+
+def test_pooled_runner_recycles_after_max_calls() -> None:
+    """Workers are replaced once they have served `max_calls` calls."""
+    closure = _closure("import os\n\ndef fn():\n    return os.getpid()\n")
+    with PooledSandboxRunner(command=[sys.executable], max_workers=1, max_calls=1) as runner:
+        assert runner.execute_function(closure)["result"] != runner.execute_function(closure)["result"]
+
+
+def test_pooled_runner_errors(runner: PooledSandboxRunner) -> None:
+    """Errors are reported like the subprocess runner and keep the worker usable."""
+    with pytest.raises(DependencyError):
+        runner.execute_function(_closure("import not_a_real_module\n\ndef fn():\n    return 1\n"))
+    with pytest.raises(RuntimeError, match="ValueError"):
+        runner.execute_function(_closure("def fn():\n    raise ValueError('boom')\n"))
+    with pytest.raises(RuntimeError, match="exited"):
+        runner.execute_function(_closure("import os\n\ndef fn():\n    os._exit(3)\n"))
+    assert runner.execute_function(_closure("def fn():\n    print('noise')\n    return 1\n")) == {"result": 1}
+
+
+class Point:
+    """A class the sandbox can only resolve from the closure's own definitions."""
+
+    def __init__(self, x: int, y: int) -> None:
+        self.x = x
+        self.y = y
+
+
+def test_pooled_runner_pickles_arguments(runner: PooledSandboxRunner) -> None:
+    """Arguments travel as pickles, so their `repr` does not have to be valid code."""
+    closure = _closure(
+        "class Point:\n"
+        "    def __init__(self, x, y):\n"
+        "        self.x = x\n"
+        "        self.y = y\n"
+        "\n"
+        "def fn(point, blob):\n"
+        "    return [point.x + point.y, len(blob)]\n"
+    )
+    assert runner.execute_function(closure, Point(1, 2), blob=b"\x00" * 1_000_000) == {"result": [3, 1_000_000]}
+
+
+@pytest.mark.asyncio
+async def test_pooled_runner_async_runs_in_thread(runner: PooledSandboxRunner) -> None:
+    """Runners without native async support execute in a worker thread."""
+    assert await runner.execute_function_async(_closure("def fn(x):\n    return x\n"), 1) == {"result": 1}
@@ -0,0 +1,42 @@
+"""Tests for the sandbox runner helpers."""
+
+from typing import Any
+
+import pytest
+
+from lilypad.lib.sandbox.runner import RUNTIME_SOURCE, SandboxRunner, DependencyError, decode_result
+
+
+def _body(result: Any) -> bytes:
+    namespace: dict[str, Any] = {}
+    exec(RUNTIME_SOURCE, namespace)
+    return b"".join(bytes(part) for part in namespace["_body"](result))
+
+
+def test_result_body_round_trip() -> None:
+    """Bytes-like values travel out of band and come back as views of the body."""
+    body = _body({"result": {"image": b"\x89PNG", "chunks": [bytearray(b"ab"), memoryview(b"c")], "n": 1}})
+    result = decode_result(body)
+    image = result["result"]["image"]
+    assert isinstance(image, memoryview) and image.obj is memoryview(body).obj
+    assert bytes(image) == b"\x89PNG"
+    assert [bytes(chunk) for chunk in result["result"]["chunks"]] == [b"ab", b"c"]
+    assert result["result"]["n"] == 1
+    assert decode_result(_body({"result": None})) == {"result": None}
+
+
+def test_parse_result_frame_errors() -> None:
+    """Error bodies are reported like the JSON errors on stdout."""
+    error = {
+        "error_type": "ModuleNotFoundError",
+        "error_message": "No module named 'x'",
+        "is_dependency_error": True,
+        "module_name": "x",
+        "traceback": "",
+    }
+    with pytest.raises(DependencyError):
+        SandboxRunner.parse_result_frame(1, _body(error), b"")
+    with pytest.raises(RuntimeError, match="ValueError"):
+        SandboxRunner.parse_result_frame(
+            1, _body({**error, "error_type": "ValueError", "is_dependency_error": False}), b""
+        )
@@ -0,0 +1,206 @@
+"""Tests for the sandbox scheduler."""
+
+import time
+import asyncio
+import threading
+from unittest.mock import Mock
+from collections.abc import Callable, Iterator, AsyncIterator
+
+import pytest
+
+from lilypad.lib import traces
+from lilypad.lib.sandbox import SandboxScheduler, get_scheduler, set_scheduler
+from lilypad.lib._utils.settings import get_settings
+
+
+def _wait_for(condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_global_limit_queues_by_priority() -> None:
+    """Waiters are served by priority, then in arrival order, once a slot frees up."""
+    scheduler = SandboxScheduler(1)
+    order: list[str] = []
+
+    def run(name: str, priority: int) -> None:
+        with scheduler.slot(name, priority=priority):
+            order.append(name)
+
+    with scheduler.slot("first"):
+        threads = []
+        for name, priority in [("low", 0), ("high", 5), ("low-2", 0)]:
+            threads.append(threading.Thread(target=run, args=(name, priority)))
+            threads[-1].start()
+            queued = len(threads)
+            _wait_for(lambda: scheduler.stats().queued == queued)  # noqa: B023
+    for thread in threads:
+        thread.join()
+    assert order == ["high", "low", "low-2"]
+    stats = scheduler.stats()
+    assert (stats.running, stats.queued, stats.started) == (0, 0, 4)
+    assert stats.max_queue_time > 0
+
+
+def test_per_function_limit_does_not_block_other_functions() -> None:
+    """A function at its own limit waits while other functions keep starting."""
+    scheduler = SandboxScheduler(4, max_per_function=1)
+    started = threading.Event()
+
+    def run() -> None:
+        with scheduler.slot("a"):
+            started.set()
+
+    with scheduler.slot("a"):
+        thread = threading.Thread(target=run)
+        thread.start()
+        _wait_for(lambda: scheduler.stats().queued == 1)
+        with scheduler.slot("b"):
+            assert not started.is_set()
+    thread.join()
+    assert started.is_set()
+
+
+@pytest.mark.asyncio
+async def test_async_and_sync_share_slots() -> None:
+    """Coroutines wait for slots held by threads without blocking the event loop."""
+    scheduler = SandboxScheduler(1)
+    release = threading.Event()
+
+    def hold() -> None:
+        with scheduler.slot("fn"):
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    _wait_for(lambda: scheduler.stats().running == 1)
+
+    async def acquire() -> str:
+        async with scheduler.slot_async("fn"):
+            return "done"
+
+    task = asyncio.create_task(acquire())
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    release.set()
+    assert await task == "done"
+    thread.join()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_queue() -> None:
+    """Cancelling a waiting coroutine removes it from the queue without leaking a slot."""
+    scheduler = SandboxScheduler(1)
+    async with scheduler.slot_async("fn"):
+
+        async def acquire() -> None:
+            async with scheduler.slot_async("fn"):
+                pass
+
+        task = asyncio.create_task(acquire())
+        await asyncio.sleep(0)
+        assert scheduler.stats().queued == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.stats().queued == 0
+    assert scheduler.stats().running == 0
+
+
+def test_get_scheduler_reads_settings(monkeypatch: pytest.MonkeyPatch) -> None:
+    """The shared scheduler is built from the settings and can be replaced."""
+    monkeypatch.setattr(get_settings(), "sandbox_max_concurrency", 3)
+    set_scheduler(None)
+    try:
+        assert get_scheduler().max_concurrency == 3
+        assert get_scheduler() is get_scheduler()
+        custom = SandboxScheduler(1)
+        set_scheduler(custom)
+        assert get_scheduler() is custom
+        monkeypatch.setattr(get_settings(), "sandbox_max_concurrency", None)
+        set_scheduler(None)
+        assert get_scheduler().max_concurrency is None
+    finally:
+        set_scheduler(None)
+
+
+def test_remote_map_streams_results_and_releases_slot(monkeypatch: pytest.MonkeyPatch) -> None:
+    """`.remote.map()` yields results while the batch runs and frees its slot once the caller stops."""
+    monkeypatch.setattr(traces, "get_deployed_function_sync", lambda **_: Mock())
+    monkeypatch.setattr(traces, "get_cached_closure", lambda _: Mock())
+    monkeypatch.setattr(traces, "export_sandbox_spans", lambda _: None)
+    finish = threading.Event()
+
+    def execute_batch(
+        closure: object, batch: list[tuple[tuple[int], dict[str, object]]], **_: object
+    ) -> Iterator[dict[str, object]]:
+        for args, _kwargs in batch:
+            yield {"result": args[0] * 2, "spans": []}
+            finish.wait(timeout=5)
+
+    sandbox = Mock()
+    sandbox.execute_batch.side_effect = execute_batch
+    scheduler = SandboxScheduler(1)
+    set_scheduler(scheduler)
+    try:
+
+        @traces.trace(versioning="automatic")
+        def double(x: int) -> int:
+            return x * 2
+
+        results = double.remote.map([1, 2, 3], sandbox=sandbox, batch_size=2)  # pyright: ignore [reportFunctionMemberAccess]
+        assert next(results) == 2  # before the rest of the batch has run
+        assert scheduler.stats().running == 1
+        finish.set()
+        results.close()  # abandoned mid-batch
+        assert scheduler.stats().running == 0
+        assert list(double.remote.map([4, 5], sandbox=sandbox, batch_size=1)) == [8, 10]  # pyright: ignore [reportFunctionMemberAccess]
+        assert scheduler.stats().running == 0
+    finally:
+        set_scheduler(None)
+
+
+@pytest.mark.asyncio
+async def test_remote_map_async_streams_results(monkeypatch: pytest.MonkeyPatch) -> None:
+    """The async `.remote.map()` yields results while the batch runs and raises batch-level errors."""
+
+    async def get_function(**_: object) -> Mock:
+        return Mock()
+
+    monkeypatch.setattr(traces, "get_deployed_function_async", get_function)
+    monkeypatch.setattr(traces, "get_cached_closure", lambda _: Mock())
+    monkeypatch.setattr(traces, "export_sandbox_spans", lambda _: None)
+    finish = asyncio.Event()
+
+    async def execute_batch_async(
+        closure: object, batch: list[tuple[tuple[int], dict[str, object]]], **_: object
+    ) -> AsyncIterator[dict[str, object]]:
+        for args, _kwargs in batch:
+            if args[0] < 0:
+                raise RuntimeError("sandbox died")
+            yield {"result": args[0] * 2, "spans": []}
+            await finish.wait()
+
+    sandbox = Mock()
+    sandbox.execute_batch_async.side_effect = execute_batch_async
+    scheduler = SandboxScheduler(1)
+    set_scheduler(scheduler)
+    try:
+
+        @traces.trace(versioning="automatic")
+        async def double(x: int) -> int:
+            return x * 2
+
+        results = double.remote.map([1, 2], sandbox=sandbox)  # pyright: ignore [reportFunctionMemberAccess]
+        assert await anext(results) == 2
+        assert scheduler.stats().running == 1
+        finish.set()
+        assert [result async for result in results] == [4]
+        assert scheduler.stats().running == 0
+        with pytest.raises(RuntimeError, match="sandbox died"):
+            _ = [result async for result in double.remote.map([-1], sandbox=sandbox)]  # pyright: ignore [reportFunctionMemberAccess]
+        assert scheduler.stats().running == 0
+    finally:
+        set_scheduler(None)
@@ -0,0 +1,187 @@
+"""Tests for the `lilypad.lib.deployments` module."""
+
+import hmac
+import hashlib
+from pathlib import Path
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+import httpx
+import orjson
+import pytest
+
+from lilypad.lib import deployments
+from lilypad.types import EnvironmentPublic
+from lilypad.lib._configure import lilypad_config
+from lilypad.lib.exceptions import LilypadValueError
+from lilypad.types.projects import DeploymentPublic
+from lilypad.lib.deployments import handle_deployment_event, start_deployment_webhook_server
+from lilypad.lib._utils.disk_cache import get_disk_cache
+from lilypad.types.projects.functions import FunctionPublic
+from lilypad.lib._utils.function_cache import _deployed_cache, get_cached_closure
+
+
+def _function(name: str) -> FunctionPublic:
+    return FunctionPublic(code="", hash="h", name=name, signature="", uuid=f"uuid-{name}", project_uuid="p")
+
+
+def _event(function_name: str | None, event: str = "deployment.activated") -> dict:
+    data = {
+        "environment_uuid": "env",
+        "function_uuid": "uuid",
+        "organization_uuid": "org",
+        "uuid": "deployment",
+        "project_uuid": "p",
+    }
+    if function_name:
+        data["function"] = _function(function_name).model_dump()
+    return {"event": event, "data": data}
+
+
+@pytest.fixture(autouse=True)
+def _seed_cache():
+    _deployed_cache.clear()
+    _deployed_cache[("p", "a")] = (0.0, _function("a"))
+    _deployed_cache[("p", "b")] = (0.0, _function("b"))
+    _deployed_cache[("q", "a")] = (0.0, _function("a"))
+    yield
+    _deployed_cache.clear()
+
+
+def test_handle_deployment_event_evicts_only_affected_function():
+    """Only the deployed function named by the event is evicted."""
+    response = handle_deployment_event(_event("a"), secret="")
+    assert response.status == "success"
+    assert set(_deployed_cache) == {("p", "b"), ("q", "a")}
+
+
+def test_handle_deployment_event_without_function_evicts_project():
+    """Events that do not name a function evict every entry of the project."""
+    handle_deployment_event(_event(None), secret="")
+    assert set(_deployed_cache) == {("q", "a")}
+
+
+def test_handle_deployment_event_ignores_other_events():
+    """Unrelated events leave the cache untouched."""
+    response = handle_deployment_event(_event("a", event="invoice.paid"), secret="")
+    assert response.status == "ignored"
+    assert len(_deployed_cache) == 3
+
+
+def test_handle_deployment_event_rejects_bad_signature():
+    """A configured secret requires a valid signature."""
+    with pytest.raises(LilypadValueError):
+        handle_deployment_event(orjson.dumps(_event("a")), signature="sha256=bad", secret="s3cret")
+    assert len(_deployed_cache) == 3
+
+
+def test_webhook_server_evicts_on_signed_post():
+    """The webhook server verifies the signature and evicts the function."""
+    body = orjson.dumps(_event("b"))
+    signature = "sha256=" + hmac.new(b"s3cret", body, hashlib.sha256).hexdigest()
+    with start_deployment_webhook_server(secret="s3cret") as server:
+        response = httpx.post(server.url, content=body, headers={"Lilypad-Signature": signature})
+        unsigned = httpx.post(server.url, content=body)
+    assert response.status_code == 200
+    assert response.json() == {"status": "success", "event": "deployment.activated"}
+    assert unsigned.status_code == 401
+    assert set(_deployed_cache) == {("p", "a"), ("q", "a")}
+
+
+def test_webhook_server_requires_secret():
+    """Without a secret the server only starts when unsigned requests are explicitly allowed."""
+    with lilypad_config(webhook_secret=None), pytest.raises(LilypadValueError):
+        start_deployment_webhook_server()
+    with lilypad_config(webhook_secret=None), start_deployment_webhook_server(allow_unsigned=True) as server:
+        response = httpx.post(server.url, content=orjson.dumps(_event("b")))
+    assert response.status_code == 200
+    assert set(_deployed_cache) == {("p", "a"), ("q", "a")}
+
+
+def _deployment(name: str, *, is_active: bool = True, day: int = 1) -> DeploymentPublic:
+    return DeploymentPublic(
+        environment_uuid="env",
+        function_uuid=f"uuid-{name}",
+        organization_uuid="org",
+        uuid=f"deployment-{name}-{day}",
+        project_uuid="p",
+        is_active=is_active,
+        activated_at=datetime(2025, 1, day, tzinfo=timezone.utc),
+        function=_function(name).model_copy(update={"uuid": f"uuid-{name}-{day}"}),
+    )
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch) -> Mock:
+    client = Mock()
+    client.environments.list.return_value = [
+        EnvironmentPublic(
+            created_at=datetime.now(timezone.utc), name="prod", organization_uuid="org", uuid="env", is_default=True
+        ),
+        EnvironmentPublic(created_at=datetime.now(timezone.utc), name="staging", organization_uuid="org", uuid="stg"),
+    ]
+    client.projects.environments.get_deployment_history.return_value = [
+        _deployment("a", day=1),
+        _deployment("a", day=2),
+        _deployment("b", is_active=False),
+    ]
+    monkeypatch.setattr(deployments, "get_sync_client", lambda **_: client)
+    return client
+
+
+def test_preload_deployments_primes_caches(client: Mock, tmp_path: Path) -> None:
+    """Active deployments are cached, their closures pinned, and a snapshot is written."""
+    _deployed_cache.clear()
+    snapshot = tmp_path / "deployments.json"
+    with lilypad_config(project_id="p"):
+        functions = deployments.preload_deployments("prod", snapshot_path=snapshot)
+    assert [fn.uuid for fn in functions] == ["uuid-a-2"]
+    assert _deployed_cache[("p", "a")][1].uuid == "uuid-a-2"
+    assert ("p", "b") not in _deployed_cache
+    assert get_cached_closure(functions[0]) is get_cached_closure(functions[0])
+    client.projects.environments.get_deployment_history.assert_called_once_with("env", project_uuid="p")
+    assert deployments.DeploymentSnapshot.model_validate_json(snapshot.read_bytes()).functions == functions
+
+
+def test_preload_deployments_falls_back_to_snapshot(client: Mock, tmp_path: Path) -> None:
+    """A snapshot from a previous boot is used when the API call fails softly."""
+    snapshot = tmp_path / "deployments.json"
+    with lilypad_config(project_id="p"):
+        deployments.preload_deployments("prod", snapshot_path=snapshot)
+        _deployed_cache.clear()
+        client.environments.list.return_value = None
+        functions = deployments.preload_deployments("prod", snapshot_path=snapshot)
+    assert [fn.uuid for fn in functions] == ["uuid-a-2"]
+    assert _deployed_cache[("p", "a")][1].uuid == "uuid-a-2"
+
+
+def test_preload_deployments_unknown_environment(client: Mock) -> None:
+    """An unknown environment name is rejected."""
+    with lilypad_config(project_id="p"), pytest.raises(LilypadValueError):
+        deployments.preload_deployments("qa")
+
+
+def test_preload_deployments_other_environment_not_served_by_remote(client: Mock, tmp_path: Path) -> None:
+    """Functions of a non-default environment never replace what `.remote()` runs."""
+    _deployed_cache.clear()
+    snapshot = tmp_path / "deployments.json"
+    with lilypad_config(project_id="p", function_cache_path=str(tmp_path / "cache.sqlite")):
+        functions = deployments.preload_deployments("staging", snapshot_path=snapshot)
+        disk = get_disk_cache()
+        assert disk is not None and disk.get("deployed", ("p", "a")) is None
+        disk.close()
+        client.environments.list.return_value = None
+        deployments.preload_deployments("staging", snapshot_path=snapshot)
+    client.projects.environments.get_deployment_history.assert_called_once_with("stg", project_uuid="p")
+    assert [fn.uuid for fn in functions] == ["uuid-a-2"]
+    assert not _deployed_cache
+    assert get_cached_closure(functions[0]) is get_cached_closure(functions[0])
+
+
+def test_preload_deployments_prepares_environments(client: Mock) -> None:
+    """Sandbox environments of the preloaded functions are built ahead of time."""
+    environments = Mock()
+    with lilypad_config(project_id="p"):
+        deployments.preload_deployments("prod", environments=environments)
+    (closures,), _ = environments.prepare.call_args
+    assert [closure.name for closure in closures] == ["a"]
@@ -0,0 +1,38 @@
+"""Tests for the `trace` decorator."""
+
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from lilypad.lib import traces
+
+
+@pytest.mark.asyncio
+async def test_async_version_returns_sync_callable(monkeypatch: pytest.MonkeyPatch) -> None:
+    """`.version()` on an async function keeps returning a blocking callable; `.version_async()` a coroutine one."""
+
+    async def get_function(**_: object) -> Mock:
+        return Mock()
+
+    monkeypatch.setattr(traces, "get_function_by_version_async", get_function)
+    monkeypatch.setattr(traces, "get_cached_closure", lambda _: Mock())
+    monkeypatch.setattr(traces, "export_sandbox_spans", lambda _: None)
+    sandbox = Mock()
+    sandbox.execute_function.side_effect = lambda closure, x, **_: {"result": x * 2, "spans": []}
+
+    async def execute_function_async(closure: object, x: int, **_: object) -> dict[str, object]:
+        return {"result": x * 3, "spans": []}
+
+    sandbox.execute_function_async.side_effect = execute_function_async
+
+    @traces.trace(versioning="automatic")
+    async def double(x: int) -> int:
+        return x * 2
+
+    version = await double.version(1, sandbox)
+    assert not asyncio.iscoroutinefunction(version)
+    assert version(2) == 4
+    version_async = await double.version_async(1, sandbox)
+    assert asyncio.iscoroutinefunction(version_async)
+    assert await version_async(2) == 6